@@ -0,0 +1,248 @@
+"""
+Knowledge distillation from the ResNet-152 classifier to a lightweight student
+The student (ResNet-18/34 or MobileNetV3) gets the same 5-class LogSoftmax head and is
+trained on the teacher's temperature-softened probabilities, so no labels are needed.
+
+    python distill.py --data /data/fundus --student resnet18 --epochs 10 --output student_resnet18.pt
+    python distill.py --report-only --output student_resnet18.pt --eval-dir sampleimages
+    python distill.py --data /data/fundus --input-size 160 --output triage_resnet18.pt   # cascade triage model
+
+The student checkpoint records its architecture, so the serving apps load it
+as a drop-in replacement: MODEL_PATH=student_resnet18.pt python app.py
+With --input-size the student instead learns from the teacher's view downscaled
+exactly as the cascade downscales it, and records that size for CASCADE_INPUT_SIZE.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+import torchvision
+from torch.optim import lr_scheduler
+from torch.utils import data
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_runtime import ARCHITECTURES, MODEL_PATH, build_model, load_checkpoint_model, test_transforms  # noqa: E402
+from prediction_cache import model_fingerprint  # noqa: E402
+from preprocessing import INPUT_SIZE, MEAN, STD  # noqa: E402
+from quantization import CALIBRATION_DIR, serialized_size_mb, time_forward  # noqa: E402
+from cascade import shrink, trained_input_size  # noqa: E402
+from model import scan_images  # noqa: E402
+
+STUDENT_ARCHS = [arch for arch in ARCHITECTURES if arch != 'resnet152']
+
+# Mild augmentation: the teacher sees exactly the same view, so its soft targets stay consistent
+train_transforms = torchvision.transforms.Compose([
+    torchvision.transforms.Resize((256, 256)),
+    torchvision.transforms.RandomResizedCrop(224, scale=(0.8, 1.0), ratio=(0.9, 1.1)),
+    torchvision.transforms.RandomHorizontalFlip(),
+    torchvision.transforms.RandomRotation(10),
+    torchvision.transforms.ToTensor(),
+    torchvision.transforms.Normalize(mean=MEAN, std=STD)
+])
+
+
+class DistillationDataset(data.Dataset):
+    """Unlabelled fundus images; the teacher provides the targets"""
+
+    def __init__(self, paths, transform=train_transforms):
+        self.paths = paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        try:
+            return self.transform(Image.open(self.paths[index]).convert('RGB'))
+        except Exception as e:
+            print(f"Skipping {self.paths[index]}: {e}")
+            return None
+
+
+def collate_tensors(items):
+    # Unreadable images come back as None and are dropped from the batch
+    items = [item for item in items if item is not None]
+    return torch.stack(items) if items else None
+
+
+def evaluation_batches(folder, batch_size=8):
+    """Preprocessed batches of every image under `folder`, scanned recursively like the training data"""
+    paths = scan_images(folder)
+    loader = data.DataLoader(DistillationDataset(paths, test_transforms), batch_size=batch_size,
+                             collate_fn=collate_tensors)
+    batches = [batch for batch in loader if batch is not None]
+    if not batches:
+        raise SystemExit(f"No readable images under {folder} for the agreement report; pass --eval-dir")
+    return batches
+
+
+def distillation_loss(student_log_probs, teacher_log_probs, temperature):
+    """KL divergence between temperature-softened teacher and student distributions
+
+    Both heads end in LogSoftmax; dividing log-probabilities by T and
+    renormalising is the same as softening the logits. The T^2 factor keeps
+    gradient magnitudes comparable across temperatures.
+    """
+    student = F.log_softmax(student_log_probs / temperature, dim=1)
+    teacher = F.log_softmax(teacher_log_probs / temperature, dim=1)
+    return F.kl_div(student, teacher, log_target=True, reduction='batchmean') * temperature ** 2
+
+
+def save_checkpoint(path, student, arch, optimizer, epoch, temperature, teacher_path, input_size):
+    # Same 'model_state_dict' layout as classifier.pt, plus the architecture to rebuild
+    checkpoint = {
+        'arch': arch,
+        'input_size': input_size,
+        'model_state_dict': student.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'epoch': epoch,
+        'temperature': temperature,
+        'teacher': model_fingerprint(teacher_path)
+    }
+    torch.save(checkpoint, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def distill(teacher, student, loader, epochs, lr, temperature, output, arch, teacher_path, input_size=INPUT_SIZE):
+    """Train `student` on the teacher's soft targets, checkpointing to `output` after every epoch
+
+    The teacher always sees the full-resolution view; the student sees it
+    downscaled to `input_size`.
+    """
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    scheduler = lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(1, epochs))
+    teacher.eval()
+    for epoch in range(1, epochs + 1):
+        student.train()
+        start = time.perf_counter()
+        total_loss = seen = 0
+        for batch in loader:
+            if batch is None:
+                continue
+            with torch.no_grad():
+                targets = teacher(batch)
+            loss = distillation_loss(student(shrink(batch, input_size)), targets, temperature)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(batch)
+            seen += len(batch)
+        scheduler.step()
+        elapsed = time.perf_counter() - start
+        print(f"Epoch {epoch}/{epochs}: loss {total_loss / max(1, seen):.4f}  "
+              f"{elapsed:.1f}s  {seen / elapsed:.1f} img/s")
+        save_checkpoint(output, student, arch, optimizer, epoch, temperature, teacher_path, input_size)
+    student.eval()
+    return student
+
+
+def compare_models(teacher, student, batches, runs=5, input_size=INPUT_SIZE):
+    """Size, latency and agreement of the student (at `input_size`) against the teacher"""
+    agree = total = 0
+    kl = prob_diff = 0.0
+    with torch.no_grad():
+        for batch in batches:
+            t, s = teacher(batch), student(shrink(batch, input_size))
+            agree += (t.argmax(1) == s.argmax(1)).sum().item()
+            kl += F.kl_div(s, t, log_target=True, reduction='sum').item()
+            prob_diff += (t.exp() - s.exp()).abs().max(dim=1).values.sum().item()
+            total += len(batch)
+    report = {'images': total, 'top1_agreement': agree / total, 'mean_kl': kl / total, 'mean_max_prob_diff': prob_diff / total}
+    for name, model, size in (('teacher', teacher, INPUT_SIZE), ('student', student, input_size)):
+        timing_batch = shrink(batches[0], size)
+        report[name] = {
+            'parameters': sum(p.numel() for p in model.parameters()),
+            'size_mb': serialized_size_mb(model),
+            'input_size': size,
+            'latency_ms_batch_1': time_forward(model, timing_batch[:1], runs) * 1000,
+            f'latency_ms_batch_{len(batches[0])}': time_forward(model, timing_batch, runs) * 1000
+        }
+    return report
+
+
+def print_report(report, arch):
+    teacher, student = report['teacher'], report['student']
+    print("=" * 66)
+    print(f"{'':24}{'resnet152':>12}{arch:>20}{'ratio':>10}")
+    print(f"{'Input size (px)':24}{teacher['input_size']:12}{student['input_size']:20}")
+    print(f"{'Parameters (M)':24}{teacher['parameters'] / 1e6:12.1f}{student['parameters'] / 1e6:20.1f}"
+          f"{teacher['parameters'] / student['parameters']:9.1f}x")
+    print(f"{'Size (MB)':24}{teacher['size_mb']:12.1f}{student['size_mb']:20.1f}{teacher['size_mb'] / student['size_mb']:9.1f}x")
+    for key in teacher:
+        if key.startswith('latency'):
+            label = f"Latency {key.rsplit('_', 2)[-2]} {key.rsplit('_', 1)[-1]} (ms)"
+            print(f"{label:24}{teacher[key]:12.1f}{student[key]:20.1f}{teacher[key] / student[key]:9.1f}x")
+    print(f"Top-1 agreement with teacher: {100 * report['top1_agreement']:.1f}% of {report['images']} images")
+    print(f"Mean KL(teacher || student): {report['mean_kl']:.4f}   mean max |prob diff|: {report['mean_max_prob_diff']:.4f}")
+    print("=" * 66)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distil the ResNet-152 classifier into a lightweight student")
+    parser.add_argument('--teacher', default=MODEL_PATH, help="Teacher checkpoint with a 'model_state_dict'")
+    parser.add_argument('--data', default=CALIBRATION_DIR, help="Directory scanned recursively for training images")
+    parser.add_argument('--eval-dir', default=None, help="Images for the agreement report (defaults to --data)")
+    parser.add_argument('--student', choices=STUDENT_ARCHS, default='resnet18')
+    parser.add_argument('--input-size', type=int, default=None,
+                        help="Student input resolution, e.g. CASCADE_INPUT_SIZE for a triage model "
+                             f"(default {INPUT_SIZE}; with --report-only, the size the student recorded)")
+    parser.add_argument('--pretrained', action='store_true', help="Start the student from torchvision's ImageNet weights")
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--output', default=None, help="Student checkpoint (default: student_<arch>.pt)")
+    parser.add_argument('--report-only', action='store_true', help="Skip training and report on an existing --output")
+    parser.add_argument('--report-json', help="Also write the report to this file")
+    parser.add_argument('--runs', type=int, default=5, help="Timed forward passes per latency measurement")
+    args = parser.parse_args()
+
+    teacher, _ = load_checkpoint_model(args.teacher)
+    teacher.requires_grad_(False)
+    teacher.eval()
+
+    if args.report_only:
+        path = args.output or f'student_{args.student}.pt'
+        student, arch = load_checkpoint_model(path)
+        input_size = args.input_size or trained_input_size(path)
+    else:
+        arch = args.student
+        input_size = args.input_size or INPUT_SIZE
+        output = args.output or f'student_{arch}.pt'
+        paths = scan_images(args.data)
+        if not paths:
+            raise SystemExit(f"No training images under {args.data}")
+        print(f"Distilling into {arch} at {input_size} px on {len(paths)} images for {args.epochs} epochs")
+        loader = data.DataLoader(
+            DistillationDataset(paths),
+            batch_size=args.batch_size,
+            shuffle=True,
+            num_workers=args.workers,
+            collate_fn=collate_tensors,
+            drop_last=len(paths) > args.batch_size
+        )
+        student = build_model(None, arch, weights='DEFAULT' if args.pretrained else None)
+        distill(teacher, student, loader, args.epochs, args.lr, args.temperature, output, arch, args.teacher,
+                input_size)
+        print(f"Student saved to {output}")
+    student.requires_grad_(False)
+    student.eval()
+
+    batches = evaluation_batches(args.eval_dir or args.data)
+    report = compare_models(teacher, student, batches, args.runs, input_size)
+    report['arch'] = arch
+    print_report(report, arch)
+    if args.report_json:
+        with open(args.report_json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,5 @@
-# Importing all packages 
+# Importing all packages
 import numpy as np
-import matplotlib.pyplot as plt
 from torch.utils import data
 import torch
 from torch import nn
@@ -13,36 +12,44 @@ from PIL import Image, ImageFile
 import json
 from torch.optim import lr_scheduler
 import random
+import argparse
+import csv
 import os
 import sys
+import time
+
+# The model architecture is shared with the web apps (model_runtime.py in the repo root)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_runtime import build_model, runtime, load_image, preprocess, CLASSES
+from dataset_shards import ShardDataset, normalize_batch, scan_images
 
 print('Imported packages')
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = models.resnet152(pretrained=False)
-num_ftrs = model.fc.in_features
-out_ftrs = 5
-model.fc = nn.Sequential(nn.Linear(num_ftrs, 512),nn.ReLU(),nn.Linear(512,out_ftrs),nn.LogSoftmax(dim=1))
-criterion = nn.NLLLoss()
-optimizer = torch.optim.Adam(filter(lambda p:p.requires_grad,model.parameters()) , lr = 0.00001)
-
-scheduler = lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.1)
-model.to(device);
-# to unfreeze more layers
-
-
-for name,child in model.named_children():
-    if name in ['layer2','layer3','layer4','fc']:
-        #print(name + 'is unfrozen')
-        for param in child.parameters():
-            param.requires_grad = True
-    else:
-        #print(name + 'is frozen')
-        for param in child.parameters():
-            param.requires_grad = False
-optimizer = torch.optim.Adam(filter(lambda p:p.requires_grad,model.parameters()) , lr = 0.000001)
-scheduler = lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.1)
+
+def setup_training(device=device):
+    # ResNet-152 with layer2-layer4 and the fc head unfrozen, as used for training
+    model = build_model(device)
+    criterion = nn.NLLLoss()
+    model.to(device);
+    # to unfreeze more layers
+
+
+    for name,child in model.named_children():
+        if name in ['layer2','layer3','layer4','fc']:
+            #print(name + 'is unfrozen')
+            for param in child.parameters():
+                param.requires_grad = True
+        else:
+            #print(name + 'is frozen')
+            for param in child.parameters():
+                param.requires_grad = False
+    optimizer = torch.optim.Adam(filter(lambda p:p.requires_grad,model.parameters()) , lr = 0.000001)
+    scheduler = lr_scheduler.StepLR(optimizer, step_size=5, gamma=0.1)
+    return model, criterion, optimizer, scheduler
 
 def load_model(path):
+    # Full training checkpoint: model weights plus optimizer state
+    model, criterion, optimizer, scheduler = setup_training()
     checkpoint = torch.load(path,map_location='cpu')
     model.load_state_dict(checkpoint['model_state_dict'])
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
@@ -64,34 +71,228 @@ def inference(model, file, transform, classes):
         print("class is: ", classes[value])
         print('Your image is printed:')
         return value, classes[value]
-        # plt.imshow(np.array(file))
-        # plt.show()
-
-
-model = load_model('../Desktop/classifier.pt')
-print("Model loaded Succesfully")
-classes = ['No DR', 'Mild', 'Moderate', 'Severe', 'Proliferative DR']
-test_transforms = torchvision.transforms.Compose([
-    torchvision.transforms.Resize((224, 224)),
-    torchvision.transforms.RandomHorizontalFlip(p=0.5),
-    torchvision.transforms.ToTensor(),
-    torchvision.transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
-])
+
+
+def get_model():
+    # Inference uses the shared runtime: lazy, meta-device loading and the configured backend
+    if not runtime.ensure_loaded():
+        raise RuntimeError(f"Model not loaded: {runtime.error}")
+    print("Model loaded Succesfully")
+    return runtime.model
+
+classes = CLASSES
+# Deterministic: no random flips at inference, so the same image always scores the same
+test_transforms = preprocess
 def main(path):
-    x, y = inference(model, path, test_transforms, classes)
+    x, y = inference(get_model(), path, test_transforms, classes)
     return x, y
-# if __name__ == '__model__':
-#     # test_dir = '../Desktop/eye'
-#     # folders = os.listdir(test_dir)
-#     # for num in range(len(folders)):
-#     #     path = test_dir+"/"+folders[num]
-#     #     print(path)
-#     #     inference(model, path, test_transforms, classes)
-#     l = sys.argv
-#     if(len(l)>1):
-#         for i in range(1, len(l)):
-#             print(l[i])
-#             path = l[i]
-#             inference(model, path, test_transforms, classes)
-#     else:
-#         print('please provide the exact path of image !')
+
+
+# Offline batch scoring
+RESULT_COLUMNS = ['path', 'severity_value', 'severity_class', 'confidence'] + [f'prob_{c}' for c in CLASSES] + ['error']
+
+class ImagePathDataset(data.Dataset):
+    # Decodes and preprocesses in DataLoader worker processes
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        path = self.paths[index]
+        try:
+            return preprocess(load_image(path)), path, ''
+        except Exception as e:
+            return None, path, str(e)
+
+def collate_images(items):
+    # Stack the images that decoded; keep failures so they are still recorded
+    ok = [(tensor, path) for tensor, path, error in items if tensor is not None]
+    failed = [(path, error) for tensor, path, error in items if tensor is None]
+    batch = torch.stack([tensor for tensor, _ in ok]) if ok else None
+    return batch, [path for _, path in ok], failed
+
+def _worker_init(worker_id):
+    # Decoding workers don't need torch's intra-op threads
+    torch.set_num_threads(1)
+
+class ResultWriter:
+    # Appends results incrementally; the output file doubles as the resume checkpoint
+    def __init__(self, output, fmt, flush_every=1024):
+        self.output = output
+        self.fmt = fmt
+        self.flush_every = flush_every
+        self.rows = []
+        self._csv_file = None
+        self._parts = 0
+        if fmt == 'parquet':
+            os.makedirs(output, exist_ok=True)
+            self._parts = len([f for f in os.listdir(output) if f.endswith('.parquet')])
+
+    def scored_paths(self):
+        # Paths already present in the output (from an earlier, interrupted run)
+        if self.fmt == 'parquet':
+            import pyarrow.parquet as pq
+            done = set()
+            for name in sorted(os.listdir(self.output)):
+                if name.endswith('.parquet'):
+                    done.update(pq.read_table(os.path.join(self.output, name), columns=['path']).column('path').to_pylist())
+            return done
+        if not os.path.exists(self.output):
+            return set()
+        # Drop a half-written last line left behind by a crash
+        with open(self.output, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b'\n'):
+                f.truncate(content.rfind(b'\n') + 1)
+        with open(self.output, newline='') as f:
+            return {row['path'] for row in csv.DictReader(f)}
+
+    def write(self, rows):
+        self.rows.extend(rows)
+        if self.fmt == 'csv' or len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # Explicit schema so parts holding only failed images still match the rest
+            schema = pa.schema(
+                [('path', pa.string()), ('severity_value', pa.int64()), ('severity_class', pa.string()), ('confidence', pa.float64())]
+                + [(f'prob_{c}', pa.float64()) for c in CLASSES] + [('error', pa.string())]
+            )
+            table = pa.Table.from_pylist(self.rows, schema=schema)
+            path = os.path.join(self.output, f'part-{self._parts:05d}.parquet')
+            pq.write_table(table, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            self._parts += 1
+        else:
+            if self._csv_file is None:
+                new_file = not os.path.exists(self.output) or os.path.getsize(self.output) == 0
+                self._csv_file = open(self.output, 'a', newline='')
+                self._csv_writer = csv.DictWriter(self._csv_file, fieldnames=RESULT_COLUMNS)
+                if new_file:
+                    self._csv_writer.writeheader()
+            self._csv_writer.writerows(self.rows)
+            self._csv_file.flush()
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self._csv_file is not None:
+            self._csv_file.close()
+
+def result_rows(paths, output):
+    ps = torch.exp(output)
+    top_p, top_class = ps.topk(1, dim=1)
+    rows = []
+    for path, probs, p, c in zip(paths, ps.tolist(), top_p[:, 0].tolist(), top_class[:, 0].tolist()):
+        row = {'path': path, 'severity_value': c, 'severity_class': CLASSES[c], 'confidence': round(p * 100, 2), 'error': ''}
+        row.update({f'prob_{name}': round(prob * 100, 4) for name, prob in zip(CLASSES, probs)})
+        rows.append(row)
+    return rows
+
+def error_row(path, error):
+    row = {column: None for column in RESULT_COLUMNS}
+    row.update({'path': path, 'error': error})
+    return row
+
+def shard_loader(directory, batch_size=32, shuffle=False, workers=2, prefetch=4, indices=None):
+    # DataLoader over preprocessed shards (dataset_shards.py): yields (uint8 images, labels, paths);
+    # pass the images through normalize_batch() before the model
+    dataset = ShardDataset(directory)
+    if indices is not None:
+        dataset = data.Subset(dataset, indices)
+    return data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=workers,
+        worker_init_fn=_worker_init if workers > 0 else None,
+        prefetch_factor=prefetch if workers > 0 else None
+    )
+
+def _pending(paths, output, fmt, flush_every):
+    # Open the writer and work out which paths an earlier run hasn't scored yet
+    writer = ResultWriter(output, fmt, flush_every)
+    done = writer.scored_paths()
+    todo = [i for i, p in enumerate(paths) if p not in done]
+    print(f"{len(paths)} images, {len(done)} already scored, {len(todo)} to go")
+    return writer, todo
+
+def _run_scoring(loader, writer, total):
+    # Each loader item is (normalised batch or None, paths, [(path, error), ...])
+    if not runtime.ensure_loaded():
+        writer.close()
+        raise RuntimeError(f"Model not loaded: {runtime.error}")
+    scored = 0
+    start = time.perf_counter()
+    try:
+        for batch, batch_paths, failed in loader:
+            rows = [error_row(path, error) for path, error in failed]
+            if batch is not None:
+                rows += result_rows(batch_paths, runtime.forward(batch))
+            writer.write(rows)
+            scored += len(rows)
+            elapsed = time.perf_counter() - start
+            print(f"\r{scored}/{total} images ({scored / elapsed:.1f} img/s)", end='', flush=True)
+    finally:
+        writer.close()
+        print()
+    return scored
+
+def score_images(paths, output, fmt='csv', batch_size=32, workers=4, prefetch=4, flush_every=1024):
+    # Score `paths` in batches, skipping any already in `output`
+    writer, todo = _pending(paths, output, fmt, flush_every)
+    if not todo:
+        return 0
+    loader = data.DataLoader(
+        ImagePathDataset([paths[i] for i in todo]),
+        batch_size=batch_size,
+        num_workers=workers,
+        collate_fn=collate_images,
+        worker_init_fn=_worker_init if workers > 0 else None,
+        prefetch_factor=prefetch if workers > 0 else None,
+        persistent_workers=False
+    )
+    return _run_scoring(loader, writer, len(todo))
+
+def score_shards(directory, output, fmt='csv', batch_size=32, workers=2, prefetch=4, flush_every=1024):
+    # Score preprocessed shards: no decoding, only the uint8 -> float normalisation per batch
+    paths = [record['path'] for record in ShardDataset(directory).records]
+    writer, todo = _pending(paths, output, fmt, flush_every)
+    if not todo:
+        return 0
+    loader = shard_loader(directory, batch_size, workers=workers, prefetch=prefetch, indices=todo)
+    batches = ((normalize_batch(images), list(batch_paths), []) for images, _, batch_paths in loader)
+    return _run_scoring(batches, writer, len(todo))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score retinal images for diabetic retinopathy severity")
+    parser.add_argument('images', nargs='*', help="Image files to score (printed to the console)")
+    parser.add_argument('--input-dir', help="Directory scanned recursively for images to batch score")
+    parser.add_argument('--shards', help="Preprocessed shard directory (dataset_shards.py) to batch score")
+    parser.add_argument('--output', default='scores.csv', help="CSV file, or directory of Parquet parts with --format parquet")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help="DataLoader decoding processes")
+    parser.add_argument('--prefetch', type=int, default=4, help="Batches prefetched per worker")
+    parser.add_argument('--flush-every', type=int, default=1024, help="Rows buffered per Parquet part")
+    args = parser.parse_args()
+
+    if args.shards:
+        score_shards(args.shards, args.output, args.format,
+                     args.batch_size, args.workers, args.prefetch, args.flush_every)
+    elif args.input_dir:
+        score_images(scan_images(args.input_dir), args.output, args.format,
+                     args.batch_size, args.workers, args.prefetch, args.flush_every)
+    elif args.images:
+        for path in args.images:
+            print(path)
+            main(path)
+    else:
+        print('please provide the exact path of image !')
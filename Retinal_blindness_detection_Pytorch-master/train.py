@@ -0,0 +1,271 @@
+"""
+Fine-tuning loop for the ResNet-152 classifier
+Uses model.py's setup (layer2-layer4 + fc unfrozen, NLLLoss, Adam, StepLR) on preprocessed shards
+
+    python train.py --shards /data/fundus_shards --epochs 10 --output classifier.pt   # fine-tunes MODEL_PATH
+    python train.py --shards /data/fundus_shards --resume classifier.pt      # continue after an interruption
+    python train.py --synthetic 64 --synthetic-size 64 --epochs 2           # CPU smoke test, no data needed
+
+Checkpoints use classifier.pt's keys ('model_state_dict', 'optimizer_state_dict'),
+so the serving apps load them directly. Resuming is exact: the sample order of
+each epoch comes from (seed, epoch), augmentation is seeded per (seed, epoch,
+sample), and checkpoints are only written at optimizer-step boundaries.
+"""
+
+import argparse
+import math
+import os
+import time
+
+import torch
+from torch.utils import data
+
+from model import setup_training, device, shard_loader, _worker_init
+from dataset_shards import ShardDataset, normalize_batch
+from model_runtime import CLASSES, MODEL_PATH, build_model, read_checkpoint
+from inference_profile import bf16_supported
+
+
+class SyntheticDataset(data.Dataset):
+    """Deterministic random uint8 images with cycling labels, shaped like ShardDataset rows"""
+
+    def __init__(self, length, size=224, seed=0):
+        self.length = length
+        self.size = size
+        self.seed = seed
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        generator = torch.Generator().manual_seed(self.seed * 1000003 + index)
+        image = torch.randint(0, 256, (3, self.size, self.size), dtype=torch.uint8, generator=generator)
+        return image, index % len(CLASSES), f'synthetic/{index}'
+
+
+class Augmented(data.Dataset):
+    """Random flips whose randomness depends only on (seed, epoch, index), so a resumed run sees the same views"""
+
+    def __init__(self, dataset, seed=0):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        image, label, _ = self.dataset[index]
+        generator = torch.Generator().manual_seed((self.seed * 1009 + self.epoch) * 1000003 + index)
+        flips = torch.rand(2, generator=generator)
+        if flips[0] < 0.5:
+            image = image.flip(-1)
+        if flips[1] < 0.5:
+            image = image.flip(-2)
+        return image, label
+
+
+class EpochSampler(data.Sampler):
+    """Shuffled order fixed by (seed, epoch), starting `start` samples in"""
+
+    def __init__(self, length, seed, epoch, start=0):
+        self.length = length
+        self.seed = seed
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        order = torch.randperm(self.length, generator=torch.Generator().manual_seed(self.seed * 1009 + self.epoch))
+        return iter(order[self.start:].tolist())
+
+    def __len__(self):
+        return self.length - self.start
+
+
+def load_initial_weights(model, init):
+    """Start from a checkpoint's weights, torchvision's ImageNet backbone ('imagenet') or nothing ('random')"""
+    if init == 'random':
+        # setup_training freezes conv1/bn1/layer1, so they stay random: only useful for smoke tests
+        print("Starting from random weights; the frozen layers stay random")
+        return
+    if init == 'imagenet':
+        model.load_state_dict(build_model(weights='DEFAULT').state_dict())
+        return
+    try:
+        checkpoint = read_checkpoint(init, device)
+    except Exception as e:
+        raise SystemExit(f"Could not read --init checkpoint {init} ({e}). "
+                         "Pass --init imagenet to start from ImageNet weights.")
+    if checkpoint.get('arch', 'resnet152') != 'resnet152':
+        raise SystemExit(f"{init} holds a {checkpoint['arch']}; train.py fine-tunes the ResNet-152")
+    model.load_state_dict(checkpoint['model_state_dict'])
+
+
+def save_checkpoint(path, model, optimizer, scheduler, epoch, batch, global_step, args):
+    # classifier.pt-compatible keys plus what resuming needs
+    checkpoint = {
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict': scheduler.state_dict(),
+        'arch': 'resnet152',
+        'epoch': epoch,
+        'batch': batch,
+        'global_step': global_step,
+        'seed': args.seed,
+        'batch_size': args.batch_size,
+        'accumulate': args.accumulate
+    }
+    torch.save(checkpoint, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def evaluate(model, loader, autocast):
+    """Top-1 accuracy and mean NLL over a labelled loader"""
+    model.eval()
+    correct = total = 0
+    loss = 0.0
+    with torch.no_grad():
+        for images, labels, _ in loader:
+            with autocast():
+                output = model(normalize_batch(images).to(device)).float()
+            labels = labels.to(device)
+            loss += torch.nn.functional.nll_loss(output, labels, reduction='sum').item()
+            correct += (output.argmax(1) == labels).sum().item()
+            total += len(labels)
+    return correct / max(1, total), loss / max(1, total)
+
+
+def train(args):
+    torch.manual_seed(args.seed)
+    model, criterion, optimizer, scheduler = setup_training(device)
+    if args.lr:
+        for group in optimizer.param_groups:
+            group['lr'] = group['initial_lr'] = args.lr
+        scheduler.base_lrs = [args.lr for _ in scheduler.base_lrs]
+    if not args.resume:
+        # Fresh optimizer on top of the starting weights
+        load_initial_weights(model, args.init)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    if args.synthetic:
+        dataset = SyntheticDataset(args.synthetic, args.synthetic_size, args.seed)
+    else:
+        shards = ShardDataset(args.shards)
+        labelled = [i for i, label in enumerate(shards.labels) if label >= 0]
+        if not labelled:
+            raise SystemExit(f"No labelled images in {args.shards}")
+        dataset = data.Subset(shards, labelled)
+    train_set = Augmented(dataset, args.seed)
+
+    epoch, start_batch, global_step = 0, 0, 0
+    if args.resume:
+        # Not memory-mapped: the optimizer state loaded from it is updated in place
+        checkpoint = torch.load(args.resume, map_location=device, weights_only=True)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        epoch, start_batch, global_step = checkpoint['epoch'], checkpoint['batch'], checkpoint['global_step']
+        if (checkpoint['batch_size'], checkpoint['accumulate'], checkpoint['seed']) != (args.batch_size, args.accumulate, args.seed):
+            raise SystemExit("Resume with the same --batch-size, --accumulate and --seed as the interrupted run")
+        print(f"Resuming at epoch {epoch + 1}, batch {start_batch} (step {global_step})")
+
+    use_bf16 = args.bf16 == 'on' or (args.bf16 == 'auto' and bf16_supported())
+    use_bf16 = use_bf16 and device.type == 'cpu'
+
+    def autocast():
+        return torch.autocast('cpu', dtype=torch.bfloat16, enabled=use_bf16)
+
+    val_loader = shard_loader(args.val_shards, args.batch_size, workers=args.workers) if args.val_shards else None
+    batches_per_epoch = math.ceil(len(train_set) / args.batch_size)
+    print(f"Training on {len(train_set)} images: {batches_per_epoch} batches/epoch, "
+          f"effective batch {args.batch_size * args.accumulate}, bf16 {'on' if use_bf16 else 'off'}")
+
+    for epoch in range(epoch, args.epochs):
+        train_set.epoch = epoch
+        sampler = EpochSampler(len(train_set), args.seed, epoch, start_batch * args.batch_size)
+        loader = data.DataLoader(
+            train_set,
+            batch_size=args.batch_size,
+            sampler=sampler,
+            num_workers=args.workers,
+            worker_init_fn=_worker_init if args.workers > 0 else None,
+            prefetch_factor=args.prefetch if args.workers > 0 else None,
+            pin_memory=device.type == 'cuda'
+        )
+        model.train()
+        optimizer.zero_grad()
+        start = time.perf_counter()
+        seen = correct = 0
+        total_loss = 0.0
+        for batch, (images, labels) in enumerate(loader, start=start_batch + 1):
+            images = normalize_batch(images).to(device, non_blocking=True)
+            if args.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
+            labels = labels.to(device, non_blocking=True)
+            with autocast():
+                output = model(images)
+            loss = criterion(output.float(), labels)
+            (loss / args.accumulate).backward()
+            total_loss += loss.item() * len(labels)
+            correct += (output.argmax(1) == labels).sum().item()
+            seen += len(labels)
+
+            if batch % args.accumulate == 0 or batch == batches_per_epoch:
+                optimizer.step()
+                optimizer.zero_grad()
+                global_step += 1
+                if args.checkpoint_every and global_step % args.checkpoint_every == 0 and batch < batches_per_epoch:
+                    save_checkpoint(args.output, model, optimizer, scheduler, epoch, batch, global_step, args)
+                if args.stop_after_steps and global_step >= args.stop_after_steps:
+                    save_checkpoint(args.output, model, optimizer, scheduler, epoch, batch, global_step, args)
+                    print(f"\nStopped after {global_step} steps; resume with --resume {args.output}")
+                    return model
+            elapsed = time.perf_counter() - start
+            print(f"\rEpoch {epoch + 1}/{args.epochs} batch {batch}/{batches_per_epoch} "
+                  f"loss {total_loss / seen:.4f} ({seen / elapsed:.1f} samples/s)", end='', flush=True)
+
+        scheduler.step()
+        elapsed = time.perf_counter() - start
+        save_checkpoint(args.output, model, optimizer, scheduler, epoch + 1, 0, global_step, args)
+        summary = (f"\rEpoch {epoch + 1}/{args.epochs}: loss {total_loss / max(1, seen):.4f}  "
+                   f"acc {100 * correct / max(1, seen):.1f}%  {elapsed:.1f}s  {seen / elapsed:.1f} samples/s")
+        if val_loader is not None:
+            val_acc, val_loss = evaluate(model, val_loader, autocast)
+            summary += f"  val loss {val_loss:.4f}  val acc {100 * val_acc:.1f}%"
+        print(summary)
+        start_batch = 0
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fine-tune the ResNet-152 classifier")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--shards', help="Training shards built with dataset_shards.py (unlabelled images are skipped)")
+    source.add_argument('--synthetic', type=int, metavar='N', help="Train on N synthetic images instead")
+    parser.add_argument('--synthetic-size', type=int, default=224, help="Side of the synthetic images")
+    parser.add_argument('--val-shards', help="Shards evaluated after every epoch")
+    parser.add_argument('--output', default='classifier.pt', help="Checkpoint written during training")
+    parser.add_argument('--init', help="Checkpoint to fine-tune from (weights only), 'imagenet' or 'random' "
+                                       "(default: MODEL_PATH, or random for --synthetic)")
+    parser.add_argument('--resume', help="Checkpoint of an interrupted run to continue exactly")
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--accumulate', type=int, default=1, help="Batches per optimizer step")
+    parser.add_argument('--lr', type=float, default=None, help="Override model.py's learning rate (1e-6)")
+    parser.add_argument('--bf16', choices=['off', 'on', 'auto'], default='off', help="bfloat16 autocast on CPU")
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--prefetch', type=int, default=4, help="Batches prefetched per worker")
+    parser.add_argument('--checkpoint-every', type=int, default=100, help="Optimizer steps between mid-epoch checkpoints")
+    parser.add_argument('--stop-after-steps', type=int, default=None, help="Checkpoint and stop after this many steps")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.init = args.init or ('random' if args.synthetic else MODEL_PATH)
+    if args.resume and os.path.abspath(args.resume) != os.path.abspath(args.output):
+        print(f"Resuming from {args.resume}; new checkpoints go to {args.output}")
+    train(args)
+
+
+if __name__ == '__main__':
+    main()
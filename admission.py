@@ -0,0 +1,126 @@
+"""
+Admission control for the inference endpoints
+Bounds concurrent and queued requests, rate-limits clients and enforces per-request deadlines
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class Rejected(Exception):
+    """A request was turned away before any work was done; `retry_after` is in whole seconds"""
+
+    def __init__(self, reason, message, retry_after=1):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """At most `max_in_flight` requests run at once and at most `max_queued` wait for a slot
+
+    A request that finds the queue full is rejected immediately, as is one
+    whose deadline passes while it waits. Retry-After is estimated from a
+    moving average of how long admitted requests hold their slot. A limit of
+    0 disables it.
+    """
+
+    def __init__(self, max_in_flight=16, max_queued=32):
+        self.max_in_flight = max(0, int(max_in_flight))
+        self.max_queued = max(0, int(max_queued))
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._queued = 0
+        self._admitted = 0
+        self._rejected = {}
+        self._service_time = 0.5  # seconds, moving average
+
+    def acquire(self, deadline=None):
+        """Take a slot, waiting in the queue until `deadline` (time.monotonic()) if all are busy
+
+        Returns the admission time, to pass back to release().
+        """
+        with self._cond:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                if self._queued >= self.max_queued:
+                    raise self._reject('queue_full', "Server is busy. Please retry later.")
+                self._queued += 1
+                try:
+                    while self._in_flight >= self.max_in_flight:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            raise self._reject('deadline', "Request deadline passed while queued.")
+                        self._cond.wait(remaining)
+                finally:
+                    self._queued -= 1
+            self._in_flight += 1
+            self._admitted += 1
+            return time.monotonic()
+
+    def release(self, admitted_at):
+        with self._cond:
+            self._in_flight -= 1
+            self._service_time = 0.9 * self._service_time + 0.1 * (time.monotonic() - admitted_at)
+            self._cond.notify()
+
+    def retry_after(self):
+        """Seconds until the current backlog has probably drained"""
+        slots = self.max_in_flight or 1
+        return max(1, math.ceil(self._service_time * (self._queued + self._in_flight) / slots))
+
+    def count_rejection(self, reason):
+        with self._cond:
+            self._rejected[reason] = self._rejected.get(reason, 0) + 1
+
+    def _reject(self, reason, message):
+        # Called with the condition held
+        self._rejected[reason] = self._rejected.get(reason, 0) + 1
+        return Rejected(reason, message, self.retry_after())
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_in_flight': self.max_in_flight,
+                'max_queued': self.max_queued,
+                'in_flight': self._in_flight,
+                'queued': self._queued,
+                'admitted': self._admitted,
+                'rejected': dict(self._rejected),
+                'avg_service_seconds': round(self._service_time, 3)
+            }
+
+
+class RateLimiter:
+    """Token bucket per client: `rate` requests per second with bursts of up to `burst`
+
+    Only the `max_clients` most recently seen clients are tracked; a client
+    that falls out simply starts again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()  # client -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, client, cost=1):
+        """Spend `cost` tokens, raising Rejected with the wait until they are available"""
+        now = time.monotonic()
+        cost = min(float(cost), self.burst)
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < cost:
+                self._buckets[client] = (tokens, now)
+                raise Rejected('rate_limited', "Rate limit exceeded. Please slow down.",
+                               max(1, math.ceil((cost - tokens) / self.rate)))
+            self._buckets[client] = (tokens - cost, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, 'clients': len(self._buckets)}
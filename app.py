@@ -3,75 +3,232 @@ Flask Backend API for Diabetic Retinopathy Detection
 Serves the PyTorch ResNet-152 model for retinal image classification
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, request, jsonify, send_from_directory, Response, stream_with_context, g
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import os
-import sys
 import torch
-from torch import nn
-import torchvision
-from torchvision import models
-from PIL import Image
-import numpy as np
 import base64
+import json
+import hashlib
+import math
+import hmac
+import time
+import uuid
+import zipfile
+import zlib
 from io import BytesIO
+from batching import BatchScheduler, DeadlineExceeded
+from admission import AdmissionController, RateLimiter, Rejected
+from model_reload import ModelReloader, ShadowScorer
+from cascade import Cascade, trained_input_size
+from prediction_cache import PredictionCache, image_key
+from embedding_index import EmbeddingIndex, image_descriptor, pixel_signature
+from tta import MAX_VIEWS as TTA_MAX_VIEWS, build_views, average_views
+from metrics import Registry, process_resident_memory_bytes, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from preprocessing import INPUT_SIZE, ImageRejected, ImageTooLarge, image_mime, encode_thumbnail
+from model_runtime import ModelRuntime, runtime, device, CLASSES, MODEL_PATH, PREPROCESS_MODE, load_image, preprocess
+
+class InMemoryRequest(Request):
+    """Request that buffers uploaded files in memory instead of spooling them to a temp file"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BytesIO()
 
 app = Flask(__name__, static_folder='frontend')
+app.request_class = InMemoryRequest
 CORS(app)
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
+SAVE_UPLOADS = os.environ.get('SAVE_UPLOADS', '0') == '1'  # keep a copy of each upload on disk
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-MODEL_PATH = 'Retinal_blindness_detection_Pytorch-master/classifier.pt'
+MODEL_WARMUP = os.environ.get('MODEL_WARMUP', '0') == '1'  # load at import instead of on the first request
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Create upload folder if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Micro-batching: concurrent requests share one forward pass
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 8))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', 5))
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 200))  # per /api/predict/batch request
+# An image inside a zip may be no larger than a direct upload. PNG/JPEG barely compress further,
+# so a far higher ratio means a zip bomb
+ZIP_MEMBER_MAX_BYTES = app.config['MAX_CONTENT_LENGTH']
+ZIP_MAX_RATIO = 100
+
+# Prediction cache: repeated images skip the forward pass
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', '1') == '1'
+CACHE_MAX_MB = float(os.environ.get('CACHE_MAX_MB', 64))
+CACHE_TTL_SECONDS = float(os.environ.get('CACHE_TTL_SECONDS', 24 * 3600))
+CACHE_DIR = os.environ.get('CACHE_DIR')  # optional on-disk tier that survives restarts
+CACHE_DISK_MAX_MB = float(os.environ.get('CACHE_DISK_MAX_MB', 1024))  # 0 = unbounded
+
+# Embedding index: near-duplicate uploads reuse stored backbone features (off unless a directory is set)
+EMBEDDING_INDEX_DIR = os.environ.get('EMBEDDING_INDEX_DIR')
+EMBEDDING_MATCH_THRESHOLD = float(os.environ.get('EMBEDDING_MATCH_THRESHOLD', 0.96))
+
+# Test-time augmentation: views averaged per image unless the request sets `tta`
+TTA_DEFAULT_VIEWS = int(os.environ.get('TTA_DEFAULT_VIEWS', 1))
+
+# Hot reload: new weights are loaded in the background, warmed up with these batch sizes and swapped in
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')  # /api/admin/* is disabled unless set
+MODEL_WATCH_SECONDS = float(os.environ.get('MODEL_WATCH_SECONDS', 0))  # poll MODEL_PATH for changes (0 = off)
+MODEL_WARMUP_BATCH_SIZES = [int(size) for size in os.environ.get('MODEL_WARMUP_BATCH_SIZES', f'1,{BATCH_MAX_SIZE}').split(',')]
+
+# Shadow scoring: a second checkpoint scores a sample of /api/predict requests in the background
+SHADOW_MODEL_PATH = os.environ.get('SHADOW_MODEL_PATH')
+SHADOW_SAMPLE_RATE = float(os.environ.get('SHADOW_SAMPLE_RATE', 1.0))
+
+# Cascade: a small triage model answers confident, non-severe images; only the rest reach the full model
+CASCADE_MODEL_PATH = os.environ.get('CASCADE_MODEL_PATH')  # e.g. a student from distill.py (unset = off)
+CASCADE_THRESHOLD = float(os.environ.get('CASCADE_THRESHOLD', 0.9))  # triage confidence needed to skip the full model
+CASCADE_MAX_CLASS = int(os.environ.get('CASCADE_MAX_CLASS', 0))  # most severe class triage may answer (0 = No DR)
+# Triage input resolution; defaults to the one the student was distilled at (224 unless distill.py --input-size)
+CASCADE_TRAINED_SIZE = trained_input_size(CASCADE_MODEL_PATH) if CASCADE_MODEL_PATH else INPUT_SIZE
+CASCADE_INPUT_SIZE = int(os.environ.get('CASCADE_INPUT_SIZE', CASCADE_TRAINED_SIZE))
+
+# Image echoed back in /api/predict responses: 'thumbnail', 'original' or 'none' (a request may override with `image`)
+IMAGE_ECHO = os.environ.get('IMAGE_ECHO', 'thumbnail')
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 256))  # longest side in pixels
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+ECHO_MODES = ('thumbnail', 'original', 'none')
+
+# Admission control: bounded in-flight and queued predictions per worker; excess requests get 429 + Retry-After.
+# Both must fit in the worker's request threads (keeping 2 free for health checks), or the excess waits in
+# gunicorn's own queue instead: gunicorn.conf.py sizes the threads from these limits unless GUNICORN_THREADS
+# is set, in which case the limits default to fitting it
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 0))
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT',
+                                             max(1, (GUNICORN_THREADS - 2) // 3) if GUNICORN_THREADS else 16))
+ADMISSION_MAX_QUEUED = int(os.environ.get('ADMISSION_MAX_QUEUED',
+                                          max(0, GUNICORN_THREADS - 2 - ADMISSION_MAX_IN_FLIGHT) if GUNICORN_THREADS else 32))
+# Header in which the front proxy stamps when it received the request (e.g. X-Request-Start), so deadlines
+# also count the time spent in gunicorn's queue; unset = count from when this worker picked the request up
+REQUEST_START_HEADER = os.environ.get('REQUEST_START_HEADER')
+# Deadline for /api/predict unless the client sends X-Request-Timeout-Ms; work past it never reaches the model
+REQUEST_DEADLINE_MS = float(os.environ.get('REQUEST_DEADLINE_MS', 30000))
+# Per-client token bucket (0 = off); set RATE_LIMIT_CLIENT_HEADER (e.g. X-Forwarded-For) behind a trusted proxy
+RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND', 0))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 10))
+RATE_LIMIT_CLIENT_HEADER = os.environ.get('RATE_LIMIT_CLIENT_HEADER')
+
+# Top-level fields a client can pick with `fields`; 'filename' and 'error' are always kept
+RESPONSE_FIELDS = ('severity_value', 'severity_class', 'confidence', 'probabilities', 'info',
+                   'model_version', 'cascade_stage', 'tta_views', 'near_duplicate', 'image_data')
+
+# Uploads are processed in memory; the folder is only needed when archiving them
+if SAVE_UPLOADS:
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Device configuration
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device: {device}")
 
-# Model setup
-model = models.resnet152(pretrained=False)
-num_ftrs = model.fc.in_features
-out_ftrs = 5
-model.fc = nn.Sequential(
-    nn.Linear(num_ftrs, 512),
-    nn.ReLU(),
-    nn.Linear(512, out_ftrs),
-    nn.LogSoftmax(dim=1)
-)
+# Load the weights now if asked to; otherwise they are loaded on the first prediction.
+# No forward pass runs here: under gunicorn --preload this executes in the master,
+# and each forked worker warms itself up in post_fork (see gunicorn.conf.py).
+if MODEL_WARMUP:
+    runtime.ensure_loaded()
 
-# Load model weights
-def load_model(path):
-    """Load the trained model from checkpoint"""
-    try:
-        checkpoint = torch.load(path, map_location=device, weights_only=False)
-        model.load_state_dict(checkpoint['model_state_dict'])
-        model.to(device)
-        model.eval()
-        print("Model loaded successfully!")
-        return True
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        return False
+# Cache keys include the checkpoint fingerprint so retrained weights never hit stale results
+MODEL_FINGERPRINT = runtime.fingerprint()
+prediction_cache = PredictionCache(
+    max_bytes=int(CACHE_MAX_MB * 1024 * 1024),
+    ttl_seconds=CACHE_TTL_SECONDS,
+    disk_dir=CACHE_DIR,
+    disk_max_bytes=int(CACHE_DISK_MAX_MB * 1024 * 1024)
+) if CACHE_ENABLED else None
+
+def open_embedding_index(fingerprint):
+    """Stored embeddings belong to one set of backbone weights, so each fingerprint gets its own store"""
+    if not EMBEDDING_INDEX_DIR or not runtime.supports_embeddings:
+        return None
+    return EmbeddingIndex(
+        os.path.join(EMBEDDING_INDEX_DIR, hashlib.blake2b(fingerprint.encode(), digest_size=8).hexdigest()),
+        threshold=EMBEDDING_MATCH_THRESHOLD
+    )
+
+embedding_index = open_embedding_index(MODEL_FINGERPRINT)
+
+def model_swapped():
+    """Point cache keys and the embedding store at the weights just swapped in"""
+    global MODEL_FINGERPRINT, embedding_index
+    MODEL_FINGERPRINT = runtime.fingerprint()
+    embedding_index = open_embedding_index(MODEL_FINGERPRINT)
+
+reloader = ModelReloader(runtime, MODEL_WARMUP_BATCH_SIZES, on_swap=model_swapped)
 
-# Classes for diabetic retinopathy severity
-CLASSES = ['No DR', 'Mild', 'Moderate', 'Severe', 'Proliferative DR']
+# The shadow model is loaded lazily by its scoring thread, with the same precision and backend
+shadow_runtime = ModelRuntime(
+    SHADOW_MODEL_PATH, quantize=runtime.quantize, backend=runtime.backend, profile=runtime.profile
+) if SHADOW_MODEL_PATH else None
+shadow_reloader = ModelReloader(shadow_runtime, name='shadow') if shadow_runtime else None
+shadow_scorer = ShadowScorer(shadow_runtime, SHADOW_SAMPLE_RATE) if shadow_runtime else None
 
-# Image transformations
-test_transforms = torchvision.transforms.Compose([
-    torchvision.transforms.Resize((224, 224)),
-    torchvision.transforms.ToTensor(),
-    torchvision.transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
-])
+# The triage model always runs eagerly: exported graphs are traced at the full input size
+cascade = Cascade(
+    ModelRuntime(CASCADE_MODEL_PATH, quantize=runtime.quantize, backend='eager', profile=runtime.profile),
+    CASCADE_THRESHOLD, CASCADE_MAX_CLASS, CASCADE_INPUT_SIZE
+) if CASCADE_MODEL_PATH else None
+if cascade and CASCADE_INPUT_SIZE != CASCADE_TRAINED_SIZE:
+    print(f"Warning: the triage model runs at CASCADE_INPUT_SIZE={CASCADE_INPUT_SIZE} but was distilled at "
+          f"{CASCADE_TRAINED_SIZE} px; re-distil with distill.py --input-size {CASCADE_INPUT_SIZE}")
+if MODEL_WARMUP and cascade:
+    cascade.runtime.ensure_loaded()
+# Cascaded predictions can differ from the full model's, so the cascade config is part of their cache keys;
+# turning the cascade off (or changing it) never serves a previous configuration's decisions
+CASCADE_VARIANT = cascade.variant if cascade else ''
+
+admission = AdmissionController(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUED)
+if GUNICORN_THREADS and ADMISSION_MAX_IN_FLIGHT and ADMISSION_MAX_IN_FLIGHT + ADMISSION_MAX_QUEUED > GUNICORN_THREADS - 2:
+    print(f"Warning: ADMISSION_MAX_IN_FLIGHT + ADMISSION_MAX_QUEUED ({ADMISSION_MAX_IN_FLIGHT + ADMISSION_MAX_QUEUED}) "
+          f"exceeds GUNICORN_THREADS - 2 ({GUNICORN_THREADS - 2}); excess requests will wait in gunicorn's queue "
+          f"instead of getting 429")
+rate_limiter = RateLimiter(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST) if RATE_LIMIT_PER_SECOND > 0 else None
+
+# Metrics served on /api/metrics; each gunicorn worker keeps its own
+metrics_registry = Registry()
+REQUEST_COUNT = metrics_registry.counter(
+    'dr_http_requests_total', 'HTTP requests handled', ('endpoint', 'method', 'status'))
+REQUEST_LATENCY = metrics_registry.histogram(
+    'dr_http_request_duration_seconds', 'End-to-end request latency', ('endpoint',))
+IN_FLIGHT = metrics_registry.gauge('dr_http_requests_in_flight', 'Requests currently being handled')
+STAGE_LATENCY = metrics_registry.histogram(
+    'dr_predict_stage_seconds', 'Time spent in each stage of a prediction', ('stage',))
+BATCH_FORWARD_LATENCY = metrics_registry.histogram(
+    'dr_batch_forward_seconds', 'Model forward pass per scheduled batch, excluding queueing')
+# Children bound once so the request path doesn't look them up
+STAGES = {name: STAGE_LATENCY.labels(stage=name)
+          for name in ('upload_read', 'decode', 'dedup', 'transform', 'triage', 'forward', 'head', 'image_echo', 'json')}
+
+def timed_forward(batch):
+    """Model forward pass returning (log-probabilities, backbone features), recorded on the batch forward histogram"""
+    with BATCH_FORWARD_LATENCY.time():
+        return runtime.forward_with_features(batch)
+
+# Shared scheduler that batches concurrent predictions
+inference_scheduler = BatchScheduler(
+    timed_forward,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS
+)
+# Triage passes are batched separately; they run on the reduced-resolution input
+triage_scheduler = BatchScheduler(
+    cascade.forward,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS
+) if cascade else None
 
-# Load model on startup
-model_loaded = load_model(MODEL_PATH)
+metrics_registry.gauge('dr_batch_queue_depth', 'Jobs waiting for the batch scheduler',
+                       callback=lambda: inference_scheduler.stats()['queued'])
+metrics_registry.gauge('dr_admission_in_flight', 'Predictions holding an admission slot',
+                       callback=lambda: admission.stats()['in_flight'])
+metrics_registry.gauge('dr_admission_queued', 'Predictions waiting for an admission slot',
+                       callback=lambda: admission.stats()['queued'])
+REJECTED = metrics_registry.counter(
+    'dr_admission_rejected_total', 'Requests turned away or dropped before inference', ('reason',))
+CASCADE_ROUTED = metrics_registry.counter(
+    'dr_cascade_predictions_total', 'Cascaded predictions by the model that decided them', ('stage',))
+metrics_registry.gauge('process_resident_memory_bytes', 'Resident memory of this worker process',
+                       callback=process_resident_memory_bytes)
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -118,35 +275,395 @@ def get_severity_info(severity_level):
     }
     return info.get(severity_level, info[0])
 
-def predict_image(image_path):
-    """Make prediction on the uploaded image"""
+def format_prediction(output, version=None):
+    """Build the response payload from one row of model log-probabilities (of the full model unless `version` says otherwise)"""
+    ps = torch.exp(output)
+    top_p, top_class = ps.topk(1)
+    
+    severity_value = top_class.item()
+    confidence = top_p.item() * 100
+    
+    # Get all class probabilities
+    probabilities = ps.numpy()
+    
+    return {
+        'severity_value': severity_value,
+        'severity_class': CLASSES[severity_value],
+        'confidence': round(confidence, 2),
+        'probabilities': {CLASSES[i]: round(float(prob) * 100, 2) for i, prob in enumerate(probabilities)},
+        'info': get_severity_info(severity_value),
+        'model_version': version or runtime.version
+    }
+
+def parse_tta_views():
+    """Number of TTA views requested via the `tta` form field or query parameter"""
+    value = request.form.get('tta', request.args.get('tta'))
+    views = TTA_DEFAULT_VIEWS if value in (None, '') else int(value)
+    if not 1 <= views <= TTA_MAX_VIEWS:
+        raise ValueError
+    return views
+
+def cache_variant(views):
+    """Cache key variant, so averaged and cascaded predictions are cached separately"""
+    return f'tta{views}' if views > 1 else CASCADE_VARIANT
+
+def cascade_forward(batch, deadline=None):
+    """Triage single-view inputs and send only the uncertain or severe rows on to the full model
+
+    Returns (log-probabilities, full-model features per row or None, escalated mask).
+    """
+    if cascade.runtime.ensure_loaded():
+        with STAGES['triage'].time():
+            outputs = triage_scheduler.submit(batch, deadline)
+        escalated = cascade.escalate(outputs)
+    else:
+        # A triage model that failed to load (see /api/health) sends everything to the full model
+        outputs, escalated = None, torch.ones(len(batch), dtype=torch.bool)
+    features = [None] * len(batch)
+    if escalated.any():
+        with STAGES['forward'].time():
+            full_outputs, full_features = inference_scheduler.submit(batch[escalated], deadline)
+        outputs = full_outputs.new_empty(len(batch), full_outputs.shape[1]) if outputs is None else outputs.clone()
+        outputs[escalated] = full_outputs
+        for row, index in enumerate(escalated.nonzero().flatten().tolist()):
+            features[index] = full_features[row]
+    CASCADE_ROUTED.labels('full').inc(int(escalated.sum()))
+    CASCADE_ROUTED.labels('triage').inc(len(batch) - int(escalated.sum()))
+    return outputs, features, escalated
+
+def cascade_result(output, escalated):
+    """Response fields for a cascaded prediction"""
+    if escalated:
+        return {**format_prediction(output), 'cascade_stage': 'full'}
+    return {**format_prediction(output, cascade.runtime.version), 'cascade_stage': 'triage'}
+
+def cache_value(output, result):
+    """What the cache stores: the log-probabilities, plus the stage and deciding model of a cascaded prediction"""
+    if 'cascade_stage' not in result:
+        return output.tolist()
+    return {'output': output.tolist(), 'cascade_stage': result['cascade_stage'], 'model_version': result['model_version']}
+
+def cached_prediction(cached):
+    """(log-probabilities, response fields) restored from a cache value"""
+    if isinstance(cached, dict):
+        output = torch.tensor(cached['output'])
+        return output, {**format_prediction(output, cached['model_version']), 'cascade_stage': cached['cascade_stage']}
+    output = torch.tensor(cached)
+    return output, format_prediction(output)
+
+def parse_fields():
+    """Response fields requested via the comma-separated `fields` form field or query parameter (None = all)"""
+    value = request.form.get('fields', request.args.get('fields'))
+    if not value:
+        return None
+    fields = {name.strip() for name in value.split(',') if name.strip()}
+    if not fields <= set(RESPONSE_FIELDS):
+        raise ValueError
+    return fields
+
+def select_fields(result, fields):
+    """Drop the fields a client didn't ask for"""
+    if fields is None:
+        return result
+    return {key: value for key, value in result.items() if key in fields or key in ('filename', 'error')}
+
+def image_echo(image, image_bytes, mode):
+    """Data URL echoing the upload: a small JPEG of the decoded image, the original bytes, or None"""
+    if mode == 'none':
+        return None
+    if mode == 'original':
+        return f"data:{image_mime(image_bytes)};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+    thumbnail = encode_thumbnail(image, THUMBNAIL_SIZE, THUMBNAIL_QUALITY)
+    return f"data:image/jpeg;base64,{base64.b64encode(thumbnail).decode('ascii')}"
+
+def client_id():
+    """Key for per-client rate limiting"""
+    if RATE_LIMIT_CLIENT_HEADER and request.headers.get(RATE_LIMIT_CLIENT_HEADER):
+        return request.headers[RATE_LIMIT_CLIENT_HEADER].split(',')[0].strip()
+    return request.remote_addr
+
+def request_received_at():
+    """time.monotonic() at which the request arrived, backdated by REQUEST_START_HEADER when configured
+
+    Accepts the usual proxy formats: seconds (nginx `t=${msec}`), milliseconds
+    (Heroku) or microseconds (Apache `t=%D`), optionally prefixed with `t=`.
+    """
+    now = time.monotonic()
+    value = request.headers.get(REQUEST_START_HEADER) if REQUEST_START_HEADER else None
+    if not value:
+        return now
     try:
-        # Load and transform image
-        image = Image.open(image_path).convert('RGB')
-        img_tensor = test_transforms(image).unsqueeze(0)
+        stamp = float(value.strip().removeprefix('t='))
+    except ValueError:
+        return now
+    if not math.isfinite(stamp):
+        return now
+    stamp /= 1e6 if stamp > 1e14 else 1e3 if stamp > 1e11 else 1
+    # Clock skew never moves the arrival into the future
+    return now - min(max(time.time() - stamp, 0.0), 3600.0)
+
+def request_deadline(default_ms=None):
+    """time.monotonic() deadline from the X-Request-Timeout-Ms header or `default_ms` (None = no deadline)"""
+    value = request.headers.get('X-Request-Timeout-Ms')
+    timeout_ms = float(value) if value else default_ms
+    if timeout_ms is not None and (not math.isfinite(timeout_ms) or timeout_ms <= 0):
+        raise ValueError
+    return g.received + timeout_ms / 1000.0 if timeout_ms else None
+
+def admit(deadline):
+    """Apply the client's rate limit, then take an admission slot (released when the response closes); raises Rejected"""
+    if rate_limiter is not None:
+        try:
+            rate_limiter.take(client_id())
+        except Rejected:
+            admission.count_rejection('rate_limited')
+            raise
+    request.environ['dr.admitted_at'] = admission.acquire(deadline)
+
+def rejected_response(e):
+    """429 with Retry-After when saturated or rate limited, 504 when the deadline passed in the queue"""
+    REJECTED.labels(e.reason).inc()
+    if e.reason == 'deadline':
+        return jsonify({'error': str(e)}), 504
+    return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+
+def find_duplicates(image, patient_id=None):
+    """Look an image up in the embedding index: (descriptor, signature, reusable row, near_duplicate info)
+
+    The coarse descriptor only flags near-duplicates; a stored embedding is
+    reused only for a row whose pixel signature matches almost exactly.
+    """
+    if embedding_index is None:
+        return None, None, None, None
+    with STAGES['dedup'].time():
+        descriptor = image_descriptor(image)
+        matches = embedding_index.search(descriptor)
+        signature = pixel_signature(image)
+        reuse = next((row for row, _ in matches if embedding_index.same_capture(row, signature)), None)
+    if not matches:
+        return descriptor, signature, None, None
+    best, similarity = matches[0]
+    return descriptor, signature, reuse, {
+        'image_id': best,
+        'similarity': round(similarity, 4),
+        'same_capture': reuse is not None,
+        'first_seen': min(embedding_index.entry(row)['created'] for row, _ in matches),
+        # Only known when the caller says whose image this is
+        'same_patient': None if patient_id is None else any(
+            embedding_index.entry(row)['patient_id'] == patient_id for row, _ in matches)
+    }
+
+def head_only_prediction(row):
+    """Answer a re-export of a stored capture from its embedding, running only the classifier head"""
+    with STAGES['head'].time():
+        features = torch.from_numpy(embedding_index.embedding(row)).unsqueeze(0)
+        return runtime.forward_head(features)[0]
+
+def record_embedding(descriptor, signature, reuse, duplicate, features, patient_id, cache_key):
+    """Store a new capture, or a known one submitted for a patient it wasn't stored under"""
+    if embedding_index is None or (reuse is not None and duplicate['same_patient'] is not False):
+        return
+    embedding = features.numpy() if features.numel() else embedding_index.embedding(reuse)
+    embedding_index.add(descriptor, embedding, patient_id, cache_key, signature)
+
+def predict_image(image_bytes, views=1, patient_id=None, deadline=None):
+    """Make prediction on the uploaded image bytes; returns (result, decoded image)"""
+    try:
+        # Decode and transform image straight from memory
+        with STAGES['decode'].time():
+            image = load_image(image_bytes)
+        descriptor, signature, reuse, duplicate = find_duplicates(image, patient_id)
+        dedup = {'near_duplicate': duplicate} if embedding_index is not None else {}
         
-        # Make prediction
-        with torch.no_grad():
-            output = model(img_tensor.to(device))
-            ps = torch.exp(output)
-            top_p, top_class = ps.topk(1, dim=1)
-            
-            severity_value = top_class.item()
-            confidence = top_p.item() * 100
-            
-            # Get all class probabilities
-            probabilities = ps[0].cpu().numpy()
+        # Serve repeated images from the cache
+        cache_key = image_key(image, MODEL_FINGERPRINT, cache_variant(views)) if prediction_cache else None
+        cached = prediction_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            output, result = cached_prediction(cached)
+            if shadow_scorer:
+                shadow_scorer.submit(image, views, output, runtime.version)
+            return {**result, **dedup}, image
+        
+        stage = {}
+        if reuse is not None and views == 1:
+            output = head_only_prediction(reuse)
+            features = output.new_empty(0)
+        elif cascade and views == 1:
+            with STAGES['transform'].time():
+                img_tensor = preprocess(image).unsqueeze(0)
+            outputs, features, escalated = cascade_forward(img_tensor, deadline)
+            output, features = outputs[0], features[0]
+            stage = cascade_result(output, escalated[0])
+        else:
+            # All TTA views go to the scheduler as one job, so they share a forward pass
+            with STAGES['transform'].time():
+                img_tensor = build_views(preprocess(image), views)
             
-        return {
-            'severity_value': severity_value,
-            'severity_class': CLASSES[severity_value],
-            'confidence': round(confidence, 2),
-            'probabilities': {CLASSES[i]: round(float(prob) * 100, 2) for i, prob in enumerate(probabilities)},
-            'info': get_severity_info(severity_value)
-        }
+            # Make prediction (batched with any concurrent requests); includes time queued for a batch
+            with STAGES['forward'].time():
+                outputs, features = inference_scheduler.submit(img_tensor, deadline)
+            # Row 0 is the untransformed view, so its features are the image's embedding
+            output, features = average_views(outputs), features[0]
+        result = {**format_prediction(output), **stage}
+        if cache_key:
+            prediction_cache.put(cache_key, cache_value(output, result))
+        # Images answered by the triage model have no full-model embedding to store
+        if descriptor is not None and features is not None:
+            record_embedding(descriptor, signature, reuse, duplicate, features, patient_id, cache_key)
+        if shadow_scorer:
+            shadow_scorer.submit(image, views, output, runtime.version)
+        return {**result, **dedup}, image
+    except (ImageRejected, DeadlineExceeded):
+        raise
     except Exception as e:
         raise Exception(f"Prediction error: {str(e)}")
 
+def iter_batch_uploads(files):
+    """Yield (filename, stream) pairs for uploaded images, expanding zip archives
+
+    The stream is None for a file that isn't an image, and an ImageRejected
+    for an archive member that is too large or can't be extracted.
+    """
+    for filename, data in files:
+        if filename.lower().endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(BytesIO(data))
+            except zipfile.BadZipFile:
+                yield filename, None
+                continue
+            for member in archive.infolist():
+                name = member.filename
+                if member.is_dir() or name.startswith('__MACOSX/') or not allowed_file(name):
+                    continue
+                if member.file_size > ZIP_MEMBER_MAX_BYTES or \
+                        member.file_size > ZIP_MAX_RATIO * max(member.compress_size, 1):
+                    yield name, ImageRejected(f"Archive member expands to {member.file_size} bytes "
+                                              f"from {member.compress_size}; not extracted")
+                    continue
+                try:
+                    # Bounded even if the header understates the size
+                    with archive.open(member) as member_file:
+                        data = member_file.read(ZIP_MEMBER_MAX_BYTES + 1)
+                except (zipfile.BadZipFile, zlib.error, NotImplementedError) as e:
+                    yield name, ImageRejected(f"Could not extract archive member: {e}")
+                    continue
+                if len(data) > ZIP_MEMBER_MAX_BYTES:
+                    yield name, ImageRejected(f"Archive member is larger than {ZIP_MEMBER_MAX_BYTES // 2**20} MB")
+                    continue
+                yield name, BytesIO(data)
+        else:
+            yield filename, (BytesIO(data) if allowed_file(filename) else None)
+
+def predict_batch_stream(files, views=1, patient_id=None, fields=None, deadline=None):
+    """Classify uploads in model-sized batches, yielding one NDJSON line per image"""
+    pending = []
+    
+    def line(result):
+        return json.dumps(select_fields(result, fields)) + '\n'
+    
+    def flush():
+        try:
+            batch = torch.cat([tensor for _, _, tensor, _ in pending])
+            if cascade and views == 1:
+                outputs, features, escalated = cascade_forward(batch, deadline)
+            else:
+                with STAGES['forward'].time():
+                    outputs, features = inference_scheduler.submit(batch, deadline)
+                escalated = None
+            lines = []
+            for index, (name, cache_key, _, lookup) in enumerate(pending):
+                output = average_views(outputs[index * views:(index + 1) * views])
+                result = cascade_result(output, escalated[index]) if escalated is not None else format_prediction(output)
+                if cache_key:
+                    prediction_cache.put(cache_key, cache_value(output, result))
+                if lookup[0] is not None and features[index * views] is not None:
+                    record_embedding(*lookup, features[index * views], patient_id, cache_key)
+                dedup = {'near_duplicate': lookup[3]} if embedding_index is not None else {}
+                lines.append(line({'filename': name, **result, **dedup}))
+        except Exception as e:
+            lines = [line({'filename': name, 'error': f"Prediction error: {str(e)}"}) for name, _, _, _ in pending]
+        pending.clear()
+        return lines
+    
+    for count, (name, stream) in enumerate(iter_batch_uploads(files), start=1):
+        if deadline is not None and time.monotonic() > deadline:
+            REJECTED.labels('deadline').inc()
+            for pending_name, _, _, _ in pending:
+                yield line({'filename': pending_name, 'error': 'Request deadline passed before inference'})
+            yield line({'error': 'Request deadline passed. The remaining images were not processed.'})
+            pending.clear()
+            break
+        if count > BATCH_MAX_FILES:
+            yield json.dumps({'error': f'Too many images. Only the first {BATCH_MAX_FILES} were processed.'}) + '\n'
+            break
+        if stream is None:
+            yield line({'filename': name, 'error': 'Invalid file type. Please upload PNG, JPG, JPEG or ZIP.'})
+            continue
+        if isinstance(stream, ImageRejected):
+            yield line({'filename': name, 'error': str(stream)})
+            continue
+        try:
+            with STAGES['decode'].time():
+                image = load_image(stream)
+            lookup = find_duplicates(image, patient_id)
+            dedup = {'near_duplicate': lookup[3]} if embedding_index is not None else {}
+            cache_key = image_key(image, MODEL_FINGERPRINT, cache_variant(views)) if prediction_cache else None
+            cached = prediction_cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                yield line({'filename': name, **cached_prediction(cached)[1], **dedup})
+                continue
+            if lookup[2] is not None and views == 1:
+                output = head_only_prediction(lookup[2])
+                if cache_key:
+                    prediction_cache.put(cache_key, output.tolist())
+                record_embedding(*lookup, output.new_empty(0), patient_id, cache_key)
+                yield line({'filename': name, **format_prediction(output), **dedup})
+                continue
+            with STAGES['transform'].time():
+                pending.append((name, cache_key, build_views(preprocess(image), views), lookup))
+        except ImageRejected as e:
+            yield line({'filename': name, 'error': str(e)})
+            continue
+        except Exception as e:
+            yield line({'filename': name, 'error': f"Prediction error: {str(e)}"})
+            continue
+        if len(pending) * views >= BATCH_MAX_SIZE:
+            yield from flush()
+    
+    if pending:
+        yield from flush()
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.received = request_received_at()
+    IN_FLIGHT.inc()
+    if MODEL_WATCH_SECONDS > 0:
+        reloader.watch(MODEL_WATCH_SECONDS)  # per worker process, started on its first request
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_COUNT.labels(endpoint, request.method, response.status_code).inc()
+    REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - g.request_start)
+    # Runs once the response, streamed or not, has been fully sent (teardown_request
+    # fires twice around a streamed body)
+    response.call_on_close(finish_request(request.environ.get('dr.admitted_at')))
+    if runtime.version:
+        response.headers['X-Model-Version'] = runtime.version
+    return response
+
+def finish_request(admitted_at):
+    """Close callback releasing the request's gauges and admission slot (once, however often close() is called)"""
+    pending = [True]
+    
+    def finish():
+        if pending and pending.pop():
+            IN_FLIGHT.dec()
+            if admitted_at is not None:
+                admission.release(admitted_at)
+    return finish
+
 @app.route('/')
 def index():
     """Serve the main frontend page"""
@@ -162,16 +679,40 @@ def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
-        'model_loaded': model_loaded,
-        'device': str(device)
+        'model_loaded': runtime.loaded,
+        'model_version': runtime.version,
+        'model_error': runtime.error,
+        'precision': runtime.quantize,
+        'backend': runtime.backend,
+        'inference_profile': runtime.profile.status(),
+        'preprocessing': PREPROCESS_MODE,
+        'device': str(device),
+        'batching': inference_scheduler.stats(),
+        'cache': prediction_cache.stats() if prediction_cache else {'enabled': False},
+        'embedding_index': embedding_index.stats() if embedding_index is not None else {'enabled': False},
+        'admission': admission.stats(),
+        'rate_limit': rate_limiter.stats() if rate_limiter else {'enabled': False},
+        'model_reload': reloader.status(),
+        'shadow': shadow_scorer.stats() if shadow_scorer else {'enabled': False},
+        'cascade': {**cascade.stats(), 'batching': triage_scheduler.stats()} if cascade else {'enabled': False}
     })
 
 @app.route('/api/predict', methods=['POST'])
 def predict():
     """Prediction endpoint"""
-    if not model_loaded:
+    if not runtime.ensure_loaded():
         return jsonify({'error': 'Model not loaded. Please check model path.'}), 500
     
+    # Turn the request away before its upload is parsed if the worker is saturated
+    try:
+        deadline = request_deadline(REQUEST_DEADLINE_MS)
+    except ValueError:
+        return jsonify({'error': 'X-Request-Timeout-Ms must be a positive number of milliseconds'}), 400
+    try:
+        admit(deadline)
+    except Rejected as e:
+        return rejected_response(e)
+    
     # Check if file is present
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
@@ -187,28 +728,132 @@ def predict():
         return jsonify({'error': 'Invalid file type. Please upload PNG, JPG, or JPEG.'}), 400
     
     try:
-        # Save file
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Make prediction
-        result = predict_image(filepath)
+        views = parse_tta_views()
+    except ValueError:
+        return jsonify({'error': f'tta must be a number of views between 1 and {TTA_MAX_VIEWS}'}), 400
+    try:
+        fields = parse_fields()
+    except ValueError:
+        return jsonify({'error': f"fields must be a comma-separated list of: {', '.join(RESPONSE_FIELDS)}"}), 400
+    echo = request.form.get('image', request.args.get('image')) or IMAGE_ECHO
+    if echo not in ECHO_MODES:
+        return jsonify({'error': f"image must be one of: {', '.join(ECHO_MODES)}"}), 400
+    if fields is not None and 'image_data' not in fields:
+        echo = 'none'
+    
+    try:
+        # Read the upload once; everything below works on this buffer
+        with STAGES['upload_read'].time():
+            image_bytes = file.read()
         
-        # Convert image to base64 for display
-        with open(filepath, 'rb') as img_file:
-            img_data = base64.b64encode(img_file.read()).decode('utf-8')
+        if SAVE_UPLOADS:
+            # Unique prefix so concurrent uploads with the same name don't collide
+            filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
+            with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as out_file:
+                out_file.write(image_bytes)
         
-        result['image_data'] = f"data:image/jpeg;base64,{img_data}"
+        # Make prediction
+        result, image = predict_image(image_bytes, views, request.form.get('patient_id') or None, deadline)
+        result['tta_views'] = views
         
-        # Clean up uploaded file
-        os.remove(filepath)
+        # Echo a thumbnail of the decoded image for display rather than the whole upload
+        if echo != 'none':
+            with STAGES['image_echo'].time():
+                result['image_data'] = image_echo(image, image_bytes, echo)
         
-        return jsonify(result)
+        with STAGES['json'].time():
+            return jsonify(select_fields(result, fields))
     
+    except DeadlineExceeded as e:
+        REJECTED.labels('deadline').inc()
+        return jsonify({'error': str(e)}), 504
+    except ImageTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except ImageRejected as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/predict/batch', methods=['POST'])
+def predict_batch():
+    """Batch prediction endpoint streaming one JSON line per image"""
+    if not runtime.ensure_loaded():
+        return jsonify({'error': 'Model not loaded. Please check model path.'}), 500
+    
+    # Batches have no default deadline; the slot is held until the stream finishes
+    try:
+        deadline = request_deadline()
+    except ValueError:
+        return jsonify({'error': 'X-Request-Timeout-Ms must be a positive number of milliseconds'}), 400
+    try:
+        admit(deadline)
+    except Rejected as e:
+        return rejected_response(e)
+    
+    # Accept any number of files (or zip archives) under 'files' or 'file'.
+    # Uploads are read up front because the request is torn down while streaming.
+    files = request.files.getlist('files') + request.files.getlist('file')
+    files = [(f.filename, f.read()) for f in files if f.filename != '']
+    if not files:
+        return jsonify({'error': 'No files provided'}), 400
+    try:
+        views = parse_tta_views()
+    except ValueError:
+        return jsonify({'error': f'tta must be a number of views between 1 and {TTA_MAX_VIEWS}'}), 400
+    try:
+        fields = parse_fields()
+    except ValueError:
+        return jsonify({'error': f"fields must be a comma-separated list of: {', '.join(RESPONSE_FIELDS)}"}), 400
+    
+    return Response(
+        stream_with_context(predict_batch_stream(files, views, request.form.get('patient_id') or None, fields, deadline)),
+        mimetype='application/x-ndjson'
+    )
+
+def admin_error():
+    """Response for a request to /api/admin/* that may not proceed, or None"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled. Set ADMIN_TOKEN to enable them.'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({'error': 'Invalid or missing X-Admin-Token'}), 401
+    return None
+
+@app.route('/api/admin/reload', methods=['POST'])
+def admin_reload():
+    """Load a checkpoint in the background, warm it up and swap it in (in the worker that receives this)"""
+    error = admin_error()
+    if error:
+        return error
+    body = request.get_json(silent=True) or request.form
+    target, path = body.get('target', 'active'), body.get('path') or None
+    if target not in ('active', 'shadow'):
+        return jsonify({'error': "target must be 'active' or 'shadow'"}), 400
+    if target == 'shadow' and shadow_reloader is None:
+        return jsonify({'error': 'No shadow model configured. Set SHADOW_MODEL_PATH.'}), 400
+    if path is not None and not os.path.isfile(path):
+        return jsonify({'error': f'Checkpoint not found: {path}'}), 400
+    target_reloader = reloader if target == 'active' else shadow_reloader
+    if not target_reloader.reload(path):
+        return jsonify({'error': 'A reload is already in progress'}), 409
+    return jsonify({'status': 'reloading', 'target': target, 'path': path or target_reloader.runtime.path,
+                    'current_version': target_reloader.runtime.version}), 202
+
+@app.route('/api/admin/models', methods=['GET'])
+def admin_models():
+    """Active and shadow model versions, reload history and shadow agreement"""
+    error = admin_error()
+    if error:
+        return error
+    return jsonify({
+        'active': {**reloader.status(), 'model': runtime.status()},
+        'shadow': {**shadow_reloader.status(), **shadow_scorer.stats()} if shadow_scorer else {'enabled': False}
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for this worker process"""
+    return Response(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route('/api/classes', methods=['GET'])
 def get_classes():
     """Get all severity classes"""
@@ -222,6 +867,7 @@ if __name__ == '__main__':
     print("Diabetic Retinopathy Detection System")
     print("=" * 60)
     print(f"Model Path: {MODEL_PATH}")
+    model_loaded = runtime.warm_up()
     print(f"Model Loaded: {model_loaded}")
     print(f"Device: {device}")
     print("=" * 60)
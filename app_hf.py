@@ -1,55 +1,21 @@
 import gradio as gr
 import torch
-from torch import nn
-import torchvision
-from torchvision import models
-from PIL import Image
-import numpy as np
+import os
+from prediction_cache import PredictionCache, image_key
+from preprocessing import ImageRejected
+from model_runtime import runtime, device, CLASSES, load_image
 
-# Device configuration
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device: {device}")
 
-# Model setup
-model = models.resnet152(pretrained=False)
-num_ftrs = model.fc.in_features
-out_ftrs = 5
-model.fc = nn.Sequential(
-    nn.Linear(num_ftrs, 512),
-    nn.ReLU(),
-    nn.Linear(512, out_ftrs),
-    nn.LogSoftmax(dim=1)
+# Cache results for repeated images (keyed on pixels + checkpoint fingerprint)
+MODEL_FINGERPRINT = runtime.fingerprint()
+prediction_cache = PredictionCache(
+    max_bytes=int(float(os.environ.get('CACHE_MAX_MB', 64)) * 1024 * 1024),
+    ttl_seconds=float(os.environ.get('CACHE_TTL_SECONDS', 24 * 3600)),
+    disk_dir=os.environ.get('CACHE_DIR'),
+    disk_max_bytes=int(float(os.environ.get('CACHE_DISK_MAX_MB', 1024)) * 1024 * 1024)
 )
 
-# Load model weights
-MODEL_PATH = 'Retinal_blindness_detection_Pytorch-master/classifier.pt'
-
-def load_model(path):
-    """Load the trained model from checkpoint"""
-    try:
-        checkpoint = torch.load(path, map_location=device, weights_only=False)
-        model.load_state_dict(checkpoint['model_state_dict'])
-        model.to(device)
-        model.eval()
-        print("✅ Model loaded successfully!")
-        return True
-    except Exception as e:
-        print(f"❌ Error loading model: {e}")
-        return False
-
-# Load model on startup
-model_loaded = load_model(MODEL_PATH)
-
-# Classes for diabetic retinopathy severity
-CLASSES = ['No DR', 'Mild', 'Moderate', 'Severe', 'Proliferative DR']
-
-# Image transformations
-test_transforms = torchvision.transforms.Compose([
-    torchvision.transforms.Resize((224, 224)),
-    torchvision.transforms.ToTensor(),
-    torchvision.transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
-])
-
 def get_severity_info(severity_level):
     """Get detailed information about each severity level"""
     info = {
@@ -86,18 +52,32 @@ def get_severity_info(severity_level):
     }
     return info.get(severity_level, info[0])
 
-def predict_image(image):
-    """Make prediction on the uploaded image"""
-    if not model_loaded:
+def predict_image(path):
+    """Make prediction on the uploaded image file"""
+    if not runtime.ensure_loaded():
         return "❌ Model not loaded. Please check the model file.", None, None
     
+    if path is None:
+        return "⚠️ Please upload an image first.", None, None
+    
+    # The upload arrives as a file, so its header is checked before any pixels are decoded
+    try:
+        image = load_image(path)
+    except ImageRejected as e:
+        return f"❌ {e}", None, None
+    
     try:
-        # Transform image
-        img_tensor = test_transforms(image).unsqueeze(0)
+        # Serve repeated images from the cache, otherwise run the model
+        cache_key = image_key(image, MODEL_FINGERPRINT)
+        cached = prediction_cache.get(cache_key)
+        if cached is not None:
+            output = torch.tensor([cached])
+        else:
+            output = runtime.predict(image).unsqueeze(0)
+            prediction_cache.put(cache_key, output[0].tolist())
         
-        # Make prediction
+        # Convert log-probabilities to class probabilities
         with torch.no_grad():
-            output = model(img_tensor.to(device))
             ps = torch.exp(output)
             top_p, top_class = ps.topk(1, dim=1)
             
@@ -149,7 +129,7 @@ with gr.Blocks(title="Diabetic Retinopathy Detection", theme=gr.themes.Soft()) a
     
     with gr.Row():
         with gr.Column():
-            input_image = gr.Image(type="pil", label="Upload Retinal Image")
+            input_image = gr.File(type="filepath", file_types=[".png", ".jpg", ".jpeg"], label="Upload Retinal Image")
             analyze_btn = gr.Button("🔍 Analyze Image", variant="primary", size="lg")
             
             gr.Markdown("""
@@ -192,4 +172,6 @@ with gr.Blocks(title="Diabetic Retinopathy Detection", theme=gr.themes.Soft()) a
 
 # Launch the app
 if __name__ == "__main__":
+    # Load the weights before serving so the first user doesn't pay for it
+    runtime.warm_up()
     demo.launch()
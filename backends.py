@@ -0,0 +1,136 @@
+"""
+Pluggable inference backends for the ResNet-152 classifier
+Eager PyTorch, TorchScript and ONNX Runtime (CPU) behind one callable interface
+
+Run as a script to export classifier.pt to TorchScript and ONNX and check
+both against eager outputs:
+    python backends.py --model Retinal_blindness_detection_Pytorch-master/classifier.pt
+"""
+
+import argparse
+import inspect
+import os
+
+import numpy as np
+import torch
+
+BACKENDS = ('eager', 'torchscript', 'onnxruntime')
+
+
+def artifact_paths(model_path):
+    """TorchScript and ONNX artifact paths that sit next to a checkpoint"""
+    stem = os.path.splitext(model_path)[0]
+    return {
+        'torchscript': os.environ.get('TORCHSCRIPT_PATH', f"{stem}.torchscript.pt"),
+        'onnxruntime': os.environ.get('ONNX_PATH', f"{stem}.onnx")
+    }
+
+
+class OnnxRuntimeModel:
+    """Wrap an ONNX Runtime session so it can be called like the torch model"""
+
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("The onnxruntime backend requires `pip install onnxruntime`")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        inputs = np.ascontiguousarray(batch.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: inputs})[0])
+
+    def eval(self):
+        return self
+
+
+def load_backend(name, model_path, device):
+    """Load the exported artifact for `name`; eager models are built by the runtime itself"""
+    paths = artifact_paths(model_path)
+    if name == 'torchscript':
+        model = torch.jit.load(paths['torchscript'], map_location=device)
+        model.eval()
+        return torch.jit.optimize_for_inference(model) if device.type == 'cpu' else model
+    if name == 'onnxruntime':
+        if device.type != 'cpu':
+            print("The onnxruntime backend runs on the CPU execution provider")
+        return OnnxRuntimeModel(paths['onnxruntime'], torch.get_num_threads())
+    raise ValueError(f"Unknown inference backend '{name}'. Choose one of: {', '.join(BACKENDS)}")
+
+
+def export_torchscript(model, path, example):
+    """Trace the eager model into a frozen TorchScript module"""
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return path
+
+
+def export_onnx(model, path, example, opset=17):
+    """Export the eager model to ONNX with a dynamic batch dimension"""
+    # Keep the TorchScript-based exporter; the dynamo exporter needs onnxscript
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            model, (example,), path,
+            input_names=['input'],
+            output_names=['log_probs'],
+            dynamic_axes={'input': {0: 'batch'}, 'log_probs': {0: 'batch'}},
+            opset_version=opset,
+            **kwargs
+        )
+    return path
+
+
+def max_abs_diff(reference, candidate, batch):
+    """Largest absolute difference between two models' log-probabilities on `batch`"""
+    with torch.no_grad():
+        return (reference(batch).cpu() - candidate(batch).cpu()).abs().max().item()
+
+
+def main():
+    from model_runtime import MODEL_PATH, load_checkpoint_model
+    from quantization import load_calibration_batches, CALIBRATION_DIR
+
+    parser = argparse.ArgumentParser(description="Export the classifier to TorchScript and ONNX")
+    parser.add_argument('--model', default=MODEL_PATH, help="Checkpoint with a 'model_state_dict'")
+    parser.add_argument('--images', default=CALIBRATION_DIR, help="Images used to compare exported outputs with eager")
+    parser.add_argument('--atol', type=float, default=1e-3, help="Maximum allowed absolute difference in log-probabilities")
+    parser.add_argument('--opset', type=int, default=17)
+    args = parser.parse_args()
+
+    model, _ = load_checkpoint_model(args.model)
+    model.requires_grad_(False)
+    model.eval()
+
+    paths = artifact_paths(args.model)
+    example = torch.zeros(1, 3, 224, 224)
+    batches = load_calibration_batches(args.images, limit=16)
+    batch = batches[0] if batches else torch.randn(4, 3, 224, 224)
+
+    failed = False
+    export_torchscript(model, paths['torchscript'], example)
+    diff = max_abs_diff(model, load_backend('torchscript', args.model, torch.device('cpu')), batch)
+    failed |= diff > args.atol
+    print(f"TorchScript -> {paths['torchscript']} (max |diff| {diff:.2e}) {'OK' if diff <= args.atol else 'FAILED'}")
+
+    export_onnx(model, paths['onnxruntime'], example, args.opset)
+    try:
+        diff = max_abs_diff(model, load_backend('onnxruntime', args.model, torch.device('cpu')), batch)
+        failed |= diff > args.atol
+        print(f"ONNX        -> {paths['onnxruntime']} (max |diff| {diff:.2e}) {'OK' if diff <= args.atol else 'FAILED'}")
+    except RuntimeError as e:
+        print(f"ONNX        -> {paths['onnxruntime']} (not verified: {e})")
+
+    if failed:
+        raise SystemExit(f"Exported outputs differ from eager by more than {args.atol}")
+
+
+if __name__ == '__main__':
+    main()
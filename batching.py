@@ -0,0 +1,151 @@
+"""
+Dynamic micro-batching for model inference
+Gathers concurrent prediction requests into a single batched forward pass
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+import torch
+
+
+class DeadlineExceeded(Exception):
+    """A job's deadline passed before it reached the model"""
+
+
+class _Job:
+    """A pending inference request waiting for its slice of a batch"""
+    __slots__ = ('inputs', 'deadline', 'done', 'output', 'error')
+
+    def __init__(self, inputs, deadline=None):
+        self.inputs = inputs
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class BatchScheduler:
+    """Collect concurrent requests and run them through the model together
+
+    Callers submit an input tensor of shape (N, C, H, W) and block until
+    the rows belonging to them come back. `model_fn` may return a tuple of
+    tensors, in which case each caller gets a tuple of row slices. A background worker waits for
+    the first job, keeps collecting jobs until either `max_batch_size`
+    rows are queued or `max_wait_ms` has passed, runs one forward pass
+    and hands every caller its own slice of the output. A job may carry a
+    deadline (a time.monotonic() value): once it passes, the job is dropped
+    from the queue and its caller gets DeadlineExceeded instead of a result.
+    """
+
+    def __init__(self, model_fn, max_batch_size=8, max_wait_ms=5.0):
+        self.model_fn = model_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._worker = None
+        self._worker_pid = None
+        self._batches = 0
+        self._rows = 0
+        self._expired = 0
+
+    def submit(self, inputs, deadline=None):
+        """Queue `inputs` for the next batch and wait for its output rows"""
+        job = _Job(inputs, deadline)
+        with self._cond:
+            self._ensure_worker()
+            self._queue.append(job)
+            self._cond.notify()
+        if deadline is not None and not job.done.wait(max(0.0, deadline - time.monotonic())):
+            with self._cond:
+                if job in self._queue:
+                    # Still waiting for a batch: drop it so the model never sees it
+                    self._queue.remove(job)
+                    self._expired += 1
+                    raise DeadlineExceeded("Request deadline passed before inference started")
+        job.done.wait()  # already in a running batch
+        if job.error is not None:
+            raise job.error
+        return job.output
+
+    def stats(self):
+        """Return counters describing how well requests are being batched"""
+        with self._cond:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'queued': len(self._queue),
+                'expired': self._expired,
+                'batches': self._batches,
+                'rows': self._rows,
+                'avg_batch_size': round(self._rows / self._batches, 2) if self._batches else 0.0
+            }
+
+    def _ensure_worker(self):
+        # Threads do not survive fork(), so a forked server worker starts its own
+        if self._worker is None or not self._worker.is_alive() or self._worker_pid != os.getpid():
+            self._worker = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def _drop_expired(self):
+        """Fail queued jobs whose deadline has passed (called with the condition held)"""
+        now = time.monotonic()
+        for job in [job for job in self._queue if job.deadline is not None and job.deadline <= now]:
+            self._queue.remove(job)
+            self._expired += 1
+            job.error = DeadlineExceeded("Request deadline passed before inference started")
+            job.done.set()
+
+    def _collect(self):
+        """Block for the first job, then gather more until the batch is full or the wait expires"""
+        with self._cond:
+            while True:
+                self._drop_expired()
+                if self._queue:
+                    break
+                self._cond.wait()
+            jobs = [self._queue.popleft()]
+            rows = jobs[0].inputs.shape[0]
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                self._drop_expired()
+                if not self._queue:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        break
+                    continue
+                if rows + self._queue[0].inputs.shape[0] > self.max_batch_size:
+                    break
+                job = self._queue.popleft()
+                jobs.append(job)
+                rows += job.inputs.shape[0]
+            return jobs, rows
+
+    def _run(self):
+        while True:
+            jobs, rows = self._collect()
+            try:
+                batch = jobs[0].inputs if len(jobs) == 1 else torch.cat([job.inputs for job in jobs])
+                with torch.no_grad():
+                    output = self.model_fn(batch)
+                start = 0
+                for job in jobs:
+                    end = start + job.inputs.shape[0]
+                    if isinstance(output, tuple):
+                        job.output = tuple(o[start:end].cpu() for o in output)
+                    else:
+                        job.output = output[start:end].cpu()
+                    start = end
+            except Exception as e:
+                for job in jobs:
+                    job.error = e
+            finally:
+                with self._cond:
+                    self._batches += 1
+                    self._rows += rows
+                for job in jobs:
+                    job.done.set()
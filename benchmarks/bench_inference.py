@@ -0,0 +1,245 @@
+"""
+Inference benchmark suite for Diabetic Retinopathy Detection
+Times decode, transform, forward, thumbnail encoding and JSON serialisation on the bundled sample images
+
+    python benchmarks/bench_inference.py --output results.json
+    python benchmarks/bench_inference.py --baseline baseline.json --tolerance 0.15
+
+A baseline recorded with different weights, runtime settings or on another
+machine is refused unless --allow-env-mismatch is given.
+
+Uses the shared model runtime, so QUANTIZE, INFERENCE_BACKEND, FAST_PREPROCESS
+and the CPU tuning variables apply here exactly as they do in the server.
+If classifier.pt can't be loaded (the repo only holds a Git LFS pointer)
+randomly initialised weights are used; timings are unaffected.
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from model_runtime import runtime, build_model, load_image, preprocess, CLASSES, PREPROCESS_MODE  # noqa: E402
+from preprocessing import encode_thumbnail  # noqa: E402
+
+SAMPLE_DIR = os.path.join(BASE_DIR, 'Retinal_blindness_detection_Pytorch-master', 'sampleimages')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Runtime status fields that differ between runs of the same setup
+VOLATILE_RUNTIME_FIELDS = ('model_loaded', 'model_path', 'checkpoint_path', 'load_seconds')
+
+
+def percentiles(samples):
+    """p50/p95/p99/mean of a list of durations, in milliseconds"""
+    values = np.array(samples) * 1000.0
+    return {
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'mean_ms': round(float(values.mean()), 3),
+        'samples': len(samples)
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is KB on Linux, bytes on macOS), None on Windows"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def timed(fn, repeat):
+    """Run fn() `repeat` times and return (durations, last result)"""
+    durations, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return durations, result
+
+
+def thumbnail_data_url(image):
+    return f"data:image/jpeg;base64,{base64.b64encode(encode_thumbnail(image)).decode('ascii')}"
+
+
+def response_payload(output, image_data):
+    """Same shape as the default /api/predict response, including the thumbnail echo"""
+    ps = torch.exp(output)
+    value = int(ps.argmax())
+    return {
+        'severity_value': value,
+        'severity_class': CLASSES[value],
+        'confidence': round(float(ps[value]) * 100, 2),
+        'probabilities': {CLASSES[i]: round(float(p) * 100, 2) for i, p in enumerate(ps.tolist())},
+        'image_data': image_data
+    }
+
+
+def bench_stages(samples, repeat):
+    """Per-image decode, transform, thumbnail and JSON serialisation latencies across all samples"""
+    decode, transform, thumbnail, serialise = [], [], [], []
+    for image_bytes in samples:
+        durations, image = timed(lambda: load_image(image_bytes), repeat)
+        decode += durations
+        durations, tensor = timed(lambda: preprocess(image), repeat)
+        transform += durations
+        durations, image_data = timed(lambda: thumbnail_data_url(image), repeat)
+        thumbnail += durations
+        output = runtime.forward(tensor.unsqueeze(0))[0]
+        durations, _ = timed(lambda: json.dumps(response_payload(output, image_data)), repeat)
+        serialise += durations
+    return {'decode': percentiles(decode), 'transform': percentiles(transform),
+            'thumbnail': percentiles(thumbnail), 'json': percentiles(serialise)}
+
+
+def bench_forward(tensors, batch_sizes, thread_counts, repeat):
+    """Forward-pass latency and throughput for every batch size / thread count pair"""
+    results = {}
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for batch_size in batch_sizes:
+            batch = torch.stack([tensors[i % len(tensors)] for i in range(batch_size)])
+            runtime.forward(batch)  # warm-up: allocator, oneDNN primitive creation
+            durations, _ = timed(lambda: runtime.forward(batch), repeat)
+            stats = percentiles(durations)
+            stats['images_per_sec'] = round(batch_size / (stats['mean_ms'] / 1000.0), 2)
+            results[f'threads={threads},batch={batch_size}'] = stats
+            print(f"  threads={threads:<3} batch={batch_size:<4} p50 {stats['p50_ms']:9.1f} ms  "
+                  f"p95 {stats['p95_ms']:9.1f} ms  {stats['images_per_sec']:8.1f} img/s")
+    return results
+
+
+def environment_differences(current, baseline):
+    """Setup fields that differ between two results; their timings are not comparable"""
+    def flatten(environment):
+        fields = {k: v for k, v in environment.items() if k != 'runtime'}
+        fields.update((f'runtime.{k}', v) for k, v in environment.get('runtime', {}).items()
+                      if k not in VOLATILE_RUNTIME_FIELDS)
+        return fields
+
+    ours, theirs = flatten(current.get('environment', {})), flatten(baseline.get('environment', {}))
+    return [f"{key}: {theirs.get(key)!r} -> {ours.get(key)!r}"
+            for key in sorted(set(ours) | set(theirs)) if ours.get(key) != theirs.get(key)]
+
+
+def compare(current, baseline, tolerance):
+    """Return descriptions of every metric more than `tolerance` worse than baseline
+
+    Latencies and peak RSS regress when they grow, throughput when it drops.
+    """
+    regressions = []
+
+    def check(label, now, before, higher_is_worse=True):
+        if not before or now is None:
+            return
+        change = now / before - 1
+        if (change if higher_is_worse else -change) > tolerance:
+            regressions.append(f"{label}: {before:.2f} -> {now:.2f} ({100 * change:+.0f}%)")
+
+    for section in ('stages', 'forward'):
+        for name, stats in current[section].items():
+            base = baseline.get(section, {}).get(name)
+            if not base:
+                continue
+            for metric in ('p50_ms', 'p95_ms'):
+                check(f"{section}/{name} {metric}", stats[metric], base[metric])
+            if 'images_per_sec' in stats:
+                check(f"{section}/{name} images_per_sec", stats['images_per_sec'], base.get('images_per_sec'),
+                      higher_is_worse=False)
+    check('peak_rss_mb', current['peak_rss_mb'], baseline.get('peak_rss_mb'))
+    return regressions
+
+
+def main():
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    parser = argparse.ArgumentParser(description="Benchmark the inference pipeline stage by stage")
+    parser.add_argument('--images', default=SAMPLE_DIR)
+    parser.add_argument('--batch-sizes', default='1,4,8,16', help="Comma-separated forward batch sizes")
+    parser.add_argument('--threads', default=','.join(str(t) for t in sorted({1, max(1, cores // 2), cores})),
+                        help="Comma-separated torch thread counts")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed repetitions per measurement")
+    parser.add_argument('--output', help="Write results JSON here")
+    parser.add_argument('--baseline', help="Compare against this results JSON and fail on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="Allowed slowdown, throughput drop or RSS growth vs baseline (0.15 = 15%%)")
+    parser.add_argument('--allow-env-mismatch', action='store_true',
+                        help="Compare against a baseline recorded with a different setup (only warns)")
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(args.images, n) for n in os.listdir(args.images) if n.lower().endswith(IMAGE_EXTENSIONS))
+    samples = [open(path, 'rb').read() for path in paths]
+
+    weights = 'checkpoint'
+    if not runtime.ensure_loaded():
+        print(f"Checkpoint unavailable ({runtime.error}); benchmarking randomly initialised weights")
+        runtime.adopt(build_model())
+        weights = 'random'
+
+    print(f"Stages over {len(samples)} images x {args.repeat} repeats")
+    stages = bench_stages(samples, args.repeat)
+    for name, stats in stages.items():
+        print(f"  {name:10} p50 {stats['p50_ms']:9.2f} ms  p95 {stats['p95_ms']:9.2f} ms  p99 {stats['p99_ms']:9.2f} ms")
+
+    print("Forward pass sweep")
+    tensors = [preprocess(load_image(b)) for b in samples]
+    forward = bench_forward(
+        tensors,
+        [int(b) for b in args.batch_sizes.split(',')],
+        [int(t) for t in args.threads.split(',')],
+        args.repeat
+    )
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'machine': platform.machine(),
+            'cores': cores,
+            'weights': weights,
+            'runtime': {k: v for k, v in runtime.status().items() if k != 'error'},
+            'preprocessing': PREPROCESS_MODE
+        },
+        'stages': stages,
+        'forward': forward,
+        'peak_rss_mb': peak_rss_mb()
+    }
+    if results['peak_rss_mb'] is not None:
+        print(f"Peak RSS: {results['peak_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differences = environment_differences(results, baseline)
+        if differences:
+            print(f"{args.baseline} was recorded with a different setup:")
+            for line in differences:
+                print(f"  {line}")
+            if not args.allow_env_mismatch:
+                sys.exit("Refusing to compare; re-record the baseline or pass --allow-env-mismatch")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Performance regressions (> {args.tolerance:.0%} worse than baseline):")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
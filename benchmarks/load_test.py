@@ -0,0 +1,468 @@
+"""
+End-to-end load test for the Flask API
+Starts app.py (Flask or gunicorn) locally and replays the sample images against /api/predict
+
+    python benchmarks/load_test.py --server gunicorn --concurrency 8 --duration 60 --output runs/closed-c8.json
+    python benchmarks/load_test.py --server gunicorn --rate 4 --env WEB_CONCURRENCY=2 --output runs/open-r4.json
+    python benchmarks/load_test.py --url http://localhost:5000 --concurrency 4       # an already-running server
+    python benchmarks/load_test.py --compare runs/*.json
+
+Closed loop (--concurrency): N clients each send their next request as soon
+as the previous one returns, so the load adapts to the server. Open loop
+(--rate): requests arrive on a Poisson schedule whatever the server does,
+and latency is measured from the scheduled arrival, so queueing shows up
+instead of being hidden by slower clients (coordinated omission).
+
+Only the standard library and numpy are used on the client side, so the
+generator itself doesn't load torch or compete with the server for memory.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_DIR = os.path.join(BASE_DIR, 'Retinal_blindness_detection_Pytorch-master', 'sampleimages')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+BOUNDARY = 'dr-load-test-boundary'
+
+# Repeated images would otherwise be answered from the prediction cache
+DEFAULT_SERVER_ENV = {'CACHE_ENABLED': '0', 'MODEL_WARMUP': '1'}
+
+
+def multipart_body(filename, data, fields):
+    """multipart/form-data body with one `file` part plus plain form fields"""
+    parts = [f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+             for name, value in fields.items()]
+    content_type = 'image/png' if filename.lower().endswith('.png') else 'image/jpeg'
+    parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b'\r\n')
+    return b''.join(parts) + f'--{BOUNDARY}--\r\n'.encode()
+
+
+def load_bodies(folder, fields):
+    paths = sorted(os.path.join(folder, n) for n in os.listdir(folder) if n.lower().endswith(IMAGE_EXTENSIONS))
+    if not paths:
+        raise SystemExit(f"No images in {folder}")
+    bodies = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            bodies.append(multipart_body(os.path.basename(path), f.read(), fields))
+    return bodies
+
+
+def send(host, port, body, timeout):
+    """POST one upload on a fresh connection; returns (status, bytes received), status 0 on connection errors"""
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('POST', '/api/predict', body, {
+            'Content-Type': f'multipart/form-data; boundary={BOUNDARY}',
+            'Connection': 'close'
+        })
+        response = connection.getresponse()
+        return response.status, len(response.read())
+    except (OSError, http.client.HTTPException):
+        return 0, 0
+    finally:
+        connection.close()
+
+
+def get_json(host, port, path, timeout=5):
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return json.loads(response.read()) if response.status == 200 else None
+    except (OSError, http.client.HTTPException, ValueError):
+        return None
+    finally:
+        connection.close()
+
+
+class Recorder:
+    """Thread-safe log of (finished at, latency, status, response bytes) for every request"""
+
+    def __init__(self):
+        self.results = []
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def add(self, finished, latency, status, size):
+        with self._lock:
+            self.results.append((finished, latency, status, size))
+
+    def skip(self):
+        with self._lock:
+            self.skipped += 1
+
+
+# Server process
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(kind, port, env_overrides, log_path):
+    """Start app.py under Flask's threaded server or gunicorn in its own process group"""
+    env = {**os.environ, **DEFAULT_SERVER_ENV, **env_overrides, 'PORT': str(port)}
+    if kind == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', 'app:app', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}']
+    else:
+        command = [sys.executable, 'app.py']
+    log = open(log_path, 'wb')
+    return subprocess.Popen(command, cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def wait_until_ready(host, port, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        if get_json(host, port, '/api/health', timeout=2) is not None:
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def process_tree(pid):
+    """`pid` and all its descendants (Linux /proc)"""
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def memory_kb(pid):
+    """(RSS, PSS) of one process in KB; PSS splits shared pages (e.g. preloaded weights) between the workers"""
+    rss = pss = 0
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Rss:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('Pss:'):
+                    pss = int(line.split()[1])
+    except OSError:
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                rss = pss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except (OSError, ValueError, IndexError):
+            pass
+    return rss, pss
+
+
+def sample_memory(pid, start, interval, samples, stop):
+    """Append {t, rss_mb, pss_mb, processes} for the server's process tree every `interval` seconds"""
+    while not stop.is_set():
+        pids = process_tree(pid)
+        usage = [memory_kb(p) for p in pids]
+        samples.append({
+            't': round(time.monotonic() - start, 2),
+            'rss_mb': round(sum(rss for rss, _ in usage) / 1024, 1),
+            'pss_mb': round(sum(pss for _, pss in usage) / 1024, 1),
+            'processes': len(pids)
+        })
+        stop.wait(interval)
+
+
+# Load generation
+
+def closed_loop(host, port, bodies, concurrency, duration, think, timeout, recorder):
+    end = time.monotonic() + duration
+
+    def client(index):
+        i = index
+        while time.monotonic() < end:
+            start = time.monotonic()
+            status, size = send(host, port, bodies[i % len(bodies)], timeout)
+            finished = time.monotonic()
+            recorder.add(finished, finished - start, status, size)
+            i += concurrency
+            if think:
+                time.sleep(think)
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def open_loop(host, port, bodies, rate, duration, arrivals, max_outstanding, timeout, seed, recorder):
+    generator = random.Random(seed)
+    outstanding = threading.Semaphore(max_outstanding)
+
+    def fire(scheduled, body):
+        try:
+            status, size = send(host, port, body, timeout)
+            finished = time.monotonic()
+            recorder.add(finished, finished - scheduled, status, size)
+        finally:
+            outstanding.release()
+
+    with ThreadPoolExecutor(max_outstanding) as pool:
+        start = time.monotonic()
+        scheduled, i = start, 0
+        while True:
+            scheduled += generator.expovariate(rate) if arrivals == 'poisson' else 1.0 / rate
+            if scheduled - start >= duration:
+                break
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not outstanding.acquire(blocking=False):
+                # The client itself is saturated; count it rather than silently slowing the arrival rate
+                recorder.skip()
+                continue
+            pool.submit(fire, scheduled, bodies[i % len(bodies)])
+            i += 1
+
+
+def latency_stats(latencies):
+    if not latencies:
+        return None
+    values = np.array(latencies) * 1000.0
+    return {
+        'p50_ms': round(float(np.percentile(values, 50)), 1),
+        'p90_ms': round(float(np.percentile(values, 90)), 1),
+        'p95_ms': round(float(np.percentile(values, 95)), 1),
+        'p99_ms': round(float(np.percentile(values, 99)), 1),
+        'max_ms': round(float(values.max()), 1),
+        'mean_ms': round(float(values.mean()), 1),
+        'samples': len(latencies)
+    }
+
+
+def summarize(recorder, start, duration, memory):
+    results = sorted(recorder.results)
+    total = len(results)
+    statuses = {}
+    for _, _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [latency for _, latency, status, _ in results if 200 <= status < 300]
+    errors = sum(count for status, count in statuses.items() if status != '429' and not status.startswith('2'))
+    timeline = []
+    for second in range(int(np.ceil(duration))):
+        window = [r for r in results if second <= r[0] - start < second + 1]
+        timeline.append({
+            't': second,
+            'completed': len(window),
+            'ok': sum(200 <= status < 300 for _, _, status, _ in window),
+            'rejected': sum(status == 429 for _, _, status, _ in window),
+            'errors': sum(status != 429 and not 200 <= status < 300 for _, _, status, _ in window),
+            'p50_ms': round(float(np.percentile([r[1] for r in window], 50)) * 1000, 1) if window else None
+        })
+    rss = [sample['rss_mb'] for sample in memory]
+    pss = [sample['pss_mb'] for sample in memory]
+    return {
+        'requests': total,
+        'throughput_rps': round(total / duration, 2),
+        'ok_rps': round(len(ok) / duration, 2),
+        'latency_ok': latency_stats(ok),
+        'latency_all': latency_stats([latency for _, latency, _, _ in results]),
+        'status_counts': statuses,
+        'error_rate': round(errors / total, 4) if total else 0.0,
+        'rejected_429_rate': round(statuses.get('429', 0) / total, 4) if total else 0.0,
+        'client_skipped': recorder.skipped,
+        'mean_response_bytes': round(float(np.mean([size for _, _, _, size in results])), 0) if total else 0,
+        'server_memory': {
+            'start_rss_mb': rss[0] if rss else None,
+            'peak_rss_mb': max(rss) if rss else None,
+            'end_rss_mb': rss[-1] if rss else None,
+            'peak_pss_mb': max(pss) if pss else None
+        },
+        'timeline': timeline,
+        'memory_samples': memory
+    }
+
+
+def print_summary(run):
+    summary, config = run['summary'], run['config']
+    load = f"concurrency {config['concurrency']}" if config['mode'] == 'closed' else f"{config['rate']} req/s ({config['arrivals']})"
+    print(f"{config['mode']}-loop, {load}, {config['duration']}s against {config['server']}")
+    print(f"  {summary['requests']} requests: {summary['throughput_rps']} req/s, {summary['ok_rps']} ok/s")
+    for name in ('latency_ok', 'latency_all'):
+        stats = summary[name]
+        if stats:
+            print(f"  {name:12} p50 {stats['p50_ms']:8.1f}  p90 {stats['p90_ms']:8.1f}  p95 {stats['p95_ms']:8.1f}  "
+                  f"p99 {stats['p99_ms']:8.1f}  max {stats['max_ms']:8.1f} ms")
+    print(f"  status {summary['status_counts']}  errors {100 * summary['error_rate']:.1f}%  "
+          f"429 {100 * summary['rejected_429_rate']:.1f}%" +
+          (f"  client-skipped {summary['client_skipped']}" if summary['client_skipped'] else ''))
+    memory = summary['server_memory']
+    if memory['peak_rss_mb'] is not None:
+        print(f"  server RSS start {memory['start_rss_mb']} MB, peak {memory['peak_rss_mb']} MB, "
+              f"end {memory['end_rss_mb']} MB (peak PSS {memory['peak_pss_mb']} MB)")
+
+
+def compare(paths):
+    """One line per saved run, for comparing configurations"""
+    print(f"{'run':28}{'mode':>8}{'load':>10}{'req/s':>8}{'ok/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'err%':>7}{'429%':>7}{'peak RSS':>10}")
+    for path in paths:
+        with open(path) as f:
+            run = json.load(f)
+        config, summary = run['config'], run['summary']
+        latency = summary['latency_ok'] or {'p50_ms': float('nan'), 'p95_ms': float('nan'), 'p99_ms': float('nan')}
+        load = f"c{config['concurrency']}" if config['mode'] == 'closed' else f"{config['rate']}/s"
+        peak = summary['server_memory']['peak_rss_mb']
+        print(f"{(config.get('label') or os.path.basename(path))[:27]:28}{config['mode']:>8}{load:>10}"
+              f"{summary['throughput_rps']:>8.2f}{summary['ok_rps']:>8.2f}{latency['p50_ms']:>9.1f}"
+              f"{latency['p95_ms']:>9.1f}{latency['p99_ms']:>9.1f}{100 * summary['error_rate']:>7.1f}"
+              f"{100 * summary['rejected_429_rate']:>7.1f}{(f'{peak:.0f} MB' if peak else '-'):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test /api/predict end to end")
+    parser.add_argument('--server', choices=['gunicorn', 'flask'], default='gunicorn',
+                        help="How to start app.py locally (ignored with --url)")
+    parser.add_argument('--url', help="Test an already-running server instead of starting one")
+    parser.add_argument('--pid', type=int, help="With --url: server process id to sample memory from")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="Server environment, e.g. WEB_CONCURRENCY=2 (CACHE_ENABLED=0 and MODEL_WARMUP=1 by default)")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument('--concurrency', type=int, help="Closed loop: clients each with one request in flight")
+    load.add_argument('--rate', type=float, help="Open loop: arrival rate in requests per second")
+    parser.add_argument('--arrivals', choices=['poisson', 'uniform'], default='poisson', help="Open-loop arrival process")
+    parser.add_argument('--max-outstanding', type=int, default=256, help="Open loop: client-side cap on requests in flight")
+    parser.add_argument('--think-ms', type=float, default=0, help="Closed loop: pause between a response and the next request")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds of measured load")
+    parser.add_argument('--warmup', type=int, default=5, help="Unmeasured requests sent first")
+    parser.add_argument('--images', default=SAMPLE_DIR)
+    parser.add_argument('--form', action='append', default=[], metavar='KEY=VALUE',
+                        help="Extra form fields sent with every upload, e.g. tta=4 or image=none")
+    parser.add_argument('--timeout', type=float, default=60, help="Client timeout per request (seconds)")
+    parser.add_argument('--sample-interval', type=float, default=0.5, help="Seconds between server memory samples")
+    parser.add_argument('--startup-timeout', type=float, default=180)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', help="Name for this run in --compare tables")
+    parser.add_argument('--output', help="Save the run (config, summary, timeline, memory samples) as JSON")
+    parser.add_argument('--compare', nargs='+', metavar='RUN', help="Print saved runs side by side and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+        return
+    mode = 'open' if args.rate else 'closed'
+    concurrency = args.concurrency or (None if args.rate else 4)
+    env = dict(item.split('=', 1) for item in args.env)
+    fields = dict(item.split('=', 1) for item in args.form)
+    bodies = load_bodies(args.images, fields)
+
+    process, log_path = None, None
+    if args.url:
+        target = urlsplit(args.url)
+        host, port = target.hostname, target.port or 80
+    else:
+        host, port = '127.0.0.1', free_port()
+        log_path = os.path.join(tempfile.gettempdir(), f'dr-load-test-{port}.log')
+        print(f"Starting {args.server} on port {port} (log: {log_path})")
+        process = start_server(args.server, port, env, log_path)
+
+    try:
+        started = time.monotonic()
+        if not wait_until_ready(host, port, process, args.startup_timeout):
+            if log_path:
+                with open(log_path, errors='replace') as f:
+                    print(f.read()[-3000:])
+            raise SystemExit(f"Server at {host}:{port} did not become ready")
+        print(f"Server ready after {time.monotonic() - started:.1f}s")
+        for i in range(args.warmup):
+            send(host, port, bodies[i % len(bodies)], args.timeout)
+        health_before = get_json(host, port, '/api/health')
+
+        memory, stop = [], threading.Event()
+        server_pid = process.pid if process else args.pid
+        recorder = Recorder()
+        start = time.monotonic()
+        sampler = None
+        if server_pid and os.path.exists(f'/proc/{server_pid}'):
+            sampler = threading.Thread(target=sample_memory,
+                                       args=(server_pid, start, args.sample_interval, memory, stop), daemon=True)
+            sampler.start()
+        if mode == 'closed':
+            print(f"Closed loop: {concurrency} clients for {args.duration}s")
+            closed_loop(host, port, bodies, concurrency, args.duration, args.think_ms / 1000, args.timeout, recorder)
+        else:
+            print(f"Open loop: {args.rate} req/s ({args.arrivals}) for {args.duration}s")
+            open_loop(host, port, bodies, args.rate, args.duration, args.arrivals, args.max_outstanding,
+                      args.timeout, args.seed, recorder)
+        # Requests still in flight at the deadline are waited for, so the run may last slightly longer
+        elapsed = max(args.duration, time.monotonic() - start)
+        stop.set()
+        if sampler:
+            sampler.join()
+        health_after = get_json(host, port, '/api/health')
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    run = {
+        'config': {
+            'label': args.label,
+            'mode': mode,
+            'concurrency': concurrency,
+            'rate': args.rate,
+            'arrivals': args.arrivals if mode == 'open' else None,
+            'think_ms': args.think_ms,
+            'duration': round(elapsed, 2),
+            'server': args.url or args.server,
+            'server_env': {**DEFAULT_SERVER_ENV, **env} if not args.url else env,
+            'form': fields,
+            'images': len(bodies),
+            'warmup': args.warmup
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cores': len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'summary': summarize(recorder, start, elapsed, memory),
+        'health_before': health_before,
+        'health_after': health_after
+    }
+    print_summary(run)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Run saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
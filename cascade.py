@@ -0,0 +1,223 @@
+"""
+Two-stage cascade: a small triage model first, ResNet-152 only when it is unsure
+Most screening images are confidently 'No DR', so they never pay for the full forward pass
+
+Run as a script to sweep confidence thresholds on a folder of images:
+    python cascade.py --triage student_resnet18.pt --images /data/fundus_val --labels /data/val.csv
+"""
+
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from model_runtime import CLASSES, MODEL_PATH, read_checkpoint
+from prediction_cache import model_fingerprint
+from preprocessing import INPUT_SIZE
+
+
+def shrink(batch, size):
+    """Downscale preprocessed (N, 3, H, W) inputs to `size`; distill.py trains triage students through this too"""
+    if batch.shape[-1] == size and batch.shape[-2] == size:
+        return batch
+    return F.interpolate(batch, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+
+
+def trained_input_size(path, default=INPUT_SIZE):
+    """Resolution a student was distilled at (distill.py --input-size); older students were trained at 224"""
+    try:
+        return int(read_checkpoint(path).get('input_size', default))
+    except Exception:
+        return default
+
+
+class Cascade:
+    """Decide which images the triage model may answer on its own
+
+    The triage model sees the usual preprocessed input downscaled to
+    `input_size`. Its prediction is final when its confidence is at least
+    `threshold` and its class is no more severe than `max_class` (0 = No
+    DR); every other image is escalated to the full model.
+    """
+
+    def __init__(self, runtime, threshold=0.9, max_class=0, input_size=INPUT_SIZE):
+        self.runtime = runtime
+        self.threshold = threshold
+        self.max_class = max_class
+        self.input_size = input_size
+        self._lock = threading.Lock()
+        self._triaged = 0
+        self._escalated = 0
+
+    @property
+    def variant(self):
+        """Cache key variant: cascaded results depend on the triage weights and settings
+
+        Built from the checkpoint file rather than the loaded model, so it is the
+        same before and after the triage model loads and in every worker.
+        """
+        return (f"cascade:{model_fingerprint(self.runtime.path)}:{self.runtime.quantize}:{self.runtime.profile.bf16}:"
+                f"{self.threshold}:{self.max_class}:{self.input_size}")
+
+    def shrink(self, batch):
+        """Downscale preprocessed (N, 3, H, W) inputs to the triage resolution"""
+        return shrink(batch, self.input_size)
+
+    def forward(self, batch):
+        """Triage log-probabilities for full-resolution preprocessed inputs"""
+        return self.runtime.forward(self.shrink(batch))
+
+    def escalate(self, outputs):
+        """Boolean mask of the rows the full model has to decide"""
+        confidence, predicted = torch.exp(outputs).max(dim=1)
+        mask = (confidence < self.threshold) | (predicted > self.max_class)
+        with self._lock:
+            self._escalated += int(mask.sum())
+            self._triaged += len(mask) - int(mask.sum())
+        return mask
+
+    def warm_up(self, batch_sizes=(1,)):
+        if not self.runtime.ensure_loaded():
+            return False
+        for batch_size in ([batch_sizes] if isinstance(batch_sizes, int) else batch_sizes):
+            self.runtime.forward(torch.zeros(batch_size, 3, self.input_size, self.input_size))
+        return True
+
+    def stats(self):
+        with self._lock:
+            total = self._triaged + self._escalated
+            return {
+                'enabled': True,
+                'version': self.runtime.version,
+                'model_loaded': self.runtime.loaded,
+                'model_error': self.runtime.error,
+                'threshold': self.threshold,
+                'max_class': self.max_class,
+                'input_size': self.input_size,
+                'answered_by_triage': self._triaged,
+                'escalated': self._escalated,
+                'escalation_rate': round(self._escalated / total, 4) if total else None
+            }
+
+
+def sweep(triage_outputs, full_outputs, thresholds, max_class, triage_seconds, full_seconds, labels=None):
+    """Escalation rate, agreement with the full model and expected speedup for each threshold
+
+    Costs are per-image forward times; the cascade pays for triage on every
+    image plus the full model on the escalated ones.
+    """
+    triage_confidence, triage_class = torch.exp(triage_outputs).max(dim=1)
+    full_class = full_outputs.argmax(dim=1)
+    labels = None if labels is None else torch.as_tensor(labels)
+    labelled = None if labels is None else labels >= 0
+    rows = []
+    for threshold in thresholds:
+        escalated = (triage_confidence < threshold) | (triage_class > max_class)
+        predicted = torch.where(escalated, full_class, triage_class)
+        rate = escalated.float().mean().item()
+        row = {
+            'threshold': round(float(threshold), 4),
+            'escalation_rate': rate,
+            'agreement': (predicted == full_class).float().mean().item(),
+            # Images the full model calls more severe than max_class but the triage model answered
+            'missed_referrals': int(((full_class > max_class) & ~escalated).sum()),
+            'speedup': full_seconds / (triage_seconds + rate * full_seconds)
+        }
+        if labelled is not None and labelled.any():
+            row['accuracy'] = (predicted[labelled] == labels[labelled]).float().mean().item()
+        rows.append(row)
+    return rows
+
+
+def run_models(triage, full, cascade, batches):
+    """Log-probabilities of both models over all batches, and each model's forward seconds per image"""
+    triage_outputs, full_outputs = [], []
+    triage_seconds = full_seconds = 0.0
+    with torch.no_grad():
+        triage.forward(cascade.shrink(batches[0][:1]))  # warm-up
+        full.forward(batches[0][:1])
+        for batch in batches:
+            start = time.perf_counter()
+            triage_outputs.append(triage.forward(cascade.shrink(batch)))
+            triage_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            full_outputs.append(full.forward(batch))
+            full_seconds += time.perf_counter() - start
+    images = sum(len(batch) for batch in batches)
+    return torch.cat(triage_outputs), torch.cat(full_outputs), triage_seconds / images, full_seconds / images
+
+
+def main():
+    from dataset_shards import scan_images, read_labels, label_for
+    from model_runtime import ModelRuntime, load_image, preprocess
+
+    parser = argparse.ArgumentParser(description="Sweep cascade thresholds: speedup vs agreement with the full model")
+    parser.add_argument('--triage', required=True, help="Triage checkpoint, e.g. a student from distill.py")
+    parser.add_argument('--model', default=MODEL_PATH, help="Full model checkpoint")
+    parser.add_argument('--images', required=True, help="Folder scanned recursively for images")
+    parser.add_argument('--labels', help="CSV of labels (as in dataset_shards.py); otherwise folders named 0-4 or after a class")
+    parser.add_argument('--input-size', type=int, default=None,
+                        help="Triage input resolution (default: the one the student was distilled at)")
+    parser.add_argument('--max-class', type=int, default=0, help="Most severe class the triage model may answer")
+    parser.add_argument('--thresholds', default='0.5,0.6,0.7,0.8,0.85,0.9,0.95,0.97,0.99')
+    parser.add_argument('--min-agreement', type=float, default=0.99,
+                        help="Recommend the fastest threshold with at least this agreement")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--report-json', help="Also write the sweep to this file")
+    args = parser.parse_args()
+
+    paths = scan_images(args.images)
+    if not paths:
+        raise SystemExit(f"No images in {args.images}")
+    label_map = read_labels(args.labels) if args.labels else None
+    labels = [label_for(path, label_map) for path in paths]
+    tensors = [preprocess(load_image(path)) for path in paths]
+    batches = [torch.stack(tensors[i:i + args.batch_size]) for i in range(0, len(tensors), args.batch_size)]
+
+    args.input_size = args.input_size or trained_input_size(args.triage)
+    full = ModelRuntime(args.model)
+    triage = ModelRuntime(args.triage, profile=full.profile)
+    if not full.ensure_loaded() or not triage.ensure_loaded():
+        raise SystemExit(f"Could not load models: {full.error or triage.error}")
+    cascade = Cascade(triage, max_class=args.max_class, input_size=args.input_size)
+    triage_outputs, full_outputs, triage_seconds, full_seconds = run_models(triage, full, cascade, batches)
+
+    thresholds = [float(t) for t in args.thresholds.split(',')]
+    rows = sweep(triage_outputs, full_outputs, thresholds, args.max_class, triage_seconds, full_seconds, labels)
+    has_labels = any(label >= 0 for label in labels)
+
+    print(f"{len(paths)} images ({sum(label >= 0 for label in labels)} labelled); triage {triage.arch} at "
+          f"{args.input_size}px {triage_seconds * 1000:.1f} ms/image, full {full.arch} {full_seconds * 1000:.1f} ms/image; "
+          f"triage answers up to '{CLASSES[args.max_class]}'")
+    header = f"{'threshold':>10}{'escalated':>11}{'agreement':>11}{'missed':>8}{'speedup':>9}"
+    print(header + (f"{'accuracy':>10}" if has_labels else ''))
+    for row in rows:
+        line = (f"{row['threshold']:>10.2f}{100 * row['escalation_rate']:>10.1f}%{100 * row['agreement']:>10.1f}%"
+                f"{row['missed_referrals']:>8}{row['speedup']:>8.2f}x")
+        print(line + (f"{100 * row['accuracy']:>9.1f}%" if 'accuracy' in row else ''))
+    if has_labels:
+        full_class = full_outputs.argmax(dim=1).numpy()
+        known = np.array(labels) >= 0
+        print(f"Full model accuracy: {100 * (full_class[known] == np.array(labels)[known]).mean():.1f}%")
+
+    eligible = [row for row in rows if row['agreement'] >= args.min_agreement]
+    if eligible:
+        best = max(eligible, key=lambda row: row['speedup'])
+        print(f"Fastest with >= {100 * args.min_agreement:.1f}% agreement: CASCADE_THRESHOLD={best['threshold']} "
+              f"({best['speedup']:.2f}x, {100 * best['escalation_rate']:.1f}% escalated)")
+    else:
+        print(f"No threshold reaches {100 * args.min_agreement:.1f}% agreement; the triage model needs more distillation")
+
+    if args.report_json:
+        with open(args.report_json, 'w') as f:
+            json.dump({'images': len(paths), 'triage': args.triage, 'model': args.model, 'input_size': args.input_size,
+                       'max_class': args.max_class, 'triage_ms': triage_seconds * 1000,
+                       'full_ms': full_seconds * 1000, 'sweep': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Preprocessed dataset shards
+Decode, resize (and optionally border-crop) a fundus image directory once into memory-mapped uint8 shards
+
+    python dataset_shards.py /data/fundus /data/fundus_shards --labels /data/train.csv
+
+Each shard is a raw (N, 224, 224, 3) uint8 array; index.json records the shard
+sizes and, for every image, its shard, row, source path and label. ShardDataset
+maps the shards and hands out rows without decoding or copying, and
+normalize_batch() turns a collated uint8 batch into model input.
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+from model_runtime import CLASSES, FAST_PREPROCESS, PREPROCESS_CROP_BORDER
+from preprocessing import INPUT_SIZE, MEAN, STD, FastPreprocessor, decode_image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+INDEX_FILE = 'index.json'
+# The server only crops the border in the fast pipeline with PREPROCESS_CROP_BORDER=1
+SERVING_CROP = FAST_PREPROCESS and PREPROCESS_CROP_BORDER
+_framing_warned = set()
+
+
+def scan_images(root):
+    """Recursively list image files in a stable order"""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.lower().endswith(IMAGE_EXTENSIONS))
+    return paths
+
+
+def read_labels(path, id_column='id_code', label_column='diagnosis'):
+    """Map image file stems to integer labels from a CSV (Kaggle APTOS column names by default)"""
+    with open(path, newline='') as f:
+        return {os.path.splitext(os.path.basename(row[id_column]))[0]: int(row[label_column]) for row in csv.DictReader(f)}
+
+
+def label_for(path, labels):
+    """Label from the CSV, else from a parent folder named 0-4 or after a class, else -1"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if labels is not None and stem in labels:
+        return labels[stem]
+    folder = os.path.basename(os.path.dirname(path))
+    if folder.isdigit() and int(folder) < len(CLASSES):
+        return int(folder)
+    return CLASSES.index(folder) if folder in CLASSES else -1
+
+
+_preprocessor = None
+
+
+def _init_worker(size, crop):
+    global _preprocessor
+    torch.set_num_threads(1)
+    _preprocessor = FastPreprocessor(size, crop=crop)
+
+
+def _load_pixels(path):
+    try:
+        image = _preprocessor.resize(decode_image(path, _preprocessor.size))
+        return path, np.asarray(image, dtype=np.uint8), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def build_shards(paths, output, labels=None, size=INPUT_SIZE, crop=SERVING_CROP, shard_size=4096, workers=None):
+    """Preprocess `paths` into uint8 shards under `output` and write the index
+
+    `crop` defaults to whatever the server does, so shards are framed like /api/predict input.
+    """
+    os.makedirs(output, exist_ok=True)
+    shards, records, errors = [], [], []
+    shard, row = None, 0
+
+    def close_shard():
+        # The last shard is trimmed to the rows actually written
+        nonlocal shard
+        shard.flush()
+        shard = None  # unmap before truncating
+        nbytes = row * size * size * 3
+        with open(os.path.join(output, shards[-1]['file']), 'r+b') as f:
+            f.truncate(nbytes)
+        shards[-1]['count'] = row
+
+    start = time.perf_counter()
+    with Pool(workers or os.cpu_count() or 1, initializer=_init_worker, initargs=(size, crop)) as pool:
+        for path, pixels, error in pool.imap(_load_pixels, paths, chunksize=16):
+            if error is not None:
+                errors.append({'path': path, 'error': error})
+                continue
+            if shard is not None and row == shard_size:
+                close_shard()
+            if shard is None:
+                name = f'shard-{len(shards):05d}.u8'
+                shard = np.memmap(os.path.join(output, name), np.uint8, 'w+', shape=(shard_size, size, size, 3))
+                shards.append({'file': name, 'count': 0})
+                row = 0
+            shard[row] = pixels
+            records.append({'shard': len(shards) - 1, 'row': row, 'path': path, 'label': label_for(path, labels)})
+            row += 1
+            if len(records) % 500 == 0:
+                print(f"\r{len(records)}/{len(paths)} images ({len(records) / (time.perf_counter() - start):.1f} img/s)",
+                      end='', flush=True)
+    if shard is not None:
+        close_shard()
+    print()
+
+    index = {
+        'size': size,
+        'crop': crop,
+        'mean': MEAN,
+        'std': STD,
+        'shards': shards,
+        'records': records,
+        'errors': errors
+    }
+    with open(os.path.join(output, INDEX_FILE + '.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(output, INDEX_FILE + '.tmp'), os.path.join(output, INDEX_FILE))
+    return index
+
+
+def normalize_batch(batch, mean=MEAN, std=STD):
+    """(N, 3, H, W) uint8 batch to the normalised float32 model input"""
+    mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1) * 255.0
+    std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1) * 255.0
+    return (batch.float() - mean) / std
+
+
+class ShardDataset(torch.utils.data.Dataset):
+    """Rows of a shard directory as (uint8 (3, H, W) tensor, label, path)
+
+    Shards are mapped copy-on-write, so a row is a view of the page cache;
+    nothing is decoded or copied until the DataLoader collates a batch.
+    Maps are opened lazily so the dataset pickles cheaply into worker processes.
+    """
+
+    def __init__(self, directory, transform=None):
+        self.directory = directory
+        self.transform = transform
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.records = self.index['records']
+        self.size = self.index['size']
+        self._shards = None
+        self.check_framing()
+
+    def check_framing(self):
+        """Warn (once per directory) when the shards are cropped differently from what the server sees"""
+        crop = self.index.get('crop', True)  # shards built before the default changed were cropped
+        if crop != SERVING_CROP and self.directory not in _framing_warned:
+            _framing_warned.add(self.directory)
+            print(f"Warning: {self.directory} was built {'with' if crop else 'without'} border cropping, but the "
+                  f"server runs {'with' if SERVING_CROP else 'without'} it (FAST_PREPROCESS/PREPROCESS_CROP_BORDER); "
+                  f"models trained or scored on it see different framing than /api/predict")
+        return crop == SERVING_CROP
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def _open(self):
+        self._shards = [
+            np.memmap(os.path.join(self.directory, shard['file']), np.uint8, 'c',
+                      shape=(shard['count'], self.size, self.size, 3)) if shard['count'] else None
+            for shard in self.index['shards']
+        ]
+
+    def __getitem__(self, index):
+        if self._shards is None:
+            self._open()
+        record = self.records[index]
+        image = torch.from_numpy(self._shards[record['shard']][record['row']]).permute(2, 0, 1)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, record['label'], record['path']
+
+    @property
+    def labels(self):
+        return [record['label'] for record in self.records]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocess an image directory into memory-mapped uint8 shards")
+    parser.add_argument('images', help="Directory scanned recursively for images")
+    parser.add_argument('output', help="Shard directory to create")
+    parser.add_argument('--labels', help="CSV with image ids and labels (Kaggle APTOS format by default)")
+    parser.add_argument('--id-column', default='id_code')
+    parser.add_argument('--label-column', default='diagnosis')
+    parser.add_argument('--size', type=int, default=INPUT_SIZE)
+    parser.add_argument('--crop', action='store_true', default=SERVING_CROP,
+                        help="Crop the black border around the fundus (default: only if the server does)")
+    parser.add_argument('--no-crop', dest='crop', action='store_false', help="Keep the black border around the fundus")
+    parser.add_argument('--shard-size', type=int, default=4096, help="Images per shard file")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    labels = read_labels(args.labels, args.id_column, args.label_column) if args.labels else None
+    paths = scan_images(args.images)
+    print(f"Preprocessing {len(paths)} images into {args.output}")
+    index = build_shards(paths, args.output, labels, args.size, args.crop, args.shard_size, args.workers)
+    total = sum(shard['count'] for shard in index['shards'])
+    labelled = sum(record['label'] >= 0 for record in index['records'])
+    print(f"{total} images in {len(index['shards'])} shard(s), {labelled} labelled, {len(index['errors'])} failed")
+    for error in index['errors'][:10]:
+        print(f"  {error['path']}: {error['error']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Backbone embedding store and near-duplicate image index
+Memory-mapped pooled backbone features keyed by a cheap perceptual descriptor
+
+Re-exports and re-compressions of the same capture have near-identical
+descriptors. The descriptor is too coarse to see lesions, though, so a stored
+backbone embedding is only reused (and just the classifier head run) when a
+128x128 pixel signature also matches the stored one almost exactly.
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, one server process only
+    fcntl = None
+
+DESCRIPTOR_SIZE = 32
+DESCRIPTOR_DIM = DESCRIPTOR_SIZE * DESCRIPTOR_SIZE
+SIGNATURE_SIZE = 128
+SIGNATURE_DIM = SIGNATURE_SIZE * SIGNATURE_SIZE
+
+
+def image_descriptor(image, size=DESCRIPTOR_SIZE):
+    """Unit-length high-pass greyscale thumbnail of a PIL image
+
+    Subtracting a coarser blur removes the bright-disc-on-black layout every
+    fundus photo shares, leaving the vessel pattern that tells captures apart.
+    Resizing and JPEG re-compression barely change it.
+    """
+    grey = image.convert('L').resize((size, size), Image.BOX)
+    low = grey.resize((size // 4, size // 4), Image.BOX).resize((size, size), Image.BILINEAR)
+    detail = np.asarray(grey, dtype=np.float32) - np.asarray(low, dtype=np.float32)
+    detail = detail.ravel() - detail.mean()
+    return detail / (np.linalg.norm(detail) + 1e-6)
+
+
+def pixel_signature(image, size=SIGNATURE_SIZE):
+    """uint8 greyscale thumbnail of a PIL image, compared pixel by pixel to confirm a reuse
+
+    Re-compression and resizing move no pixel by more than about 10 levels;
+    even one haemorrhage-sized spot moves some by 60 or more.
+    """
+    return np.asarray(image.convert('L').resize((size, size), Image.BOX), dtype=np.uint8).ravel()
+
+
+class EmbeddingIndex:
+    """Append-only store of (descriptor, embedding, metadata) rows with vectorised cosine search
+
+    Descriptors and embeddings are float16 memory-mapped arrays that grow by
+    doubling, next to a uint8 array of pixel signatures; metadata is one JSON
+    line per row. Appends take an exclusive file lock, and every process picks
+    up rows written by the others, so gunicorn workers can share one directory.
+    The embedding width (2048 for ResNet-152, less for distilled students) is
+    taken from the first row stored when it isn't given.
+    """
+
+    def __init__(self, directory, threshold=0.96, descriptor_dim=DESCRIPTOR_DIM, embedding_dim=None,
+                 search_chunk=65536, signature_dim=SIGNATURE_DIM, pixel_tolerance=16):
+        self.directory = directory
+        self.threshold = threshold
+        self.descriptor_dim = descriptor_dim
+        self.signature_dim = signature_dim
+        self.pixel_tolerance = pixel_tolerance
+        self.embedding_dim = embedding_dim
+        self.search_chunk = search_chunk
+        os.makedirs(directory, exist_ok=True)
+        self._descriptor_path = os.path.join(directory, 'descriptors.f16')
+        self._embedding_path = os.path.join(directory, 'embeddings.f16')
+        self._signature_path = os.path.join(directory, 'signatures.u8')
+        self._entries_path = os.path.join(directory, 'entries.jsonl')
+        self._lock_path = os.path.join(directory, '.lock')
+        self._lock = threading.Lock()
+        self._entries = []
+        self._entries_offset = 0
+        self._capacity = 0
+        self._descriptors = None
+        self._embeddings = None
+        self._signatures = None
+        self._lookups = 0
+        self._matches = 0
+        with self._lock:
+            self._refresh()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _map(self, capacity):
+        """(Re)map both arrays with room for `capacity` rows, growing the files if needed"""
+        if self.embedding_dim is None and os.path.exists(self._embedding_path):
+            # Both files always hold the same number of rows
+            rows = os.path.getsize(self._descriptor_path) // (self.descriptor_dim * 2)
+            self.embedding_dim = os.path.getsize(self._embedding_path) // (rows * 2) if rows else None
+        arrays = [(self._descriptor_path, self.descriptor_dim * 2), (self._signature_path, self.signature_dim)]
+        if self.embedding_dim:
+            arrays.append((self._embedding_path, self.embedding_dim * 2))
+        for path, row_bytes in arrays:
+            size = capacity * row_bytes
+            with open(path, 'ab') as f:
+                if f.tell() < size:
+                    f.truncate(size)
+        self._capacity = capacity
+        self._descriptors = np.memmap(self._descriptor_path, np.float16, 'r+', shape=(capacity, self.descriptor_dim))
+        self._signatures = np.memmap(self._signature_path, np.uint8, 'r+', shape=(capacity, self.signature_dim))
+        if self.embedding_dim:
+            self._embeddings = np.memmap(self._embedding_path, np.float16, 'r+', shape=(capacity, self.embedding_dim))
+
+    def _refresh(self):
+        """Pick up rows appended since the last call (possibly by another process)"""
+        try:
+            size = os.path.getsize(self._entries_path)
+        except OSError:
+            size = 0
+        if size > self._entries_offset:
+            with open(self._entries_path, 'rb') as f:
+                f.seek(self._entries_offset)
+                data = f.read(size - self._entries_offset)
+            # Ignore a trailing line another process is still writing
+            complete = data[:data.rfind(b'\n') + 1]
+            self._entries.extend(json.loads(line) for line in complete.splitlines())
+            self._entries_offset += len(complete)
+        # Also remap once rows exist if this process opened the store before any embedding was written
+        if self._descriptors is None or len(self._entries) > self._capacity or \
+                (self._embeddings is None and self._entries):
+            on_disk = os.path.getsize(self._descriptor_path) // (self.descriptor_dim * 2) \
+                if os.path.exists(self._descriptor_path) else 0
+            self._map(max(1024, on_disk, len(self._entries)))
+
+    def _file_lock(self):
+        handle = open(self._lock_path, 'a')
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def add(self, descriptor, embedding, patient_id=None, key=None, signature=None):
+        """Append one row and return its id; rows without a pixel signature are never reused"""
+        with self._lock:
+            handle = self._file_lock()
+            try:
+                self._refresh()
+                row = len(self._entries)
+                if self.embedding_dim is None:
+                    self.embedding_dim = len(embedding)
+                    self._map(self._capacity)
+                if row >= self._capacity:
+                    self._map(self._capacity * 2)
+                self._descriptors[row] = descriptor
+                self._embeddings[row] = embedding
+                if signature is not None:
+                    self._signatures[row] = signature
+                    self._signatures.flush()
+                self._descriptors.flush()
+                self._embeddings.flush()
+                entry = {'id': row, 'patient_id': patient_id, 'key': key, 'created': time.time(),
+                         'signature': signature is not None}
+                # The metadata line is written last: it is what makes the row visible
+                with open(self._entries_path, 'ab') as f:
+                    line = (json.dumps(entry) + '\n').encode()
+                    f.write(line)
+                self._entries.append(entry)
+                self._entries_offset += len(line)
+                return row
+            finally:
+                handle.close()
+
+    def search(self, descriptor):
+        """Near-duplicates of `descriptor`: (id, cosine similarity) pairs at or above the threshold, best first"""
+        with self._lock:
+            self._refresh()
+            count = len(self._entries)
+            descriptors = self._descriptors
+            self._lookups += 1
+        query = np.asarray(descriptor, dtype=np.float32)
+        found = []
+        # Chunked so a large store never materialises as one float32 copy
+        for start in range(0, count, self.search_chunk):
+            scores = np.asarray(descriptors[start:min(count, start + self.search_chunk)], dtype=np.float32) @ query
+            for index in np.flatnonzero(scores >= self.threshold):
+                found.append((start + int(index), float(scores[index])))
+        found.sort(key=lambda item: -item[1])
+        if found:
+            with self._lock:
+                self._matches += 1
+        return found
+
+    def same_capture(self, row, signature):
+        """True when no pixel of `signature` differs from the row's by more than `pixel_tolerance`"""
+        if not self._entries[row].get('signature'):
+            return False
+        stored = np.asarray(self._signatures[row], dtype=np.int16)
+        return int(np.abs(stored - np.asarray(signature, dtype=np.int16)).max()) <= self.pixel_tolerance
+
+    def entry(self, row):
+        """Metadata of a row: id, patient_id, key and creation time"""
+        return self._entries[row]
+
+    def embedding(self, row):
+        """Stored backbone embedding of a row as float32"""
+        return np.asarray(self._embeddings[row], dtype=np.float32)
+
+    def stats(self):
+        return {
+            'enabled': True,
+            'entries': len(self._entries),
+            'capacity': self._capacity,
+            'threshold': self.threshold,
+            'pixel_tolerance': self.pixel_tolerance,
+            'lookups': self._lookups,
+            'matches': self._matches,
+            'embedding_dim': self.embedding_dim,
+            'bytes': self._capacity * ((self.descriptor_dim + (self.embedding_dim or 0)) * 2 + self.signature_dim)
+        }
@@ -146,7 +146,8 @@ async function checkAPIHealth() {
         const response = await fetch(`${API_BASE_URL}/health`);
         const data = await response.json();
         
-        if (!data.model_loaded) {
+        // The model loads lazily, so only warn when loading actually failed
+        if (!data.model_loaded && data.model_error) {
             showNotification('Model not loaded. Please check the backend configuration.', 'warning');
         }
     } catch (error) {
@@ -0,0 +1,53 @@
+"""
+Gunicorn configuration for the Flask API
+Loads the model once in the master and shares its weights with forked workers
+
+Scale workers with cores: each worker gets cores // WEB_CONCURRENCY torch
+threads (see inference_profile.py), so e.g. 8 cores with WEB_CONCURRENCY=4
+gives four workers with two intra-op threads each. The weights are loaded
+once before forking, so memory does not grow with the worker count.
+"""
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Threads let the batch scheduler see concurrent requests. There is one for every prediction the admission
+# controller admits or queues, plus two for health checks and metrics, so requests beyond its limits get
+# an immediate 429 instead of waiting unbounded in gunicorn's own queue (see the admission settings in app.py)
+threads = int(os.environ.get('GUNICORN_THREADS') or (
+    int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 16)) + int(os.environ.get('ADMISSION_MAX_QUEUED', 32)) + 2))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+# Import app.py (and the model) in the master so workers inherit it via fork()
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    """Load the weights in the master before any worker is forked"""
+    if not preload_app:
+        return
+    from model_runtime import runtime
+    from app import cascade
+    for model in (runtime, cascade.runtime) if cascade else (runtime,):
+        if model.ensure_loaded() and os.environ.get('SHARE_MODEL_MEMORY', '1') == '1':
+            model.share_memory()
+    server.log.info(f"Model preloaded in master: {runtime.status()}")
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far into the permanent GC generation, so
+    # the collector in each worker doesn't write to (and un-share) those pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Per-worker setup: thread pools don't survive fork(), warm-up runs here rather than in the master"""
+    from model_runtime import runtime
+    runtime.profile.apply_threads(force=True)
+    if os.environ.get('MODEL_WARMUP', '0') == '1':
+        runtime.warm_up()
+        from app import cascade
+        if cascade:
+            cascade.warm_up()
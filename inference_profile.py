@@ -0,0 +1,93 @@
+"""
+CPU inference tuning profile
+Memory format, bfloat16 autocast and thread counts, configured per deployment
+"""
+
+import contextlib
+import os
+
+import torch
+
+
+def _flag(name, default='0'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+def available_cores():
+    """Cores this process may run on (respects taskset/cgroup CPU affinity)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def bf16_supported():
+    """Whether oneDNN can run bfloat16 kernels natively on this CPU"""
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class InferenceProfile:
+    """Tuning knobs applied by the model runtime
+
+    Environment variables:
+        INFERENCE_CHANNELS_LAST  run the eager model in channels_last memory format
+        INFERENCE_BF16           bfloat16 autocast on CPU ('auto' enables it when supported)
+        WEB_CONCURRENCY          number of server worker processes sharing the cores
+        TORCH_NUM_THREADS        intra-op threads per worker (default: cores // workers)
+        TORCH_INTEROP_THREADS    inter-op threads per worker (default: 1)
+    """
+
+    def __init__(self):
+        self.workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+        self.cores = available_cores()
+        self.num_threads = int(os.environ.get('TORCH_NUM_THREADS', max(1, self.cores // self.workers)))
+        self.interop_threads = int(os.environ.get('TORCH_INTEROP_THREADS', 1))
+        self.channels_last = _flag('INFERENCE_CHANNELS_LAST')
+        bf16 = os.environ.get('INFERENCE_BF16', '0').lower()
+        self.bf16 = bf16_supported() if bf16 == 'auto' else _flag('INFERENCE_BF16')
+        self._threads_applied = False
+
+    def apply_threads(self, force=False):
+        """Pin torch's thread pools so workers don't oversubscribe the cores"""
+        if self._threads_applied and not force:
+            return
+        torch.set_num_threads(self.num_threads)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op work has started
+            pass
+        self._threads_applied = True
+
+    def prepare_model(self, model):
+        """Convert an eager model to the profile's memory format"""
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    def prepare_input(self, batch, device):
+        """Move a batch to the device in the profile's memory format"""
+        if self.channels_last:
+            return batch.to(device, memory_format=torch.channels_last)
+        return batch.to(device)
+
+    def autocast(self, device):
+        """Context manager running the forward pass in bfloat16 when enabled"""
+        if self.bf16 and device.type == 'cpu':
+            return torch.autocast('cpu', dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def status(self):
+        """Summary reported on /api/health"""
+        return {
+            'channels_last': self.channels_last,
+            'bf16': self.bf16,
+            'bf16_supported': bf16_supported(),
+            'workers': self.workers,
+            'cores': self.cores,
+            'num_threads': torch.get_num_threads(),
+            'interop_threads': torch.get_num_interop_threads()
+        }
@@ -0,0 +1,226 @@
+"""
+Lightweight Prometheus metrics
+Counters, gauges and latency histograms rendered in the Prometheus text exposition format
+"""
+
+import bisect
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds: sub-millisecond JSON work up to multi-second CPU forward passes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value != value:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """A named metric family; labelled children are created on first use"""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        """Return the child for one combination of label values"""
+        key = tuple(str(kwargs[name]) for name in self.labelnames) if kwargs else tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for key, child in list(self._children.items()):
+            yield '', _format_labels(self.labelnames, key), child.value
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, or is read from `callback` at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def _samples(self):
+        if self.callback is not None:
+            yield '', '', self.callback()
+            return
+        for key, child in list(self._children.items()):
+            yield '', _format_labels(self.labelnames, key), child.value
+
+
+class _HistogramValue:
+    __slots__ = ('upper_bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets
+
+    Observing is one bisect and one short locked update, so it is cheap
+    enough to leave on for every request.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        for key, child in list(self._children.items()):
+            with child.lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))]), cumulative
+            yield '_sum', _format_labels(self.labelnames, key), total
+            yield '_count', _format_labels(self.labelnames, key), cumulative
+
+
+class Registry:
+    """Ordered collection of metrics rendered together on /api/metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def process_resident_memory_bytes():
+    """Current RSS of this process (peak RSS where /proc isn't available, NaN without the resource module)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
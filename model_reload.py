@@ -0,0 +1,201 @@
+"""
+Hot model reload and shadow scoring
+Loads a new checkpoint in the background, warms it up and swaps it into the running ModelRuntime
+"""
+
+import os
+import queue
+import threading
+import time
+
+import torch
+
+from model_runtime import ModelRuntime
+
+
+class ModelReloader:
+    """Background reloads of a ModelRuntime: load a candidate, warm it up, then swap it in
+
+    The candidate is a separate ModelRuntime with the same precision, backend
+    and profile, so requests keep running on the current model until the
+    swap. Forward passes already running hold their own reference to the old
+    model and finish on it. A failed load leaves the current model in place.
+
+    `watch(interval)` polls the checkpoint file and reloads once a change has
+    been stable for one interval (so a half-copied file is never loaded).
+    Threads don't survive fork(), so each server worker starts its own watcher.
+    """
+
+    def __init__(self, runtime, warmup_batch_sizes=(1,), on_swap=None, name='active'):
+        self.runtime = runtime
+        self.warmup_batch_sizes = tuple(warmup_batch_sizes)
+        self.on_swap = on_swap
+        self.name = name
+        self._lock = threading.Lock()
+        self._thread = None
+        self._watcher = None
+        self._watcher_pid = None
+        self._reloads = 0
+        self._failures = 0
+        self._last = None
+
+    @property
+    def reloading(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def reload(self, path=None):
+        """Start loading `path` (default: the current checkpoint) in the background; False if one is running"""
+        with self._lock:
+            if self.reloading:
+                return False
+            self._thread = threading.Thread(target=self._reload, args=(path or self.runtime.path,),
+                                            name=f'model-reload-{self.name}', daemon=True)
+            self._thread.start()
+            return True
+
+    def _reload(self, path):
+        start = time.perf_counter()
+        candidate = ModelRuntime(path, self.runtime.device, self.runtime.quantize, self.runtime.backend,
+                                 self.runtime.profile, self.runtime.arch)
+        try:
+            if not candidate.warm_up(self.warmup_batch_sizes):
+                raise RuntimeError(candidate.error)
+        except Exception as e:
+            self._failures += 1
+            self._last = {'path': path, 'ok': False, 'error': str(e), 'finished': time.time()}
+            print(f"Model reload ({self.name}) from {path} failed, keeping {self.runtime.version}: {e}")
+            return False
+        previous = self.runtime.version
+        self.runtime.swap(candidate)
+        self._reloads += 1
+        self._last = {
+            'path': path,
+            'ok': True,
+            'previous_version': previous,
+            'version': self.runtime.version,
+            'seconds': round(time.perf_counter() - start, 3),
+            'finished': time.time()
+        }
+        print(f"Model reloaded ({self.name}): {previous} -> {self.runtime.version} "
+              f"in {self._last['seconds']}s (warmed up with batches of {list(self.warmup_batch_sizes)})")
+        if self.on_swap is not None:
+            self.on_swap()
+        return True
+
+    def watch(self, interval):
+        """Make sure this process has a thread polling the checkpoint every `interval` seconds"""
+        if self._watcher is not None and self._watcher.is_alive() and self._watcher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._watcher is None or not self._watcher.is_alive() or self._watcher_pid != os.getpid():
+                self._watcher = threading.Thread(target=self._watch, args=(interval,),
+                                                 name=f'model-watch-{self.name}', daemon=True)
+                self._watcher_pid = os.getpid()
+                self._watcher.start()
+
+    def _watch(self, interval):
+        def signature(path):
+            try:
+                stat = os.stat(path)
+                return stat.st_size, stat.st_mtime_ns
+            except OSError:
+                return None
+        path = self.runtime.path
+        loaded, seen = signature(path), None
+        while True:
+            time.sleep(interval)
+            if self.runtime.path != path:
+                # Switched to another checkpoint by reload(path); watch that file from now on
+                path = self.runtime.path
+                loaded, seen = signature(path), None
+                continue
+            current = signature(path)
+            if current is None or current == loaded:
+                seen = None
+            elif current != seen:
+                seen = current  # changed; wait one more interval for the write to settle
+            elif not self.reloading:
+                loaded, seen = current, None
+                self.reload()
+
+    def status(self):
+        return {
+            'version': self.runtime.version,
+            'path': self.runtime.path,
+            'reloading': self.reloading,
+            'reloads': self._reloads,
+            'failures': self._failures,
+            'last_reload': self._last,
+            'watching': self._watcher is not None and self._watcher.is_alive()
+        }
+
+
+class ShadowScorer:
+    """Score requests on a second model version off the request path and track agreement with the active one
+
+    Jobs are queued to one background thread; when the queue is full the
+    request is simply not shadowed, so the shadow model never adds latency.
+    """
+
+    def __init__(self, runtime, sample_rate=1.0, max_pending=32):
+        self.runtime = runtime
+        self.sample_rate = sample_rate
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+        self._offered = 0
+        self._scored = 0
+        self._agreed = 0
+        self._abs_diff = 0.0
+        self._dropped = 0
+        self._errors = 0
+
+    def submit(self, image, views, active_output, active_version):
+        """Queue one request's decoded image and the active model's log-probabilities"""
+        with self._lock:
+            self._offered += 1
+            # Deterministic sampling: every 1/sample_rate-th request
+            if int(self._offered * self.sample_rate) == int((self._offered - 1) * self.sample_rate):
+                return
+            if self._worker is None or not self._worker.is_alive() or self._worker_pid != os.getpid():
+                self._worker = threading.Thread(target=self._run, name='shadow-scorer', daemon=True)
+                self._worker_pid = os.getpid()
+                self._worker.start()
+        try:
+            self._queue.put_nowait((image, views, active_output, active_version))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def _run(self):
+        while True:
+            image, views, active_output, active_version = self._queue.get()
+            try:
+                if not self.runtime.ensure_loaded() or self.runtime.version == active_version:
+                    continue
+                output = self.runtime.predict(image, views)
+                diff = (torch.exp(output) - torch.exp(active_output)).abs().max().item()
+                with self._lock:
+                    self._scored += 1
+                    self._agreed += int(output.argmax() == active_output.argmax())
+                    self._abs_diff += diff
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                print(f"Shadow scoring failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': True,
+                'version': self.runtime.version,
+                'model_loaded': self.runtime.loaded,
+                'sample_rate': self.sample_rate,
+                'scored': self._scored,
+                'top1_agreement': round(self._agreed / self._scored, 4) if self._scored else None,
+                'mean_max_prob_diff': round(self._abs_diff / self._scored, 4) if self._scored else None,
+                'pending': self._queue.qsize(),
+                'dropped': self._dropped,
+                'errors': self._errors
+            }
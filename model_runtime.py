@@ -0,0 +1,421 @@
+"""
+Shared model runtime for Diabetic Retinopathy Detection
+Builds the ResNet-152 classifier once and loads its weights lazily
+"""
+
+import os
+import threading
+import time
+import zipfile
+
+import torch
+from torch import nn
+import torchvision
+from torchvision import models
+
+from prediction_cache import model_fingerprint
+from backends import BACKENDS, load_backend
+from inference_profile import InferenceProfile
+from preprocessing import FastPreprocessor, decode_image
+from tta import build_views, average_views
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.environ.get(
+    'MODEL_PATH',
+    os.path.join(BASE_DIR, 'Retinal_blindness_detection_Pytorch-master', 'classifier.pt')
+)
+
+# Architecture assumed for checkpoints that don't record one (distilled students do, see distill.py)
+MODEL_ARCH = os.environ.get('MODEL_ARCH', 'resnet152').lower()
+
+# Inference precision: 'fp32' (default) or 'int8' (CPU-only quantized model, see quantization.py)
+QUANTIZE = os.environ.get('QUANTIZE', 'fp32').lower()
+
+# Inference backend: 'eager', 'torchscript' or 'onnxruntime' (export artifacts with backends.py)
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'eager').lower()
+
+# Preprocessing: reduced-resolution JPEG decode + fused normalisation (see preprocessing.py)
+FAST_PREPROCESS = os.environ.get('FAST_PREPROCESS', '0') == '1'
+PREPROCESS_CROP_BORDER = os.environ.get('PREPROCESS_CROP_BORDER', '0') == '1'
+
+# Decompression budget: larger PNGs are rejected from their header, larger JPEGs are decoded at reduced scale
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 40_000_000))
+
+# Prefer the slim inference artifact next to MODEL_PATH (classifier.slim.pt, see slim_checkpoint.py)
+PREFER_SLIM_CHECKPOINT = os.environ.get('PREFER_SLIM_CHECKPOINT', '1') == '1'
+
+# Classes for diabetic retinopathy severity
+CLASSES = ['No DR', 'Mild', 'Moderate', 'Severe', 'Proliferative DR']
+
+# Backbones that can carry the classifier head, with the width of the pooled feature fed to it
+ARCHITECTURES = {
+    'resnet152': 2048,
+    'resnet50': 2048,
+    'resnet34': 512,
+    'resnet18': 512,
+    'mobilenet_v3_large': 960,
+    'mobilenet_v3_small': 576
+}
+
+# Device configuration
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Image transformations
+test_transforms = torchvision.transforms.Compose([
+    torchvision.transforms.Resize((224, 224)),
+    torchvision.transforms.ToTensor(),
+    torchvision.transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))
+])
+
+fast_preprocessor = FastPreprocessor(crop=PREPROCESS_CROP_BORDER)
+PREPROCESS_MODE = ('fast+crop' if PREPROCESS_CROP_BORDER else 'fast') if FAST_PREPROCESS else 'reference'
+
+
+def load_image(source):
+    """Validate the header of image bytes, a stream or a path, then decode it to an RGB PIL image
+
+    Raises ImageRejected (before any pixel is decoded) for unsupported formats
+    and images over MAX_IMAGE_PIXELS that can't be decoded at reduced size.
+    """
+    return decode_image(source, draft=FAST_PREPROCESS, max_pixels=MAX_IMAGE_PIXELS)
+
+
+def preprocess(image):
+    """Turn an RGB PIL image into the normalised (3, 224, 224) model input"""
+    if FAST_PREPROCESS:
+        return fast_preprocessor.preprocess(image)
+    return test_transforms(image)
+
+
+def build_classifier_head(num_ftrs=2048):
+    """The custom 5-class head that replaces ResNet's fc layer"""
+    return nn.Sequential(
+        nn.Linear(num_ftrs, 512),
+        nn.ReLU(),
+        nn.Linear(512, len(CLASSES)),
+        nn.LogSoftmax(dim=1)
+    )
+
+
+def build_model(device=None, arch='resnet152', weights=None):
+    """Build a backbone (ResNet-152 by default) with the custom 5-class classifier head
+
+    With device='meta' no memory is allocated and no random initialisation
+    runs; the parameters are placeholders until a state dict is assigned.
+    `weights` selects torchvision's pretrained ImageNet weights for the backbone.
+    """
+    if arch not in ARCHITECTURES:
+        raise ValueError(f"Unknown architecture '{arch}'. Choose one of: {', '.join(ARCHITECTURES)}")
+    with torch.device(device or 'cpu'):
+        model = getattr(models, arch)(weights=weights)
+        if arch.startswith('mobilenet'):
+            # MobileNetV3's classifier MLP is replaced by the same head as the ResNets' fc
+            model.classifier = build_classifier_head(model.classifier[0].in_features)
+        else:
+            model.fc = build_classifier_head(model.fc.in_features)
+    return model
+
+
+SLIM_FORMAT = 'dr-slim-v1'
+
+
+def slim_path(path):
+    """Where the slim inference artifact for a checkpoint lives: classifier.pt -> classifier.slim.pt"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.slim{ext or '.pt'}"
+
+
+def read_checkpoint(path, device='cpu'):
+    """torch.load with weights_only=True, memory-mapping zip-format files
+
+    Only tensors and plain containers are unpickled. With mmap, tensors are
+    paged in from the file as they are touched, so entries that are never
+    used (e.g. a full checkpoint's optimizer state) are never read.
+    """
+    return torch.load(path, map_location=device, weights_only=True, mmap=zipfile.is_zipfile(path))
+
+
+def resolve_checkpoint(path):
+    """The file to load for `path`: its slim artifact if there is one made from this exact checkpoint"""
+    candidate = slim_path(path)
+    if not PREFER_SLIM_CHECKPOINT or path == candidate or not os.path.exists(candidate):
+        return path
+    try:
+        source = read_checkpoint(candidate).get('source_fingerprint')
+    except Exception as e:
+        print(f"Ignoring unreadable slim checkpoint {candidate}: {e}")
+        return path
+    if os.path.exists(path) and source != model_fingerprint(path):
+        print(f"Ignoring stale slim checkpoint {candidate}; re-run slim_checkpoint.py")
+        return path
+    return candidate
+
+
+def load_checkpoint_model(path, device='cpu', arch=MODEL_ARCH):
+    """Build the checkpoint's architecture on the meta device and assign its weights
+
+    Returns (model, arch). Checkpoints that record an 'arch' use it; others
+    are assumed to be `arch`. Slim checkpoints stored in fp16/bf16 are cast
+    back to float32. Only the weights are ever paged in from the memory map.
+    """
+    checkpoint = read_checkpoint(path, device)
+    arch = checkpoint.get('arch', arch)
+    state_dict = checkpoint['model_state_dict']
+    upcast = checkpoint.get('format') == SLIM_FORMAT and checkpoint.get('dtype', 'float32') != 'float32'
+    if upcast or zipfile.is_zipfile(path):
+        # Copy every tensor (even the integer BN counters) out of the file mapping, so the served
+        # weights never change, or fault, when the checkpoint file is overwritten or truncated
+        state_dict = {k: v.float() if upcast and v.is_floating_point() else v.clone() for k, v in state_dict.items()}
+    model = build_model('meta', arch)
+    model.load_state_dict(state_dict, assign=True)
+    return model, arch
+
+
+def split_forward(model, batch):
+    """Run `model` and also return the pooled backbone feature fed to its head"""
+    if hasattr(model, 'backbone'):
+        # QuantizedClassifier: the INT8 backbone already ends at the pooled feature
+        features = model.backbone(batch)
+        return model.head(features), features
+    if hasattr(model, 'classifier'):
+        features = torch.flatten(model.avgpool(model.features(batch)), 1)
+        return model.classifier(features), features
+    x = model.maxpool(model.relu(model.bn1(model.conv1(batch))))
+    x = model.layer4(model.layer3(model.layer2(model.layer1(x))))
+    features = torch.flatten(model.avgpool(x), 1)
+    return model.fc(features), features
+
+
+def classifier_head(model):
+    """The classifier head of an eager or INT8 model"""
+    if hasattr(model, 'backbone'):
+        return model.head
+    return model.classifier if hasattr(model, 'classifier') else model.fc
+
+
+class ModelRuntime:
+    """Lazily-loaded inference model shared by every entry point
+
+    The checkpoint is read on the first call to `ensure_loaded()`,
+    `warm_up()` or any predict method, so importing an app stays cheap.
+    """
+
+    def __init__(self, path=MODEL_PATH, device=device, quantize=QUANTIZE, backend=INFERENCE_BACKEND, profile=None,
+                 arch=MODEL_ARCH):
+        self.path = path
+        self.arch = arch
+        self.device = device
+        self.quantize = quantize
+        self.backend = backend
+        self.profile = profile or InferenceProfile()
+        self._tuned = False
+        self.model = None
+        self.error = None
+        self.load_seconds = None
+        self.checkpoint_fingerprint = None
+        self.checkpoint_path = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    @property
+    def version(self):
+        """File name and fingerprint of the loaded weights, e.g. 'classifier.slim.pt@3f2a9c1e'"""
+        if self.checkpoint_fingerprint is None:
+            return None
+        return f"{os.path.basename(self.checkpoint_path or self.path)}@{self.checkpoint_fingerprint[:8]}"
+
+    def ensure_loaded(self):
+        """Load the checkpoint if it hasn't been yet; return whether the model is usable"""
+        if self.model is not None:
+            return True
+        with self._lock:
+            if self.model is None and self.error is None:
+                self._load()
+        return self.model is not None
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            self.profile.apply_threads()
+            # Exported backends load their own artifacts; eager prefers an up-to-date slim checkpoint
+            self.checkpoint_path = self.path if self.backend != 'eager' else resolve_checkpoint(self.path)
+            # Taken before reading, so a checkpoint replaced mid-load is picked up by the next reload
+            self.checkpoint_fingerprint = model_fingerprint(self.checkpoint_path)
+            if self.backend != 'eager':
+                self.model = self._load_exported()
+                self.load_seconds = round(time.perf_counter() - start, 3)
+                print(f"Model loaded successfully ({self.backend}) in {self.load_seconds}s!")
+                return
+            # Build on the meta device and adopt the checkpoint tensors directly,
+            # so the 60M parameters are never randomly initialised just to be overwritten
+            model, self.arch = load_checkpoint_model(self.checkpoint_path, self.device, self.arch)
+            self.model = self._prepare_eager(model)
+            self.load_seconds = round(time.perf_counter() - start, 3)
+            print(f"Model loaded successfully ({self.arch}, {os.path.basename(self.checkpoint_path)}) "
+                  f"in {self.load_seconds}s!")
+        except Exception as e:
+            self.error = str(e)
+            print(f"Error loading model: {e}")
+
+    def swap(self, other):
+        """Atomically start serving another runtime's loaded model (see model_reload.py)
+
+        Forward passes already running keep their reference to the old model
+        and finish on it; every later call uses the new one.
+        """
+        with self._lock:
+            self.path, self.arch, self.device = other.path, other.arch, other.device
+            self.checkpoint_path = other.checkpoint_path
+            self.load_seconds, self.checkpoint_fingerprint = other.load_seconds, other.checkpoint_fingerprint
+            self._tuned, self.error = other._tuned, None
+            self.model = other.model
+
+    def _prepare_eager(self, model):
+        model.requires_grad_(False)
+        model.eval()
+        if self.quantize == 'int8':
+            self._tuned = False
+            return self._quantize(model)
+        # channels_last / bf16 only apply to the fp32 eager model
+        self._tuned = True
+        return self.profile.prepare_model(model)
+
+    def adopt(self, model):
+        """Serve an already-built eager model instead of loading the checkpoint
+
+        Used by the benchmarks to fall back to randomly initialised weights
+        when classifier.pt is only a Git LFS pointer.
+        """
+        with self._lock:
+            self.profile.apply_threads()
+            self.model = self._prepare_eager(model.to(self.device))
+            self.error = None
+
+    def _load_exported(self):
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend '{self.backend}'. Choose one of: {', '.join(BACKENDS)}")
+        if self.quantize != 'fp32':
+            print(f"QUANTIZE={self.quantize} only applies to the eager backend; ignoring it")
+            self.quantize = 'fp32'
+        if self.backend == 'onnxruntime':
+            self.device = torch.device('cpu')
+        return load_backend(self.backend, self.path, self.device)
+
+    def _quantize(self, model):
+        # Imported here because quantization.py builds on this module
+        from quantization import quantize_model, load_calibration_batches
+        if self.device.type != 'cpu':
+            print("INT8 quantization is CPU-only; moving the model to the CPU")
+            self.device = torch.device('cpu')
+            model.to(self.device)
+        start = time.perf_counter()
+        model = quantize_model(model, load_calibration_batches(), arch=self.arch)
+        print(f"Model quantized to INT8 in {time.perf_counter() - start:.1f}s")
+        return model
+
+    def share_memory(self):
+        """Move weights into shared memory so forked workers map the same pages"""
+        if not self.loaded or not hasattr(self.model, 'share_memory'):
+            return False
+        try:
+            self.model.share_memory()
+            return True
+        except (RuntimeError, NotImplementedError) as e:
+            # e.g. packed INT8 weights; these still stay copy-on-write shared
+            print(f"Could not move model into shared memory: {e}")
+            return False
+
+    def fingerprint(self):
+        """Identify the weights and precision in use, for keying cached predictions"""
+        precision = 'bf16' if self.profile.bf16 and self.quantize == 'fp32' and self.backend == 'eager' else self.quantize
+        checkpoint = self.checkpoint_fingerprint or model_fingerprint(self.path)
+        return f"{checkpoint}:{precision}:{self.backend}:{PREPROCESS_MODE}"
+
+    def warm_up(self, batch_sizes=(1,)):
+        """Load the model and run dummy forward passes so the first requests aren't slow
+
+        One pass per batch size, since oneDNN creates its primitives per input shape.
+        """
+        if not self.ensure_loaded():
+            return False
+        for batch_size in ([batch_sizes] if isinstance(batch_sizes, int) else batch_sizes):
+            self.forward_with_features(torch.zeros(batch_size, 3, 224, 224))
+        return True
+
+    def forward(self, batch):
+        """Run a preprocessed batch (N, 3, 224, 224) and return log-probabilities on the CPU"""
+        if not self.ensure_loaded():
+            raise RuntimeError(f"Model not loaded: {self.error}")
+        with torch.no_grad():
+            if self._tuned:
+                with self.profile.autocast(self.device):
+                    output = self.model(self.profile.prepare_input(batch, self.device))
+                return output.float().cpu()
+            return self.model(batch.to(self.device)).cpu()
+
+    @property
+    def supports_embeddings(self):
+        """Exported TorchScript/ONNX graphs can't be split at the backbone feature"""
+        return self.backend == 'eager'
+
+    def forward_with_features(self, batch):
+        """Like forward(), but return (log-probabilities, pooled backbone features)"""
+        if not self.supports_embeddings:
+            output = self.forward(batch)
+            return output, output.new_empty(output.shape[0], 0)
+        if not self.ensure_loaded():
+            raise RuntimeError(f"Model not loaded: {self.error}")
+        with torch.no_grad():
+            if self._tuned:
+                with self.profile.autocast(self.device):
+                    output, features = split_forward(self.model, self.profile.prepare_input(batch, self.device))
+                return output.float().cpu(), features.float().cpu()
+            output, features = split_forward(self.model, batch.to(self.device))
+            return output.cpu(), features.cpu()
+
+    def forward_head(self, features):
+        """Run only the classifier head on stored (N, feature width) backbone features"""
+        if not self.ensure_loaded():
+            raise RuntimeError(f"Model not loaded: {self.error}")
+        with torch.no_grad():
+            return classifier_head(self.model)(features.to(self.device)).float().cpu()
+
+    def predict_batch(self, images):
+        """Return the class log-probabilities for a list of PIL images"""
+        if FAST_PREPROCESS:
+            # Filled into this thread's reusable buffer; forward() consumes it before returning
+            return self.forward(fast_preprocessor.preprocess_batch(images))
+        return self.forward(torch.stack([preprocess(image) for image in images]))
+
+    def predict(self, image, views=1):
+        """Return the class log-probabilities for a single PIL image
+
+        With `views` > 1 the first `views` test-time augmentations (see tta.py)
+        run as one batch and their probabilities are averaged.
+        """
+        if views > 1:
+            return average_views(self.forward(build_views(preprocess(image), views)))
+        return self.predict_batch([image])[0]
+
+    def status(self):
+        """Summary used by health endpoints"""
+        return {
+            'model_loaded': self.loaded,
+            'model_path': self.path,
+            'checkpoint_path': self.checkpoint_path,
+            'arch': self.arch,
+            'precision': self.quantize,
+            'backend': self.backend,
+            'profile': self.profile.status(),
+            'preprocessing': PREPROCESS_MODE,
+            'load_seconds': self.load_seconds,
+            'version': self.version,
+            'error': self.error
+        }
+
+
+# Default runtime shared within a process
+runtime = ModelRuntime()
@@ -0,0 +1,203 @@
+"""
+Content-addressed prediction cache
+Skips the forward pass for images that have already been classified
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def model_fingerprint(path):
+    """Cheap fingerprint of a checkpoint file: size, mtime and its first/last 64KB"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 'no-checkpoint'
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(65536))
+        if stat.st_size > 65536:
+            f.seek(-65536, os.SEEK_END)
+            digest.update(f.read(65536))
+    return digest.hexdigest()
+
+
+def image_key(image, fingerprint, variant=''):
+    """Hash the decoded pixels of a PIL image together with the model fingerprint"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{fingerprint}|{variant}|{image.mode}|{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """Bounded LRU cache of model outputs with TTL and an optional on-disk tier
+
+    Values are small JSON-serialisable objects (the per-class log-probabilities
+    of one image). The in-memory tier is capped at `max_bytes`; the least
+    recently used entries are evicted first. When `disk_dir` is set, entries
+    are also written there so they survive restarts; once that directory
+    grows past `disk_max_bytes` (0 = unbounded), expired and then the oldest
+    files are deleted.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl_seconds=86400, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (created, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._disk_bytes = 0
+        self._disk_evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._prune_disk()
+
+    def get(self, key):
+        """Return the cached value for `key`, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self.ttl and now - entry[0] > self.ttl:
+                    self._remove(key)
+                else:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return entry[1]
+        value = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+            self._disk_hits += 1
+            self._hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store `value` under `key` in memory (and on disk when enabled)"""
+        created = time.time()
+        self._memory_put(key, value, created)
+        if self.disk_dir:
+            try:
+                path = self._disk_path(key)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                data = json.dumps({'created': created, 'value': value})
+                with open(tmp_path, 'w') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Prediction cache disk write failed: {e}")
+                return
+            with self._lock:
+                self._disk_bytes += len(data)
+                over = self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes
+            if over:
+                self._prune_disk()
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'disk_hits': self._disk_hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self._evictions,
+                'disk_enabled': bool(self.disk_dir),
+                'disk_bytes': self._disk_bytes,
+                'disk_max_bytes': self.disk_max_bytes,
+                'disk_evictions': self._disk_evictions
+            }
+
+    def _memory_put(self, key, value, created):
+        size = sys.getsizeof(key) + len(json.dumps(value))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (created, value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _prune_disk(self):
+        """Delete expired disk entries, then the oldest until the tier is back under 90% of its cap
+
+        Also recounts the tier's size, since other workers write to the same directory.
+        """
+        files = []
+        try:
+            with os.scandir(self.disk_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json'):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            print(f"Prediction cache disk scan failed: {e}")
+            return
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.disk_max_bytes * 0.9
+        now = time.time()
+        removed = 0
+        for modified, size, path in files:
+            # Oldest first: once a file is neither expired nor over the cap, neither is any later one
+            if not (self.ttl and now - modified > self.ttl) and not (self.disk_max_bytes and total > target):
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            total -= size
+        with self._lock:
+            self._disk_bytes = total
+            self._disk_evictions += removed
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.ttl and now - entry['created'] > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        # Promote back into the memory tier
+        self._memory_put(key, entry['value'], entry['created'])
+        return entry['value']
@@ -0,0 +1,222 @@
+"""
+Fast fundus image decode and preprocessing
+Reduced-resolution JPEG decoding, black-border cropping and a fused uint8 -> normalised float step
+
+Run as a script to check the fast pipeline against the reference transform:
+    python preprocessing.py Retinal_blindness_detection_Pytorch-master/sampleimages
+"""
+
+import argparse
+import os
+import threading
+from io import BytesIO
+
+import numpy as np
+import torch
+from PIL import Image
+
+INPUT_SIZE = 224
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+SUPPORTED_FORMATS = ('PNG', 'JPEG')
+
+# Per-channel lookup table: normalised value for every uint8 level, so the whole
+# ToTensor + Normalize step becomes one gather per channel
+_LUT = ((np.arange(256, dtype=np.float32)[None, :] / 255.0 - np.array(MEAN, dtype=np.float32)[:, None])
+        / np.array(STD, dtype=np.float32)[:, None])
+
+
+class ImageRejected(ValueError):
+    """An image failed header validation; no pixels were decoded"""
+
+
+class ImageTooLarge(ImageRejected):
+    """An image's dimensions exceed the pixel budget even at the smallest decode scale"""
+
+
+def probe_image(source, max_pixels=None):
+    """Open an image lazily and validate its header without decoding any pixels
+
+    Checks the magic bytes, the format PIL parses from the header and the
+    dimensions. Returns the still-unloaded PIL image and the JPEG DCT scale
+    (1, 2, 4 or 8) needed to decode it within `max_pixels`; other formats
+    can't be decoded at reduced size, so over-budget ones are rejected.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    if isinstance(source, (str, os.PathLike)):
+        # PIL opens (and closes) the file itself
+        with open(source, 'rb') as f:
+            header = f.read(16)
+    else:
+        position = source.tell()
+        header = source.read(16)
+        source.seek(position)
+    if image_mime(header) == 'application/octet-stream':
+        raise ImageRejected("Unsupported image format. Please upload PNG, JPG or JPEG.")
+    try:
+        image = Image.open(source, formats=SUPPORTED_FORMATS)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    except (OSError, SyntaxError) as e:
+        raise ImageRejected(f"Unreadable image header: {e}")
+    width, height = image.size
+    if width < 1 or height < 1:
+        raise ImageRejected(f"Invalid image dimensions {width}x{height}")
+    scale = 1
+    if max_pixels:
+        while width * height > max_pixels * scale * scale:
+            if image.format != 'JPEG' or scale == 8:
+                raise ImageTooLarge(f"Image is {width}x{height}; the limit is {max_pixels:,} pixels")
+            scale *= 2
+    return image, scale
+
+
+def decode_image(source, size=INPUT_SIZE, draft=True, max_pixels=None):
+    """Decode bytes, a stream or a path to RGB, letting JPEG decode at reduced resolution
+
+    JPEG's DCT scaling decodes directly at 1/2, 1/4 or 1/8 scale. We ask for
+    twice the model input size so there is headroom for the border crop and
+    the final resize still downsamples. The header is validated first, and
+    JPEGs over `max_pixels` are decoded at a scale that fits the budget.
+    """
+    image, scale = probe_image(source, max_pixels)
+    if image.format == 'JPEG':
+        # draft() picks the largest reduction that keeps the image at least this big
+        target = (image.width // scale, image.height // scale)
+        if draft:
+            target = (min(target[0], size * 2), min(target[1], size * 2))
+        if target != image.size:
+            image.draft('RGB', target)
+    return image.convert('RGB')
+
+
+def image_mime(data):
+    """MIME type of encoded image bytes, from their signature"""
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    return 'application/octet-stream'
+
+
+def encode_thumbnail(image, max_size=256, quality=80):
+    """JPEG bytes of a decoded image shrunk so its longest side is at most `max_size`"""
+    scale = max_size / max(image.size)
+    if scale < 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def crop_border(image, threshold=10, probe_size=128):
+    """Crop the black background around the circular fundus region
+
+    The bounding box is found on a small greyscale probe so the cost doesn't
+    grow with the image resolution. Images that are all background (or have
+    no border) are returned unchanged.
+    """
+    probe = image.convert('L')
+    probe.thumbnail((probe_size, probe_size))
+    mask = np.asarray(probe) > threshold
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return image
+    sx, sy = image.width / probe.width, image.height / probe.height
+    box = (
+        max(0, int(cols[0] * sx)), max(0, int(rows[0] * sy)),
+        min(image.width, int(np.ceil((cols[-1] + 1) * sx))), min(image.height, int(np.ceil((rows[-1] + 1) * sy)))
+    )
+    if box == (0, 0, image.width, image.height) or box[2] - box[0] < 16 or box[3] - box[1] < 16:
+        return image
+    return image.crop(box)
+
+
+def normalize_into(image, out):
+    """Write the normalised (3, H, W) float32 version of an RGB uint8 image into `out`"""
+    pixels = np.asarray(image, dtype=np.uint8)
+    target = out.numpy() if isinstance(out, torch.Tensor) else out
+    for c in range(3):
+        np.take(_LUT[c], pixels[:, :, c], out=target[c])
+    return out
+
+
+class FastPreprocessor:
+    """Decode-to-tensor pipeline with reusable per-thread output buffers
+
+    `preprocess()` returns a new tensor. `preprocess_batch()` fills a
+    preallocated batch buffer owned by the calling thread and returns it
+    without copying, so the caller must use the result before its next call.
+    """
+
+    def __init__(self, size=INPUT_SIZE, crop=False, draft=True):
+        self.size = size
+        self.crop = crop
+        self.draft = draft
+        self._local = threading.local()
+
+    def resize(self, image):
+        if self.crop:
+            image = crop_border(image)
+        # reducing_gap does a cheap integer box reduction first on large images
+        return image.resize((self.size, self.size), Image.BILINEAR, reducing_gap=3.0)
+
+    def preprocess(self, image):
+        """Return the normalised (3, size, size) tensor for an RGB PIL image"""
+        return normalize_into(self.resize(image), torch.empty(3, self.size, self.size))
+
+    def preprocess_batch(self, images):
+        """Fill this thread's reusable buffer with a batch and return a view of it"""
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or buffer.shape[0] < len(images):
+            buffer = torch.empty(max(len(images), 1), 3, self.size, self.size)
+            self._local.buffer = buffer
+        for i, image in enumerate(images):
+            normalize_into(self.resize(image), buffer[i])
+        return buffer[:len(images)]
+
+    def load(self, source):
+        """Decode and preprocess in one call"""
+        return self.preprocess(decode_image(source, self.size, self.draft))
+
+
+def compare_with_reference(paths, reference_transform, preprocessor):
+    """Max and mean absolute difference between the fast pipeline and the reference transform"""
+    results = []
+    for path in paths:
+        expected = reference_transform(Image.open(path).convert('RGB'))
+        actual = preprocessor.load(path)
+        diff = (expected - actual).abs()
+        results.append((path, diff.max().item(), diff.mean().item()))
+    return results
+
+
+def main():
+    from model_runtime import test_transforms
+
+    parser = argparse.ArgumentParser(description="Check the fast preprocessing pipeline against test_transforms")
+    parser.add_argument('folder', help="Folder of fundus images")
+    parser.add_argument('--mean-atol', type=float, default=0.02, help="Maximum allowed mean absolute difference per image")
+    parser.add_argument('--no-draft', action='store_true', help="Decode JPEGs at full resolution")
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.folder, name) for name in os.listdir(args.folder)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    # Border cropping changes the framing on purpose, so it is left out of the comparison
+    preprocessor = FastPreprocessor(crop=False, draft=not args.no_draft)
+    failed = 0
+    for path, max_diff, mean_diff in compare_with_reference(paths, test_transforms, preprocessor):
+        ok = mean_diff <= args.mean_atol
+        failed += not ok
+        print(f"{os.path.basename(path):20} max |diff| {max_diff:.4f}  mean |diff| {mean_diff:.4f}  {'OK' if ok else 'FAILED'}")
+    if failed:
+        raise SystemExit(f"{failed} image(s) differ from the reference transform by more than {args.mean_atol}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+INT8 quantized CPU inference for the ResNet-152 classifier
+Static post-training quantization for the conv backbone, dynamic quantization for the fc head
+
+Run as a script to compare the quantized model against fp32:
+    python quantization.py --model Retinal_blindness_detection_Pytorch-master/classifier.pt
+"""
+
+import argparse
+import io
+import os
+import time
+
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+from torchvision.models.quantization.resnet import QuantizableResNet, QuantizableBottleneck, QuantizableBasicBlock
+from PIL import Image
+
+from model_runtime import BASE_DIR, CLASSES, MODEL_PATH, build_classifier_head, load_checkpoint_model, test_transforms
+
+CALIBRATION_DIR = os.environ.get(
+    'QUANTIZE_CALIBRATION_DIR',
+    os.path.join(BASE_DIR, 'Retinal_blindness_detection_Pytorch-master', 'sampleimages')
+)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Quantizable twins of the supported ResNets: block type and blocks per stage
+QUANTIZABLE_RESNETS = {
+    'resnet152': (QuantizableBottleneck, [3, 8, 36, 3]),
+    'resnet50': (QuantizableBottleneck, [3, 4, 6, 3]),
+    'resnet34': (QuantizableBasicBlock, [3, 4, 6, 3]),
+    'resnet18': (QuantizableBasicBlock, [2, 2, 2, 2])
+}
+
+
+class QuantizedClassifier(nn.Module):
+    """INT8 backbone (quantize -> convs -> dequantize) followed by a dynamically quantized head"""
+
+    def __init__(self, backbone, head):
+        super().__init__()
+        self.backbone = backbone
+        self.head = head
+
+    def forward(self, x):
+        return self.head(self.backbone(x))
+
+
+def load_calibration_batches(folder=CALIBRATION_DIR, limit=64, batch_size=8):
+    """Preprocess up to `limit` images from `folder` into batches for calibration"""
+    paths = sorted(
+        os.path.join(folder, name) for name in os.listdir(folder)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )[:limit]
+    tensors = [test_transforms(Image.open(path).convert('RGB')) for path in paths]
+    return [torch.stack(tensors[i:i + batch_size]) for i in range(0, len(tensors), batch_size)]
+
+
+def quantize_model(float_model, calibration_batches, engine=None, arch='resnet152'):
+    """Return an INT8 copy of a loaded float ResNet classifier (CPU only)"""
+    if not calibration_batches:
+        raise ValueError("Static quantization needs at least one calibration image")
+    if arch not in QUANTIZABLE_RESNETS:
+        raise ValueError(f"INT8 quantization supports {', '.join(QUANTIZABLE_RESNETS)}, not '{arch}'")
+    engine = engine or ('x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack')
+    torch.backends.quantized.engine = engine
+
+    state_dict = {k: v.detach().cpu() for k, v in float_model.state_dict().items()}
+
+    # Quantizable twin of the ResNet with the same custom head
+    block, layers = QUANTIZABLE_RESNETS[arch]
+    with torch.device('meta'):
+        backbone = QuantizableResNet(block, layers)
+        backbone.fc = build_classifier_head(backbone.fc.in_features)
+    backbone.load_state_dict(state_dict, assign=True)
+
+    # The head stays outside the quantized region and gets dynamic INT8 Linear layers
+    head = backbone.fc
+    backbone.fc = nn.Identity()
+    backbone.eval()
+    backbone.fuse_model()
+    backbone.qconfig = tq.get_default_qconfig(engine)
+    tq.prepare(backbone, inplace=True)
+    with torch.no_grad():
+        for batch in calibration_batches:
+            backbone(batch)
+    tq.convert(backbone, inplace=True)
+
+    head = tq.quantize_dynamic(head.eval(), {nn.Linear}, dtype=torch.qint8)
+    model = QuantizedClassifier(backbone, head)
+    model.eval()
+    return model
+
+
+def serialized_size_mb(model):
+    """Size of the model's state dict when saved with torch.save"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / (1024 * 1024)
+
+
+def time_forward(model, batch, runs):
+    """Mean seconds per forward pass over `runs` runs after one warm-up pass"""
+    with torch.no_grad():
+        model(batch)
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(batch)
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare INT8 and fp32 ResNet-152 inference on CPU")
+    parser.add_argument('--model', default=MODEL_PATH, help="Checkpoint with a 'model_state_dict'")
+    parser.add_argument('--calibration-dir', default=CALIBRATION_DIR, help="Images used to calibrate activation ranges")
+    parser.add_argument('--eval-dir', default=None, help="Images used to measure top-1 agreement (defaults to the calibration dir)")
+    parser.add_argument('--calibration-images', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    float_model, arch = load_checkpoint_model(args.model)
+    float_model.eval()
+
+    calibration = load_calibration_batches(args.calibration_dir, args.calibration_images, args.batch_size)
+    start = time.perf_counter()
+    int8_model = quantize_model(float_model, calibration, arch=arch)
+    print(f"Quantized in {time.perf_counter() - start:.1f}s using {sum(len(b) for b in calibration)} calibration images")
+
+    evaluation = load_calibration_batches(args.eval_dir or args.calibration_dir, 10 ** 6, args.batch_size)
+    agree = total = 0
+    with torch.no_grad():
+        for batch in evaluation:
+            agree += (float_model(batch).argmax(1) == int8_model(batch).argmax(1)).sum().item()
+            total += len(batch)
+
+    fp32_size, int8_size = serialized_size_mb(float_model), serialized_size_mb(int8_model)
+    fp32_time = time_forward(float_model, evaluation[0], args.runs)
+    int8_time = time_forward(int8_model, evaluation[0], args.runs)
+    n = len(evaluation[0])
+
+    print("=" * 60)
+    print(f"{'':20}{'fp32':>12}{'int8':>12}{'ratio':>12}")
+    print(f"{'Size (MB)':20}{fp32_size:12.1f}{int8_size:12.1f}{fp32_size / int8_size:11.2f}x")
+    print(f"{f'Latency/batch {n} (ms)':20}{fp32_time * 1000:12.1f}{int8_time * 1000:12.1f}{fp32_time / int8_time:11.2f}x")
+    print(f"{'Images/sec':20}{n / fp32_time:12.1f}{n / int8_time:12.1f}")
+    print(f"Top-1 agreement with fp32: {agree}/{total} ({100.0 * agree / total:.1f}%) over {len(CLASSES)} classes")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
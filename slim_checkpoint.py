@@ -0,0 +1,108 @@
+"""
+Slim inference checkpoints
+Strips a training checkpoint down to the model weights, optionally in fp16/bf16, for fast memory-mapped loading
+
+    python slim_checkpoint.py --model Retinal_blindness_detection_Pytorch-master/classifier.pt --dtype fp16
+
+writes classifier.slim.pt next to the checkpoint. The serving runtime loads it
+instead of classifier.pt as long as it was made from the current classifier.pt
+(see resolve_checkpoint in model_runtime.py).
+"""
+
+import argparse
+import os
+import pickle
+import time
+
+import torch
+
+from model_runtime import (MODEL_PATH, MODEL_ARCH, SLIM_FORMAT, build_model, load_checkpoint_model, read_checkpoint,
+                           slim_path)
+from prediction_cache import model_fingerprint
+
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def load_source(path, allow_pickle=False):
+    """Read a training checkpoint; arbitrary pickles are only unpickled when explicitly allowed"""
+    try:
+        return read_checkpoint(path)
+    except pickle.UnpicklingError as e:
+        if not allow_pickle:
+            raise SystemExit(f"{path} holds objects weights_only loading refuses ({e}).\n"
+                             "Re-run with --allow-pickle only if you trust where this file came from.")
+        return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def source_model(source, arch=MODEL_ARCH):
+    """Model holding an already-read training checkpoint's weights, however it had to be unpickled"""
+    model = build_model('meta', source.get('arch', arch))
+    model.load_state_dict(source['model_state_dict'], assign=True)
+    return model
+
+
+def slim_checkpoint(source, source_fingerprint, dtype='fp32', arch=MODEL_ARCH):
+    """Inference-only copy of a checkpoint dict: weights (floating point ones cast to `dtype`) and metadata"""
+    state_dict = {}
+    for name, tensor in source['model_state_dict'].items():
+        if tensor.is_floating_point():
+            tensor = tensor.to(DTYPES[dtype])
+        # A compact copy, so views never drag their whole base storage into the file
+        state_dict[name] = tensor.clone(memory_format=torch.contiguous_format)
+    return {
+        'format': SLIM_FORMAT,
+        'arch': source.get('arch', arch),
+        'dtype': str(DTYPES[dtype]).replace('torch.', ''),
+        'source_fingerprint': source_fingerprint,
+        'model_state_dict': state_dict
+    }
+
+
+def timed_load(path):
+    start = time.perf_counter()
+    model, _ = load_checkpoint_model(path)
+    return model, time.perf_counter() - start
+
+
+def main():
+    from quantization import load_calibration_batches, CALIBRATION_DIR
+
+    parser = argparse.ArgumentParser(description="Write a weights-only inference checkpoint")
+    parser.add_argument('--model', default=MODEL_PATH, help="Checkpoint with a 'model_state_dict'")
+    parser.add_argument('--output', default=None, help="Defaults to <checkpoint>.slim.pt, where the apps look for it")
+    parser.add_argument('--dtype', choices=list(DTYPES), default='fp32',
+                        help="Storage precision; weights are cast back to fp32 when loaded")
+    parser.add_argument('--allow-pickle', action='store_true',
+                        help="Fully unpickle a checkpoint that weights_only loading rejects (trusted files only)")
+    parser.add_argument('--images', default=CALIBRATION_DIR, help="Images used to compare outputs with the original")
+    parser.add_argument('--atol', type=float, default=None,
+                        help="Maximum allowed absolute difference in log-probabilities (default 1e-5 fp32, 5e-2 fp16/bf16)")
+    args = parser.parse_args()
+    output = args.output or slim_path(args.model)
+
+    fingerprint = model_fingerprint(args.model)
+    # The original is compared from this same dict: with --allow-pickle it can't be re-read weights-only
+    start = time.perf_counter()
+    source = load_source(args.model, args.allow_pickle)
+    original = source_model(source)
+    original_seconds = time.perf_counter() - start
+    slim = slim_checkpoint(source, fingerprint, args.dtype)
+    torch.save(slim, output + '.tmp')
+    os.replace(output + '.tmp', output)
+
+    converted, slim_seconds = timed_load(output)
+    print(f"{args.model}: {os.path.getsize(args.model) / 2**20:.1f} MB, loaded in {original_seconds:.2f}s")
+    print(f"{output}: {os.path.getsize(output) / 2**20:.1f} MB ({slim['dtype']}), loaded in {slim_seconds:.2f}s")
+
+    batches = load_calibration_batches(args.images, limit=16) if os.path.isdir(args.images) else []
+    batch = batches[0] if batches else torch.randn(4, 3, 224, 224)
+    with torch.no_grad():
+        diff = (original.eval()(batch) - converted.eval()(batch)).abs().max().item()
+    atol = args.atol if args.atol is not None else (1e-5 if args.dtype == 'fp32' else 5e-2)
+    print(f"Max |diff| in log-probabilities {diff:.2e} {'OK' if diff <= atol else 'FAILED'}")
+    if diff > atol:
+        raise SystemExit(f"Slim checkpoint outputs differ from the original by more than {atol}")
+
+
+if __name__ == '__main__':
+    main()
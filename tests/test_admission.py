@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+import admission as admission_module
+from admission import AdmissionController, RateLimiter, Rejected
+
+
+def hold_slots(controller, count):
+    return [controller.acquire() for _ in range(count)]
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    controller = AdmissionController(max_in_flight=1, max_queued=1)
+    admitted_at = controller.acquire()
+    waiter = threading.Thread(target=lambda: controller.release(controller.acquire()))
+    waiter.start()
+    while controller.stats()['queued'] == 0:
+        time.sleep(0.001)
+
+    with pytest.raises(Rejected) as rejected:
+        controller.acquire()
+    assert rejected.value.reason == 'queue_full' and rejected.value.retry_after >= 1
+
+    controller.release(admitted_at)  # wakes the queued request
+    waiter.join(timeout=5)
+    stats = controller.stats()
+    assert stats['in_flight'] == 0 and stats['admitted'] == 2 and stats['rejected'] == {'queue_full': 1}
+
+
+def test_deadline_passing_in_the_queue_is_rejected():
+    controller = AdmissionController(max_in_flight=1, max_queued=4)
+    hold_slots(controller, 1)
+    start = time.monotonic()
+    with pytest.raises(Rejected) as rejected:
+        controller.acquire(deadline=start + 0.05)
+    assert rejected.value.reason == 'deadline'
+    assert 0.04 <= time.monotonic() - start < 1
+    assert controller.stats()['queued'] == 0
+
+
+def test_zero_limit_admits_everything():
+    controller = AdmissionController(max_in_flight=0, max_queued=0)
+    hold_slots(controller, 100)
+    assert controller.stats()['in_flight'] == 100
+
+
+def test_rate_limiter_allows_a_burst_then_refills(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission_module.time, 'monotonic', lambda: now[0])
+    limiter = RateLimiter(rate=2, burst=3)
+    for _ in range(3):
+        limiter.take('a')
+    with pytest.raises(Rejected) as rejected:
+        limiter.take('a')
+    assert rejected.value.reason == 'rate_limited' and rejected.value.retry_after == 1
+    limiter.take('b')  # buckets are per client
+
+    now[0] += 0.5  # one token at 2/s
+    limiter.take('a')
+    with pytest.raises(Rejected):
+        limiter.take('a')
+
+
+def test_rate_limiter_forgets_least_recent_clients():
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    for client in ('a', 'b', 'c'):
+        limiter.take(client)
+    assert limiter.stats()['clients'] == 2
+    limiter.take('a')  # evicted, so it starts again with a full bucket
+
+
+def test_deadline_counts_from_the_proxy_timestamp(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'REQUEST_START_HEADER', 'X-Request-Start')
+    for header in (f"t={time.time() - 2:.3f}", str(int((time.time() - 2) * 1000)), str(int((time.time() - 2) * 1e6))):
+        with app.app.test_request_context(headers={'X-Request-Start': header, 'X-Request-Timeout-Ms': '5000'}):
+            app.g.received = app.request_received_at()
+            assert 2.9 < app.request_deadline() - time.monotonic() < 3.1
+    with app.app.test_request_context(headers={'X-Request-Start': f"t={time.time() + 60}"}):
+        assert app.request_received_at() <= time.monotonic()
@@ -0,0 +1,59 @@
+import io
+
+import pytest
+import torch
+
+from embedding_index import EmbeddingIndex
+from model_runtime import build_model
+from test_embedding_index import sample, reexport, with_lesions
+
+
+def png_bytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    import app
+    torch.manual_seed(0)
+    app.runtime.adopt(build_model(arch='resnet18'))
+    monkeypatch.setattr(app, 'embedding_index', EmbeddingIndex(str(tmp_path)))
+    monkeypatch.setattr(app, 'prediction_cache', None)
+    monkeypatch.setattr(app, 'cascade', None)
+    monkeypatch.setattr(app, 'shadow_scorer', None)
+    backbone_runs = []
+    submit = app.inference_scheduler.submit
+
+    def counting_submit(batch, deadline=None):
+        backbone_runs.append(len(batch))
+        return submit(batch, deadline)
+
+    monkeypatch.setattr(app.inference_scheduler, 'submit', counting_submit)
+    return app, backbone_runs
+
+
+def test_reexport_runs_only_the_head(server):
+    app, backbone_runs = server
+    original = sample('eye17.png')
+    first, _ = app.predict_image(png_bytes(original))
+    assert first['near_duplicate'] is None and backbone_runs == [1]
+
+    again, _ = app.predict_image(png_bytes(reexport(original)))
+    assert backbone_runs == [1]
+    assert again['near_duplicate']['same_capture'] is True
+    assert again['severity_value'] == first['severity_value']
+    assert len(app.embedding_index) == 1
+
+
+def test_changed_image_runs_the_backbone(server):
+    app, backbone_runs = server
+    original = sample('eye17.png')
+    app.predict_image(png_bytes(original))
+
+    result, _ = app.predict_image(png_bytes(with_lesions(original, 5)))
+    assert backbone_runs == [1, 1]
+    # Still flagged by the coarse descriptor, but answered by the full model and stored as a new capture
+    assert result['near_duplicate']['same_capture'] is False
+    assert len(app.embedding_index) == 2
@@ -0,0 +1,32 @@
+import io
+import zipfile
+
+from preprocessing import ImageRejected
+from test_app_dedup import png_bytes
+from test_embedding_index import sample
+
+
+def make_zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_zip_bomb_members_are_not_extracted():
+    import app
+    image = png_bytes(sample('eye17.png').resize((256, 184)))
+    archive = make_zip({'eye.png': image, 'bomb.png': bytes(64 * 2**20), 'notes.txt': b'hello'})
+
+    uploads = dict(app.iter_batch_uploads([('scans.zip', archive)]))
+    assert uploads['eye.png'].getvalue() == image
+    assert isinstance(uploads['bomb.png'], ImageRejected)
+    assert 'notes.txt' not in uploads
+
+
+def test_rejected_member_becomes_an_error_line():
+    import app
+    archive = make_zip({'bomb.png': bytes(32 * 2**20)})
+    lines = list(app.predict_batch_stream([('scans.zip', archive)]))
+    assert len(lines) == 1 and 'not extracted' in lines[0] and 'bomb.png' in lines[0]
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from batching import BatchScheduler, DeadlineExceeded
+
+
+class FakeModel:
+    """Doubles its input; records every batch it is called with"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+
+    def __call__(self, batch):
+        self.batches.append(batch.clone())
+        time.sleep(self.delay)
+        return batch * 2
+
+
+def rows(start, count):
+    return torch.arange(start, start + count, dtype=torch.float32).reshape(count, 1)
+
+
+def test_expired_job_never_reaches_the_model():
+    model = FakeModel(delay=0.2)
+    scheduler = BatchScheduler(model, max_batch_size=1, max_wait_ms=0)
+    busy = threading.Thread(target=scheduler.submit, args=(rows(0, 1),))
+    busy.start()
+    while not model.batches:
+        time.sleep(0.001)
+
+    with pytest.raises(DeadlineExceeded):
+        scheduler.submit(rows(100, 1), deadline=time.monotonic() + 0.02)
+    busy.join()
+    scheduler.submit(rows(200, 1))
+    assert [int(batch[0, 0]) for batch in model.batches] == [0, 200]
+    assert scheduler.stats()['expired'] == 1
+
+
+def test_job_already_past_its_deadline_is_dropped():
+    model = FakeModel()
+    scheduler = BatchScheduler(model)
+    with pytest.raises(DeadlineExceeded):
+        scheduler.submit(rows(0, 2), deadline=time.monotonic() - 1)
+    assert model.batches == []
+
+
+def run_concurrently(scheduler, inputs):
+    """Submit each input from its own thread; return the outputs in input order"""
+    outputs = [None] * len(inputs)
+
+    def submit(i):
+        outputs[i] = scheduler.submit(inputs[i])
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    return threads, outputs
+
+
+def test_concurrent_submits_share_a_batch_and_get_their_own_rows():
+    model = FakeModel(delay=0.1)
+    scheduler = BatchScheduler(model, max_batch_size=8, max_wait_ms=50)
+    busy = threading.Thread(target=scheduler.submit, args=(rows(0, 1),))
+    busy.start()
+    while not model.batches:
+        time.sleep(0.001)
+
+    inputs = [rows(10, 2), rows(20, 1), rows(30, 3)]
+    threads, outputs = run_concurrently(scheduler, inputs)
+    while scheduler.stats()['queued'] < len(inputs):
+        time.sleep(0.001)
+    for thread in threads + [busy]:
+        thread.join(timeout=5)
+
+    assert len(model.batches) == 2 and len(model.batches[1]) == 6
+    for given, output in zip(inputs, outputs):
+        assert torch.equal(output, given * 2)
+    assert scheduler.stats()['batches'] == 2 and scheduler.stats()['rows'] == 7
+
+
+def test_tuple_outputs_are_sliced_per_caller():
+    scheduler = BatchScheduler(lambda batch: (batch * 2, batch + 1), max_batch_size=8, max_wait_ms=50)
+    inputs = [rows(0, 2), rows(10, 1)]
+    threads, outputs = run_concurrently(scheduler, inputs)
+    for thread in threads:
+        thread.join(timeout=5)
+    for given, (doubled, shifted) in zip(inputs, outputs):
+        assert torch.equal(doubled, given * 2) and torch.equal(shifted, given + 1)
+
+
+def test_job_larger_than_the_batch_size_still_runs():
+    model = FakeModel()
+    scheduler = BatchScheduler(model, max_batch_size=4)
+    output = scheduler.submit(rows(0, 10))
+    assert torch.equal(output, rows(0, 10) * 2)
+    assert [len(batch) for batch in model.batches] == [10]
+
+
+def test_model_errors_reach_every_caller_in_the_batch():
+    def broken(batch):
+        raise RuntimeError("out of memory")
+
+    scheduler = BatchScheduler(broken)
+    with pytest.raises(RuntimeError, match="out of memory"):
+        scheduler.submit(rows(0, 1))
+    # The worker survives a failed batch
+    scheduler.model_fn = FakeModel()
+    assert torch.equal(scheduler.submit(rows(5, 1)), rows(5, 1) * 2)
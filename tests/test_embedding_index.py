@@ -0,0 +1,87 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from embedding_index import EmbeddingIndex, DESCRIPTOR_DIM, image_descriptor, pixel_signature
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'Retinal_blindness_detection_Pytorch-master', 'sampleimages')
+
+
+def sample(name):
+    return Image.open(os.path.join(SAMPLE_DIR, name)).convert('RGB')
+
+
+def reexport(image, scale=2, quality=60):
+    """Downscaled JPEG copy, as a viewer's "save as" would produce"""
+    buffer = io.BytesIO()
+    image.resize((image.width // scale, image.height // scale), Image.LANCZOS).save(buffer, 'JPEG', quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue())).convert('RGB')
+
+
+def with_lesions(image, count, seed=0):
+    """Paint haemorrhage- and exudate-sized spots onto the central retina"""
+    image = image.copy()
+    draw = ImageDraw.Draw(image)
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        x, y = rng.uniform(0.3, 0.7) * image.width, rng.uniform(0.3, 0.7) * image.height
+        radius = rng.uniform(0.004, 0.012) * image.width
+        draw.ellipse([x - radius, y - radius, x + radius, y + radius],
+                     fill=(120, 20, 10) if i % 2 else (240, 220, 120))
+    return image
+
+
+def unit(seed, dim):
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_instance_opened_before_first_row_sees_other_writers(tmp_path):
+    # Two gunicorn workers sharing one directory: the reader opens the empty store first
+    reader = EmbeddingIndex(str(tmp_path))
+    writer = EmbeddingIndex(str(tmp_path))
+    descriptor, embedding = unit(0, DESCRIPTOR_DIM), unit(1, 512)
+    row = writer.add(descriptor, embedding, patient_id='p1')
+
+    matches = reader.search(descriptor)
+    assert matches and matches[0][0] == row
+    assert reader.embedding_dim == 512
+    np.testing.assert_allclose(reader.embedding(row), embedding, atol=1e-3)
+    assert reader.entry(row)['patient_id'] == 'p1'
+
+
+def test_reader_follows_growth_past_initial_capacity(tmp_path):
+    reader = EmbeddingIndex(str(tmp_path))
+    writer = EmbeddingIndex(str(tmp_path))
+    for i in range(1030):
+        writer.add(unit(i, DESCRIPTOR_DIM), unit(10000 + i, 64))
+    last = unit(1029, DESCRIPTOR_DIM)
+    assert reader.search(last)[0][0] == 1029
+    np.testing.assert_allclose(reader.embedding(1029), unit(11029, 64), atol=1e-3)
+
+
+def test_reexport_is_reused_but_changed_capture_is_not(tmp_path):
+    original = sample('eye17.png')
+    index = EmbeddingIndex(str(tmp_path))
+    row = index.add(image_descriptor(original), unit(0, 64), signature=pixel_signature(original))
+
+    copy = reexport(original)
+    assert index.search(image_descriptor(copy))[0][0] == row
+    assert index.same_capture(row, pixel_signature(copy))
+
+    # The coarse descriptor still calls these near-duplicates; the pixel check must not
+    for count, seed in [(1, 1), (5, 0), (40, 0)]:
+        changed = with_lesions(original, count, seed)
+        assert not index.same_capture(row, pixel_signature(changed)), f"{count} lesions reused"
+    assert image_descriptor(with_lesions(original, 5)) @ image_descriptor(original) >= index.threshold
+    assert not index.same_capture(row, pixel_signature(sample('eye11.png')))
+
+
+def test_rows_without_signature_are_never_reused(tmp_path):
+    black = Image.new('RGB', (64, 64))
+    index = EmbeddingIndex(str(tmp_path))
+    row = index.add(unit(0, DESCRIPTOR_DIM), unit(1, 64))
+    assert not index.same_capture(row, pixel_signature(black))
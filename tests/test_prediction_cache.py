@@ -0,0 +1,33 @@
+import os
+import time
+
+from prediction_cache import PredictionCache
+
+VALUE = [-0.01, -5.2, -6.1, -7.3, -8.4]
+
+
+def disk_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+
+
+def test_disk_tier_prunes_oldest_files_past_its_cap(tmp_path):
+    cache = PredictionCache(disk_dir=str(tmp_path), disk_max_bytes=1000)
+    for i in range(40):
+        cache.put(f'key{i:02d}', VALUE)
+        os.utime(tmp_path / f'key{i:02d}.json', ns=(0, time.time_ns() - (40 - i) * 10 ** 6))
+
+    files = disk_files(tmp_path)
+    assert sum(os.path.getsize(tmp_path / name) for name in files) <= 1000
+    assert 'key39.json' in files and 'key00.json' not in files
+    assert cache.stats()['disk_evictions'] == 40 - len(files)
+
+
+def test_startup_removes_expired_disk_entries(tmp_path):
+    PredictionCache(disk_dir=str(tmp_path)).put('old', VALUE)
+    PredictionCache(disk_dir=str(tmp_path)).put('new', VALUE)
+    stale = time.time() - 7200
+    os.utime(tmp_path / 'old.json', (stale, stale))
+
+    cache = PredictionCache(ttl_seconds=3600, disk_dir=str(tmp_path))
+    assert disk_files(tmp_path) == ['new.json']
+    assert cache.get('new') == VALUE
@@ -0,0 +1,71 @@
+"""
+Deterministic test-time augmentation
+A fixed, ordered set of views of one preprocessed image, scored in a single batched forward pass
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms import functional as TF
+
+from preprocessing import MEAN, STD
+
+# Normalised value of a black pixel, used to fill the corners exposed by rotation
+_BLACK = [-m / s for m, s in zip(MEAN, STD)]
+CROP_SCALE = 0.875
+
+
+def _rotate(angle):
+    return lambda x: TF.rotate(x, angle, interpolation=InterpolationMode.BILINEAR, fill=_BLACK)
+
+
+def _crop(position):
+    """Crop CROP_SCALE of the image at `position` and resize back to the input size"""
+    def view(x):
+        height, width = x.shape[-2:]
+        ch, cw = int(round(height * CROP_SCALE)), int(round(width * CROP_SCALE))
+        top = {'t': 0, 'c': (height - ch) // 2, 'b': height - ch}[position[0]]
+        left = {'l': 0, 'c': (width - cw) // 2, 'r': width - cw}[position[1]]
+        crop = x[..., top:top + ch, left:left + cw]
+        return F.interpolate(crop.unsqueeze(0), size=(height, width), mode='bilinear', align_corners=False)[0]
+    return view
+
+
+# Ordered so that asking for fewer views keeps the most useful ones
+VIEWS = (
+    ('identity', lambda x: x),
+    ('hflip', lambda x: x.flip(-1)),
+    ('vflip', lambda x: x.flip(-2)),
+    ('rot180', lambda x: x.flip(-2, -1)),
+    ('rot+10', _rotate(10)),
+    ('rot-10', _rotate(-10)),
+    ('crop_center', _crop('cc')),
+    ('crop_top_left', _crop('tl')),
+    ('crop_top_right', _crop('tr')),
+    ('crop_bottom_left', _crop('bl')),
+    ('crop_bottom_right', _crop('br')),
+)
+MAX_VIEWS = len(VIEWS)
+
+
+def view_names(count):
+    """Names of the first `count` views"""
+    return [name for name, _ in VIEWS[:count]]
+
+
+def build_views(tensor, count):
+    """Stack the first `count` views of a (3, H, W) input into a (count, 3, H, W) batch"""
+    if not 1 <= count <= MAX_VIEWS:
+        raise ValueError(f"Number of TTA views must be between 1 and {MAX_VIEWS}")
+    if count == 1:
+        return tensor.unsqueeze(0)
+    return torch.stack([view(tensor) for _, view in VIEWS[:count]])
+
+
+def average_views(log_probs):
+    """Average the probabilities of all view rows and return them as one row of log-probabilities"""
+    if log_probs.shape[0] == 1:
+        return log_probs[0]
+    return torch.logsumexp(log_probs, dim=0) - math.log(log_probs.shape[0])